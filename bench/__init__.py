@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""ابزار benchmark آفلاین ربات (بدون تلگرام واقعی و Neon).
+
+اجرا از ریشه‌ی مخزن:
+    python -m bench.run --users 20 --iterations 5
+
+Postgres محلی با initdb/pg_ctl ساخته می‌شود (یا BENCH_DATABASE_URL را بدهید)
+و Bot API با یک سرور tornado محلی شبیه‌سازی می‌شود.
+"""
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""شبیه‌ساز محلی HTTP Bot API تلگرام (فقط آن‌قدر که PTB راضی باشد)."""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+import tornado.web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+class FakeBotAPI:
+    """متدهای send*/edit*/copy* یک Message جعلی برمی‌گردانند، getMe ربات و بقیه True."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        self._server = None
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if method.startswith(("send", "edit")):
+            chat_id = int(params.get("chat_id") or 0)
+            msg = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+            }
+            if "text" in params:
+                msg["text"] = params["text"]
+            return msg
+        return True
+
+    def make_app(self) -> tornado.web.Application:
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                if self.request.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(self.request.body or b"{}")
+                else:
+                    params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+                api.calls[method] += 1
+                if api.latency:
+                    await asyncio.sleep(api.latency)
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps({"ok": True, "result": api._result(method, params)}))
+
+            get = post
+
+        return tornado.web.Application([(r"/bot([^/]+)/(\w+)", Handler)])
+
+    def start(self, port: int):
+        self._server = self.make_app().listen(port, address="127.0.0.1")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
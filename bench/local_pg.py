@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""راه‌اندازی یک Postgres موقت برای benchmark."""
+import glob
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+def _pg_bin(name: str) -> str:
+    found = shutil.which(name)
+    if found:
+        return found
+    candidates = sorted(glob.glob(f"/usr/lib/postgresql/*/bin/{name}"))
+    if candidates:
+        return candidates[-1]
+    raise RuntimeError(f"{name} not found; install PostgreSQL or set BENCH_DATABASE_URL")
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def local_postgres():
+    """URL یک دیتابیس خالی؛ اگر BENCH_DATABASE_URL ست شده باشد همان استفاده می‌شود.
+
+    initdb اجازه‌ی اجرا با root را نمی‌دهد؛ در کانتینر با یک کاربر عادی اجرا کنید.
+    """
+    url = os.getenv("BENCH_DATABASE_URL")
+    if url:
+        yield url
+        return
+    initdb, pg_ctl = _pg_bin("initdb"), _pg_bin("pg_ctl")
+    datadir = tempfile.mkdtemp(prefix="crepebar-pg-")
+    port = _free_port()
+    subprocess.run(
+        [initdb, "-D", datadir, "-U", "bench", "--auth=trust", "-E", "UTF8"],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    subprocess.run(
+        [pg_ctl, "-D", datadir, "-w", "-l", os.path.join(datadir, "server.log"),
+         "-o", f"-p {port} -k {datadir} -c listen_addresses=127.0.0.1 -c fsync=off", "start"],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield f"postgresql://bench@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([pg_ctl, "-D", datadir, "-m", "fast", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(datadir, ignore_errors=True)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""benchmark هندلرهای واقعی build_handlers() با Updateهای مصنوعی.
+
+دو مرحله:
+  profile: یک کاربر سناریو را اجرا می‌کند و برای هر هندلر کوئری/قرض کانکشن/کانکشن
+           فیزیکی به ازای هر update دقیق شمرده می‌شود (بدون تداخل کاربران دیگر).
+  load:    --users کاربر هم‌زمان، هر کدام --iterations بار سناریو؛ throughput و
+           p50/p95/p99 latency هر هندلر.
+
+    python -m bench.run --users 20 --iterations 5 --api-latency-ms 30 --json bench.json
+
+با --persistence همان سناریو با PostgresPersistence اجرا می‌شود؛ مقایسه‌ی دو اجرا
+هزینه‌ی هر update و آمار نوشتن‌های دسته‌ای را نشان می‌دهد.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import defaultdict
+
+from .fake_bot_api import FakeBotAPI, BOT_USER
+from .local_pg import local_postgres, _free_port
+
+ADMIN_TG_ID = 900000
+FIRST_USER_TG_ID = 1000
+STAT_KEYS = ("queries", "borrows", "connects")
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(s) - 1)
+    return s[f] + (s[c] - s[f]) * (k - f)
+
+class Driver:
+    """Update مصنوعی می‌سازد و با app.process_update اجرا و زمان‌گیری می‌کند."""
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.profile = False
+        self.latencies = defaultdict(list)
+        self.db_usage = defaultdict(list)
+        self._update_ids = itertools.count(1)
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _user(tg_id: int) -> dict:
+        return {"id": tg_id, "is_bot": False, "first_name": f"user{tg_id}"}
+
+    def message(self, tg_id: int, text: str | None = None, photo: str | None = None):
+        from telegram import Update
+        msg = {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": tg_id, "type": "private"}, "from": self._user(tg_id),
+        }
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo is not None:
+            msg["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 90, "height": 90}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": msg}, self.app.bot)
+
+    def callback(self, tg_id: int, data: str, photo: bool = False):
+        """callback روی پیام متنی ربات، یا با photo=True روی کارت عکس‌دار."""
+        from telegram import Update
+        msg = {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": tg_id, "type": "private"}, "from": BOT_USER,
+        }
+        if photo:
+            msg["photo"] = [{"file_id": "card", "file_unique_id": "card", "width": 90, "height": 90}]
+            msg["caption"] = "…"
+        else:
+            msg["text"] = "…"
+        cq = {
+            "id": str(next(self._ids)), "from": self._user(tg_id),
+            "chat_instance": str(tg_id), "data": data, "message": msg,
+        }
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": cq}, self.app.bot)
+
+    async def send(self, label: str, update):
+        before = self.db.stats() if self.profile else None
+        t0 = time.perf_counter()
+        await self.app.process_update(update)
+        self.latencies[label].append(time.perf_counter() - t0)
+        if before is not None:
+            after = self.db.stats()
+            self.db_usage[label].append({k: after[k] - before[k] for k in STAT_KEYS})
+
+async def user_flow(d: Driver, adb, tg_id: int, cat_id: int, after_id: int, product_ids):
+    """مرور منو → صفحه‌ی دوم دسته → افزودن به سبد → سبد → ارسال/پرداخت → ثبت با کیف پول
+    → مکالمه‌ی شارژ (کیف پول → مبلغ → رسید)."""
+    await d.send("start", d.message(tg_id, "/start"))
+    await d.send("menu", d.message(tg_id, "🍭 منو"))
+    await d.send("cat", d.callback(tg_id, f"cat:{cat_id}"))
+    await d.send("catp", d.callback(tg_id, f"catp:{cat_id}:2:a{after_id}", photo=True))
+    for pid in product_ids:
+        await d.send("add", d.callback(tg_id, f"add:{pid}"))
+    await d.send("order", d.message(tg_id, "🧾 سفارش"))
+    await d.send("ship", d.callback(tg_id, "ship:toggle"))
+    await d.send("pay", d.callback(tg_id, "pay:toggle"))
+    user = await adb.resolve_user(tg_id)
+    order, _ = await adb.get_draft_with_items(user["id"])
+    await d.send("submit", d.callback(tg_id, f"submit:{order['order_id']}"))
+    await d.send("wallet", d.message(tg_id, "👛 کیف پول"))
+    await d.send("amount", d.message(tg_id, "50000"))
+    await d.send("receipt", d.message(tg_id, photo=f"receipt{tg_id}"))
+
+def seed(db, users: int, products: int):
+    db.init_db()
+    cats = db.list_categories()
+    cat_id = cats[0]["id"]
+    for i in range(products):
+        db.add_product(cat_id, f"محصول {i}", 50000 + i * 1000, None, f"photo{i}" if i % 2 else None)
+    for n in range(users + 1):
+        tg_id = FIRST_USER_TG_ID + n
+        uid = db.upsert_user(tg_id, f"user{tg_id}")
+        db.add_wallet_tx(uid, "topup", 10**12, {"bench": True})
+    first_page, _ = db.list_products_by_category(cat_id, None, None, 6)
+    return cat_id, first_page[-1]["id"], [p["id"] for p in first_page[:3]]
+
+def report(d: Driver, wall: float, api: FakeBotAPI, persistence=None) -> dict:
+    out = {"wall_seconds": wall, "handlers": {}, "bot_api_calls": dict(api.calls)}
+    total = sum(len(v) for v in d.latencies.values())
+    out["throughput_updates_per_s"] = total / wall if wall else 0.0
+    print(f"\n{'handler':<8} {'n':>6} {'upd/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+          f" {'q/upd':>6} {'borrow':>7} {'conn':>5}")
+    for label, lat in d.latencies.items():
+        usage = d.db_usage.get(label) or [{k: 0 for k in STAT_KEYS}]
+        per = {k: sum(u[k] for u in usage) / len(usage) for k in STAT_KEYS}
+        row = {
+            "n": len(lat), "updates_per_s": len(lat) / wall if wall else 0.0,
+            "p50_ms": percentile(lat, 50) * 1000, "p95_ms": percentile(lat, 95) * 1000,
+            "p99_ms": percentile(lat, 99) * 1000,
+            "queries_per_update": per["queries"], "borrows_per_update": per["borrows"],
+            "connects_per_update": per["connects"],
+        }
+        out["handlers"][label] = row
+        print(f"{label:<8} {row['n']:>6} {row['updates_per_s']:>8.1f} {row['p50_ms']:>8.2f}"
+              f" {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {per['queries']:>6.1f}"
+              f" {per['borrows']:>7.1f} {per['connects']:>5.1f}")
+    print(f"\ntotal: {total} updates in {wall:.2f}s → {out['throughput_updates_per_s']:.1f} upd/s")
+    if persistence is not None:
+        c = dict(persistence.counters)
+        out["persistence"] = c
+        print(f"persistence: {c['flushes']} flushes, {c['rows']} rows, {c['seconds']*1000:.1f}ms"
+              f" ({c['seconds'] / total * 1e6 if total else 0:.0f}µs/update amortized)")
+    return out
+
+async def bench(args):
+    from telegram.ext import Application, AIORateLimiter
+    from src import db, adb, metrics
+    from src.handlers import build_handlers
+    from src.persistence import PostgresPersistence
+
+    cat_id, after_id, product_ids = seed(db, args.users, args.products)
+
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    port = _free_port()
+    api.start(port)
+    builder = Application.builder().token(os.environ["BOT_TOKEN"]) \
+        .base_url(f"http://127.0.0.1:{port}/bot").base_file_url(f"http://127.0.0.1:{port}/file/bot")
+    if args.rate_limiter:
+        builder = builder.rate_limiter(AIORateLimiter())
+    persistence = None
+    if args.persistence:
+        persistence = PostgresPersistence(update_interval=args.persistence_interval)
+        builder = builder.persistence(persistence)
+    app = builder.build()
+    for h in build_handlers(persistent=args.persistence):
+        app.add_handler(metrics.instrument(h))
+
+    async with app:
+        await app.start()
+        d = Driver(app, db)
+
+        # profile: گرم کردن کش‌ها، سپس یک دور اندازه‌گیری دقیق
+        tg = FIRST_USER_TG_ID
+        await user_flow(d, adb, tg, cat_id, after_id, product_ids)
+        d.latencies.clear()
+        d.profile = True
+        await user_flow(d, adb, tg, cat_id, after_id, product_ids)
+        d.profile = False
+        d.latencies.clear()
+        api.calls.clear()
+        if persistence is not None:
+            await app.update_persistence()
+            persistence.counters.update(flushes=0, rows=0, seconds=0.0)
+
+        # load
+        async def one_user(n):
+            for _ in range(args.iterations):
+                await user_flow(d, adb, FIRST_USER_TG_ID + 1 + n, cat_id, after_id, product_ids)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one_user(n) for n in range(args.users)))
+        wall = time.perf_counter() - t0
+        await app.stop()
+    api.stop()
+    out = report(d, wall, api, persistence)
+    out["args"] = vars(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=20, help="کاربران هم‌زمان در مرحله‌ی load")
+    ap.add_argument("--iterations", type=int, default=5, help="تکرار سناریو برای هر کاربر")
+    ap.add_argument("--products", type=int, default=30, help="تعداد محصولات دسته‌ی اول")
+    ap.add_argument("--api-latency-ms", type=float, default=0.0, help="تاخیر مصنوعی Bot API")
+    ap.add_argument("--pool-max", type=int, default=10)
+    ap.add_argument("--rate-limiter", action="store_true", help="AIORateLimiter مثل production")
+    ap.add_argument("--persistence", action="store_true", help="PostgresPersistence مثل production")
+    ap.add_argument("--persistence-interval", type=float, default=5.0, help="فاصله‌ی نوشتن دسته‌ای (ثانیه)")
+    ap.add_argument("--json", help="ذخیره‌ی نتیجه به‌صورت JSON")
+    args = ap.parse_args()
+
+    with local_postgres() as url:
+        # src.base تنظیمات را هنگام import از env می‌خواند
+        os.environ.update({
+            "DATABASE_URL": url,
+            "BOT_TOKEN": "123456:bench",
+            "ADMIN_IDS": str(ADMIN_TG_ID),
+            "DB_POOL_MAX": str(args.pool_max),
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        })
+        asyncio.run(bench(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""stress هم‌زمانی پرداخت با کیف پول: هیچ‌وقت نباید موجودی منفی شود.
+
+یک کاربر با موجودی B و --orders سفارش هر کدام به مبلغ T (B < orders*T) ساخته
+می‌شود و همه‌ی پرداخت‌ها هم‌زمان از --workers thread اجرا می‌شوند. انتظار:
+دقیقاً B//T سفارش paid، موجودی نهایی B - paid*T، و برابری users.balance با
+جمع دفتر wallet_transactions. در صورت نقض، خروجی غیرصفر است.
+
+    python -m bench.stress_checkout --orders 50 --workers 16
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .local_pg import local_postgres
+
+TG_ID = 5000
+
+def run(args) -> int:
+    from src import db
+
+    db.init_db()
+    # کش‌بک صفر تا محاسبه‌ی مورد انتظار ساده بماند
+    db._exec("UPDATE settings SET value='0' WHERE key='cashback_percent'")
+    cat_id = db.list_categories()[0]["id"]
+    pid = db.add_product(cat_id, "stress", args.price, None, None)
+    uid = db.upsert_user(TG_ID, "stress")
+    budget = args.price * (args.orders // 2) + args.price // 2
+    db.add_wallet_tx(uid, "topup", budget, {"stress": True})
+
+    order_ids = []
+    with db._conn() as cn, cn.cursor() as cur:
+        for _ in range(args.orders):
+            cur.execute("INSERT INTO orders(user_id,status) VALUES(%s,'submitted') RETURNING order_id", (uid,))
+            oid = cur.fetchone()[0]
+            cur.execute("INSERT INTO order_items(order_id,product_id,qty,unit_price) VALUES(%s,%s,1,%s)",
+                        (oid, pid, args.price))
+            order_ids.append(oid)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as ex:
+        results = list(ex.map(lambda oid: db.wallet_checkout(oid, TG_ID), order_ids))
+    wall = time.perf_counter() - t0
+
+    paid = sum(1 for r in results if r["status"] == "paid")
+    with db._conn() as cn, cn.cursor() as cur:
+        cur.execute("SELECT balance FROM users WHERE user_id=%s", (uid,))
+        balance = cur.fetchone()[0]
+        cur.execute("SELECT COALESCE(SUM(amount),0) FROM wallet_transactions WHERE user_id=%s", (uid,))
+        ledger = cur.fetchone()[0]
+
+    expected_paid = budget // args.price
+    print(f"{args.orders} checkouts / {args.workers} workers in {wall*1000:.0f} ms "
+          f"({args.orders/wall:.0f}/s): paid={paid} (expected {expected_paid}), "
+          f"balance={balance} (expected {budget - expected_paid*args.price}), ledger={ledger}")
+    ok = paid == expected_paid and balance == budget - paid * args.price and balance >= 0 and ledger == balance
+    print("OK" if ok else "FAILED: overdraft or lost update")
+    return 0 if ok else 1
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--orders", type=int, default=50)
+    ap.add_argument("--workers", type=int, default=16)
+    ap.add_argument("--price", type=int, default=100000)
+    args = ap.parse_args()
+    with local_postgres() as url:
+        os.environ.update({
+            "DATABASE_URL": url,
+            "DB_POOL_MAX": str(args.workers),
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        })
+        sys.exit(run(args))
+
+if __name__ == "__main__":
+    main()
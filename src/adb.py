@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""نسخه‌ی async توابع db: هر کوئری در یک thread pool محدود اجرا می‌شود
+تا event loop ربات هنگام انتظار برای Postgres قفل نشود."""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .base import DB_POOL_MAX
+from . import db
+
+# هم‌اندازه‌ی pool کانکشن؛ threadها بیشتر از کانکشن‌ها فقط منتظر می‌مانند
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+def _wrap(fn):
+    # توابع کش‌شده (cache.memoize) در صورت hit بدون رفتن به thread pool جواب می‌دهند
+    peek = getattr(fn, "peek", None)
+
+    @functools.wraps(fn)
+    async def runner(*args, **kwargs):
+        if peek is not None:
+            hit, value = peek(*args, **kwargs)
+            if hit:
+                return value
+        return await run(fn, *args, **kwargs)
+    return runner
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+# Users
+upsert_user = _wrap(db.upsert_user)
+resolve_user = _wrap(db.resolve_user)
+get_user_by_tg = _wrap(db.get_user_by_tg)
+get_user_tg_by_id = _wrap(db.get_user_tg_by_id)
+get_balance = _wrap(db.get_balance)
+
+# Categories / Products
+list_categories = _wrap(db.list_categories)
+list_products_by_category = _wrap(db.list_products_by_category)
+get_category_cover = _wrap(db.get_category_cover)
+search_products = _wrap(db.search_products)
+import_catalog = _wrap(db.import_catalog)
+export_catalog = _wrap(db.export_catalog)
+get_product = _wrap(db.get_product)
+add_product = _wrap(db.add_product)
+
+# Orders
+open_draft_order = _wrap(db.open_draft_order)
+add_or_increment_item = _wrap(db.add_or_increment_item)
+cart_add = _wrap(db.cart_add)
+empty_order = _wrap(db.empty_order)
+get_draft_with_items = _wrap(db.get_draft_with_items)
+get_order_with_items_by_id = _wrap(db.get_order_with_items_by_id)
+verify_order_totals = _wrap(db.verify_order_totals)
+set_order_option = _wrap(db.set_order_option)
+submit_order = _wrap(db.submit_order)
+mark_order_paid = _wrap(db.mark_order_paid)
+
+# Kitchen queue
+advance_order = _wrap(db.advance_order)
+kitchen_queue = _wrap(db.kitchen_queue)
+list_kitchen_boards = _wrap(db.list_kitchen_boards)
+set_kitchen_board = _wrap(db.set_kitchen_board)
+drop_kitchen_board = _wrap(db.drop_kitchen_board)
+
+# Wallet
+add_wallet_tx = _wrap(db.add_wallet_tx)
+wallet_checkout = _wrap(db.wallet_checkout)
+wallet_statement = _wrap(db.wallet_statement)
+checkpoint_wallets = _wrap(db.checkpoint_wallets)
+reconcile_wallets = _wrap(db.reconcile_wallets)
+
+# Janitor
+expire_payment_requests = _wrap(db.expire_payment_requests)
+expire_drafts = _wrap(db.expire_drafts)
+archive_orders = _wrap(db.archive_orders)
+
+# Reports
+sales_report = _wrap(db.sales_report)
+
+# Topup & Order-pay requests
+create_topup_request = _wrap(db.create_topup_request)
+create_order_pay_request = _wrap(db.create_order_pay_request)
+set_topup_admin_msg = _wrap(db.set_topup_admin_msg)
+decide_payment = _wrap(db.decide_payment)
+
+# Broadcasts
+create_broadcast = _wrap(db.create_broadcast)
+get_broadcast = _wrap(db.get_broadcast)
+list_running_broadcasts = _wrap(db.list_running_broadcasts)
+fetch_broadcast_recipients = _wrap(db.fetch_broadcast_recipients)
+checkpoint_broadcast = _wrap(db.checkpoint_broadcast)
+finish_broadcast = _wrap(db.finish_broadcast)
+
+# Outbox
+enqueue_notices = _wrap(db.enqueue_notices)
+claim_outbox = _wrap(db.claim_outbox)
+finish_outbox = _wrap(db.finish_outbox)
+
+# Bot persistence
+load_user_data = _wrap(db.load_user_data)
+load_conversations = _wrap(db.load_conversations)
+save_persistence = _wrap(db.save_persistence)
+
+# Cluster
+acquire_lease = _wrap(db.acquire_lease)
+release_lease = _wrap(db.release_lease)
+try_chat_lock = _wrap(db.try_chat_lock)
+unlock_chat = _wrap(db.unlock_chat)
+
+# Update de-duplication
+claim_update = _wrap(db.claim_update)
+prune_processed_updates = _wrap(db.prune_processed_updates)
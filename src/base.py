@@ -15,9 +15,44 @@ TOKEN = os.getenv("BOT_TOKEN", "").strip()
 PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "mysecret")
 PORT = int(os.getenv("PORT", "10000"))
+# حداکثر آپدیت‌هایی که هم‌زمان پردازش می‌شوند (۱ = ترتیبی مثل قبل)
+MAX_CONCURRENT_UPDATES = max(1, int(os.getenv("MAX_CONCURRENT_UPDATES", "32")))
+
+# Multi-worker: WORKERS پردازه روی همین ماشین (fork) × INSTANCES ماشین پشت یک وبهوک.
+# با بیش از یک پردازه، قفل چت، lease رهبر و LISTEN/NOTIFY فعال می‌شوند.
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+INSTANCES = max(1, int(os.getenv("INSTANCES", "1")))
+CLUSTER_SIZE = WORKERS * INSTANCES
+CLUSTERED = CLUSTER_SIZE > 1
+# lease رهبر (broadcast، outbox، کارهای دوره‌ای) هر LEADER_LEASE_TTL/3 ثانیه تمدید می‌شود
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+# حذف آپدیت‌های تکراری (redelivery تلگرام): پنجره‌ی update_idهای اخیر در حافظه و
+# در صورت فعال بودن جدول processed_updates (پیش‌فرض: فقط وقتی چند پردازه داریم)
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "10000"))
+UPDATE_DEDUP_DB = os.getenv("UPDATE_DEDUP_DB", "1" if CLUSTERED else "0") == "1"
+# حداکثر انتظار برای قفل یک چت که پردازه‌ی دیگری در حال پردازش آن است (ثانیه)
+CHAT_LOCK_TIMEOUT = float(os.getenv("CHAT_LOCK_TIMEOUT", "30"))
 
 # DB / Settings
 DATABASE_URL = os.getenv("DATABASE_URL", "")
+# Connection pool (psycopg2 ThreadedConnectionPool): DB_POOL_MIN کانکشن از ابتدا ساخته و
+# تا DB_POOL_MAX کانکشن بیکار برای قرض‌های بعدی باز نگه داشته می‌شود
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = max(DB_POOL_MIN, int(os.getenv("DB_POOL_MAX", "5")))
+# کانکشن‌هایی که بیش از این (ثانیه) بیکار بوده‌اند قبل از استفاده با SELECT 1 چک می‌شوند
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+# کوئری‌های کندتر از این (میلی‌ثانیه) با WARNING لاگ می‌شوند
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+# مسیر متریک‌ها کنار وبهوک؛ اگر METRICS_TOKEN ست شود، ?token=... لازم است
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# عمر کش منو/محصولات در حافظه (ثانیه)؛ با ثبت محصول جدید هم خالی می‌شود
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "300"))
+# کش کوتاه نتایج جستجو (inline query هنگام تایپ، پیشوندهای پرتکرار)
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "30"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2048"))
+# حداکثر کاربرانی که نگاشت telegram_id ⇄ user_id آن‌ها در حافظه می‌ماند
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
 try:
     CASHBACK_PERCENT = float(os.getenv("CASHBACK_PERCENT", "3"))
 except Exception:
@@ -27,6 +62,37 @@ except Exception:
 _admin_ids_env = os.getenv("ADMIN_IDS", "").replace(",", " ").split()
 ADMIN_IDS = [int(x) for x in _admin_ids_env if x.isdigit()]
 
+# Outbox: ارسال پیام‌های ثبت‌شده در دیتابیس
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+
+# Broadcast: پیام در ثانیه (سقف سراسری تلگرام ~۳۰/ثانیه است؛ بقیه برای ترافیک عادی)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+
+# فاصله‌ی checkpoint موجودی کیف پول‌ها (ثانیه)
+WALLET_CHECKPOINT_INTERVAL = float(os.getenv("WALLET_CHECKPOINT_INTERVAL", "3600"))
+
+# فاصله‌ی نوشتن دسته‌ای مکالمه‌ها و user_data در دیتابیس (ثانیه)؛
+# در crash حداکثر همین مقدار از تغییرات از دست می‌رود
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+# نظافت دوره‌ای (janitor): سبدهای رهاشده حذف، درخواست‌های پرداخت بی‌پاسخ expired و
+# سفارش‌های پرداخت‌شده‌ی قدیمی به orders_history منتقل می‌شوند (ORDER_ARCHIVE_DAYS=0 یعنی بدون انتقال).
+# هر کار در دسته‌های JANITOR_BATCH ردیفی، هر دسته یک تراکنش کوتاه.
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", "3600"))
+JANITOR_BATCH = int(os.getenv("JANITOR_BATCH", "500"))
+DRAFT_TTL_HOURS = float(os.getenv("DRAFT_TTL_HOURS", "72"))
+PAYMENT_REQUEST_TTL_HOURS = float(os.getenv("PAYMENT_REQUEST_TTL_HOURS", "48"))
+ORDER_ARCHIVE_DAYS = float(os.getenv("ORDER_ARCHIVE_DAYS", "180"))
+
+# تابلوی سفارش‌های آشپزخانه: تغییرات هر KITCHEN_BOARD_INTERVAL ثانیه در یک ویرایش
+# (به ازای هر تابلو) جمع می‌شوند؛ حداکثر KITCHEN_BOARD_SIZE سفارش روی تابلو
+KITCHEN_BOARD_INTERVAL = float(os.getenv("KITCHEN_BOARD_INTERVAL", "2"))
+KITCHEN_BOARD_SIZE = int(os.getenv("KITCHEN_BOARD_SIZE", "30"))
+
 # Payments (defaults filled with what you gave me)
 CARD_PAN  = os.getenv("CARD_PAN",  "5029081080984145")
 CARD_NAME = os.getenv("CARD_NAME", "شهرزاد محمد زاده")
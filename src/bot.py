@@ -1,27 +1,89 @@
+import asyncio
+import os
+import signal
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+from telegram import Update
 from telegram.ext import Application, AIORateLimiter
-from .base import TOKEN, PUBLIC_URL, WEBHOOK_SECRET, PORT, log
+from .base import (
+    TOKEN, PUBLIC_URL, WEBHOOK_SECRET, PORT, MAX_CONCURRENT_UPDATES, METRICS_PATH, log,
+    WORKERS, CLUSTER_SIZE,
+)
 from .handlers import build_handlers
-from . import db
+from .persistence import PostgresPersistence
+from . import db, adb, cluster, metrics, web
+
+async def _post_init(app: Application):
+    # broadcast، outbox و کارهای دوره‌ای فقط روی رهبر (cluster.start)
+    await cluster.start(app)
+
+async def _post_shutdown(app: Application):
+    adb.shutdown()
+    db.close_pool()
+
+async def _serve(app: Application, sockets):
+    # به‌جای run_webhook سرور را خودمان می‌سازیم تا /metrics کنار وبهوک سرو شود
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    await _post_init(app)
+    await app.start()
+    server = tornado.httpserver.HTTPServer(web.make_app(app))
+    server.add_sockets(sockets)
+    # وبهوک ساده: آدرس عمومی کامل در env → PUBLIC_URL
+    await app.bot.set_webhook(
+        url=PUBLIC_URL,                  # مثال: https://bio-crepebar-bot.onrender.com
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    log.info(f"Webhook at {PUBLIC_URL}/ (metrics: {METRICS_PATH}) on port {PORT}")
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await cluster.stop(app)
+        await app.stop()
+        await app.shutdown()
+        await _post_shutdown(app)
+
+def _forward_signal(signum, frame):
+    signal.signal(signum, signal.SIG_IGN)
+    os.killpg(os.getpgid(0), signum)
 
 def main():
     db.init_db()
+    sockets = tornado.netutil.bind_sockets(PORT, address="0.0.0.0")
+    if WORKERS > 1:
+        # فرزندها pool خودشان را می‌سازند؛ کانکشن باز نباید بین پردازه‌ها مشترک شود
+        db.close_pool()
+        # پردازه‌ی والد فقط ناظر است؛ SIGTERM/SIGINT را به همه‌ی workerها می‌رساند
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, _forward_signal)
+        task_id = tornado.process.fork_processes(WORKERS)
+        log.info(f"worker {task_id} started (pid {os.getpid()})")
 
+    processor = cluster.ChatLockProcessor(MAX_CONCURRENT_UPDATES)
     app = Application.builder() \
         .token(TOKEN) \
-        .rate_limiter(AIORateLimiter()) \
+        .rate_limiter(AIORateLimiter(
+            # سقف‌های تلگرام برای کل ربات است؛ هر پردازه سهم خودش را دارد
+            overall_max_rate=30 / CLUSTER_SIZE,
+            group_max_rate=20 / CLUSTER_SIZE,
+        )) \
+        .concurrent_updates(processor) \
+        .persistence(PostgresPersistence()) \
         .build()
+    processor.app = app
 
     for h in build_handlers():
-        app.add_handler(h)
+        app.add_handler(metrics.instrument(h))
 
-    # وبهوک ساده: آدرس عمومی کامل در env → PUBLIC_URL
-    log.info(f"Starting webhook at {PUBLIC_URL}/")
-    app.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        webhook_url=PUBLIC_URL,          # مثال: https://bio-crepebar-bot.onrender.com
-        secret_token=WEBHOOK_SECRET or None,
-    )
+    asyncio.run(_serve(app, sockets))
 
 if __name__ == "__main__":
     main()
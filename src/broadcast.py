@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""پیام همگانی به همه‌ی کاربران فعال از طریق JobQueue.
+
+گیرندگان به‌صورت دسته‌ای (keyset روی user_id) خوانده می‌شوند، ارسال با token bucket
+زیر سقف سراسری تلگرام انجام می‌شود و بعد از هر دسته checkpoint در دیتابیس ثبت
+می‌شود تا پس از ری‌استارت از همان‌جا ادامه پیدا کند.
+"""
+import asyncio
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, ContextTypes
+
+from .base import log, BROADCAST_RATE, BROADCAST_BATCH
+from . import adb, cluster
+
+class TokenBucket:
+    """token bucket ساده: rate توکن در ثانیه، حداکثر burst توکن ذخیره."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# یک bucket برای همه‌ی broadcastهای این پردازه
+_bucket: TokenBucket | None = None
+
+def _get_bucket() -> TokenBucket:
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(BROADCAST_RATE, burst=max(1.0, BROADCAST_RATE / 2))
+    return _bucket
+
+# نتیجه‌ی ارسال به یک گیرنده
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+async def _deliver(bot, bc, chat_id: int) -> str:
+    for _ in range(3):
+        await _get_bucket().acquire()
+        try:
+            if bc["from_chat_id"] and bc["message_id"]:
+                await bot.copy_message(chat_id=chat_id, from_chat_id=bc["from_chat_id"], message_id=bc["message_id"])
+            else:
+                await bot.send_message(chat_id=chat_id, text=bc["text"])
+            return SENT
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+        except Forbidden:
+            return BLOCKED
+        except BadRequest as e:
+            # کاربر حسابش را حذف کرده یا چت وجود ندارد
+            if "chat not found" in str(e).lower() or "deactivated" in str(e).lower():
+                return BLOCKED
+            return FAILED
+        except NetworkError:
+            await asyncio.sleep(1)
+    return FAILED
+
+async def run_broadcast(context: ContextTypes.DEFAULT_TYPE):
+    bid = context.job.data
+    bc = await adb.get_broadcast(bid)
+    if not bc or bc["status"] != "running":
+        return
+    after = bc["last_user_id"]
+    total = {"sent": bc["sent"], "failed": bc["failed"], "blocked": bc["blocked"]}
+    log.info(f"broadcast #{bid}: starting after user_id={after}")
+    t0 = time.perf_counter()
+    status = "running"
+    while status == "running":
+        if not cluster.is_leader():
+            # رهبر جدید از آخرین checkpoint ادامه می‌دهد
+            log.warning(f"broadcast #{bid}: paused at user_id={after} (not leader)")
+            return
+        batch = await adb.fetch_broadcast_recipients(after, BROADCAST_BATCH)
+        if not batch:
+            break
+        results = await asyncio.gather(*(_deliver(context.bot, bc, tg_id) for _, tg_id in batch))
+        blocked = [tg_id for (_, tg_id), r in zip(batch, results) if r == BLOCKED]
+        sent = results.count(SENT)
+        failed = results.count(FAILED)
+        after = batch[-1][0]
+        status = await adb.checkpoint_broadcast(bid, after, sent, failed, blocked)
+        total["sent"] += sent; total["failed"] += failed; total["blocked"] += len(blocked)
+        log.info(f"broadcast #{bid}: checkpoint user_id={after} {total}")
+
+    if status == "running":
+        await adb.finish_broadcast(bid, "done")
+    log.info(f"broadcast #{bid}: {status if status != 'running' else 'done'} in {time.perf_counter()-t0:.1f}s {total}")
+    try:
+        await context.bot.send_message(
+            bc["admin_tg_id"],
+            f"📣 پیام همگانی #{bid} {'لغو شد' if status == 'cancelled' else 'تمام شد'}.\n"
+            f"ارسال‌شده: {total['sent']} | ناموفق: {total['failed']} | بلاک‌کرده: {total['blocked']}",
+        )
+    except Exception as e:
+        log.warning(f"broadcast #{bid}: admin report failed: {e}")
+
+def schedule(app: Application, broadcast_id: int):
+    """اجرا فقط روی رهبر؛ بقیه‌ی workerها منتظر NOTIFY «broadcast» به رهبر می‌مانند."""
+    name = f"broadcast:{broadcast_id}"
+    if not cluster.is_leader() or app.job_queue.get_jobs_by_name(name):
+        return
+    app.job_queue.run_once(run_broadcast, 0, data=broadcast_id, name=name)
+
+async def resume_all(app: Application):
+    """broadcastهای نیمه‌کاره (مثلاً قبل از ری‌استارت) را از آخرین checkpoint ادامه می‌دهد."""
+    for bid in await adb.list_running_broadcasts():
+        log.info(f"broadcast #{bid}: resuming")
+        schedule(app, bid)
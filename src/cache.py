@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""کش‌های درون‌پردازه‌ای (بدون وابستگی به تلگرام/دیتابیس)."""
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+class VersionedCache:
+    """کش کلید/مقدار با TTL و شماره‌ی نسخه.
+
+    invalidate() نسخه را بالا می‌برد و همه‌چیز را دور می‌ریزد؛ نتیجه‌ی کوئری‌ای
+    که قبل از invalidate شروع شده با نسخه‌ی قدیمی put می‌شود و نادیده گرفته می‌شود.
+    با maxsize (برای کلیدهای نامحدود مثل عبارت جستجو) قدیمی‌ترین ورودی‌ها بیرون می‌افتند.
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int | None = None):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: dict = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return True, entry[1]
+        return False, None
+
+    def get(self, key):
+        """(hit, value)"""
+        hit, value = self._lookup(key)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit, value
+
+    def put(self, key, value, version: int):
+        with self._lock:
+            if version == self.version:
+                self._data.pop(key, None)
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                if self.maxsize is not None and len(self._data) > self.maxsize:
+                    del self._data[next(iter(self._data))]
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name, "version": self.version, "size": len(self._data),
+            "hits": self.hits, "misses": self.misses,
+        }
+
+    def memoize(self, fn):
+        """تابع sync را کش می‌کند؛ fn.peek(...) بدون اجرای fn فقط کش را نگاه می‌کند."""
+        def key_of(args, kwargs):
+            return (fn.__name__, args, tuple(sorted(kwargs.items())))
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = key_of(args, kwargs)
+            hit, value = self.get(key)
+            if hit:
+                return value
+            version = self.version
+            value = fn(*args, **kwargs)
+            self.put(key, value, version)
+            return value
+
+        def peek(*args, **kwargs):
+            # miss اینجا شمرده نمی‌شود؛ فراخوانی بعدی wrapper آن را می‌شمارد
+            hit, value = self._lookup(key_of(args, kwargs))
+            if hit:
+                self.hits += 1
+            return hit, value
+
+        wrapper.peek = peek
+        return wrapper
+
+class IdentityMap:
+    """LRU محدود telegram_id ⇄ user_id (به‌همراه نام) با حذف قدیمی‌ترین‌ها."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._by_tg: OrderedDict[int, dict] = OrderedDict()
+        self._tg_by_id: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _lookup_tg(self, tg_id: int):
+        with self._lock:
+            u = self._by_tg.get(tg_id)
+            if u is not None:
+                self._by_tg.move_to_end(tg_id)
+            return u
+
+    def peek_tg(self, tg_id: int):
+        """(hit, user)؛ miss شمرده نمی‌شود."""
+        u = self._lookup_tg(tg_id)
+        if u is not None:
+            self.hits += 1
+        return u is not None, u
+
+    def get_by_tg(self, tg_id: int):
+        u = self._lookup_tg(tg_id)
+        if u is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return u
+
+    def _lookup_user(self, user_id: int):
+        with self._lock:
+            tg_id = self._tg_by_id.get(user_id)
+            if tg_id is not None:
+                self._by_tg.move_to_end(tg_id)
+            return tg_id
+
+    def peek_user(self, user_id: int):
+        """(hit, telegram_id)؛ miss شمرده نمی‌شود."""
+        tg_id = self._lookup_user(user_id)
+        if tg_id is not None:
+            self.hits += 1
+        return tg_id is not None, tg_id
+
+    def get_tg(self, user_id: int):
+        tg_id = self._lookup_user(user_id)
+        if tg_id is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return tg_id
+
+    def put(self, user: dict):
+        """user: {"id", "telegram_id", "name"}"""
+        tg_id = user["telegram_id"]
+        with self._lock:
+            old = self._by_tg.pop(tg_id, None)
+            if old is not None:
+                self._tg_by_id.pop(old["id"], None)
+            self._by_tg[tg_id] = user
+            self._tg_by_id[user["id"]] = tg_id
+            while len(self._by_tg) > self.maxsize:
+                _, evicted = self._by_tg.popitem(last=False)
+                self._tg_by_id.pop(evicted["id"], None)
+
+    def discard(self, tg_id: int):
+        with self._lock:
+            old = self._by_tg.pop(tg_id, None)
+            if old is not None:
+                self._tg_by_id.pop(old["id"], None)
+
+    def stats(self) -> dict:
+        return {"name": "identities", "size": len(self._by_tg), "hits": self.hits, "misses": self.misses}
+
+class RecentSet:
+    """مجموعه‌ی محدود از کلیدهای اخیر (ring)؛ قدیمی‌ترین‌ها بیرون می‌افتند."""
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self._keys: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key) -> bool:
+        """True اگر کلید جدید بود."""
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self.maxlen:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""تبدیل فایل ورودی/خروجی کاتالوگ برای db.import_catalog / db.export_catalog.
+
+CSV مستقیم به COPY داده می‌شود؛ XLSX با openpyxl (در requirements.txt) اول به CSV تبدیل می‌شود.
+"""
+import csv
+import io
+import tempfile
+
+from .db import CATALOG_COLUMNS
+
+REQUIRED_COLUMNS = ("category", "name", "price")
+BOM = b"\xef\xbb\xbf"
+
+def prepare_import(filename: str, data: bytes):
+    """(فایل CSV آماده‌ی COPY، ستون‌ها)؛ ValueError با پیام قابل نمایش به ادمین."""
+    if filename.lower().endswith(".xlsx"):
+        data = _xlsx_to_csv(data)
+    if data.startswith(BOM):
+        data = data[len(BOM):]
+    # سطر خالی انتهای فایل برای COPY یک ردیف ناقص است
+    data = data.rstrip(b"\r\n") + b"\n"
+    try:
+        first_line = data.split(b"\n", 1)[0].decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError("فایل باید UTF-8 باشد.")
+    header = [c.strip().lower() for c in next(csv.reader([first_line]), [])]
+    unknown = [c for c in header if c not in CATALOG_COLUMNS]
+    missing = [c for c in REQUIRED_COLUMNS if c not in header]
+    if unknown or missing or len(set(header)) != len(header):
+        raise ValueError(
+            "سطر عنوان نامعتبر است.\n"
+            f"ستون‌های مجاز: {', '.join(CATALOG_COLUMNS)}\n"
+            f"الزامی: {', '.join(REQUIRED_COLUMNS)}"
+        )
+    return io.BytesIO(data), header
+
+def _xlsx_to_csv(data: bytes) -> bytes:
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError("برای XLSX بسته‌ی openpyxl لازم است؛ فعلاً فایل CSV بفرستید.")
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for row in wb.active.iter_rows(values_only=True):
+        if any(v is not None for v in row):
+            writer.writerow(["" if v is None else v for v in row])
+    wb.close()
+    return out.getvalue().encode("utf-8")
+
+def export_file():
+    """فایل موقت (تا ۱ مگابایت در حافظه) با BOM تا Excel فارسی را درست نشان دهد."""
+    f = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    f.write(BOM)
+    return f
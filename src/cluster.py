@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""اجرای چند worker پشت یک وبهوک (WORKERS پردازه × INSTANCES ماشین).
+
+- قفل چت: آپدیت‌های یک چت پشت سر هم پردازش می‌شوند؛ در کل cluster با advisory lock
+  در Postgres؛ بعد از گرفتن قفل، وضعیت مکالمه و user_data از دیتابیس تازه و بعد
+  از پردازش فوراً نوشته می‌شود تا worker بعدی همان وضعیت را ببیند.
+- LISTEN/NOTIFY: باطل شدن کش‌ها و کار جدید (outbox، broadcast) به همه‌ی پردازه‌ها می‌رسد.
+- رهبر: فقط صاحب lease «leader» broadcast، outbox، تابلوی آشپزخانه و کارهای دوره‌ای را اجرا می‌کند.
+
+در حالت تک‌پردازه (CLUSTERED=False) همین پردازه همیشه رهبر است، LISTEN خاموش است و
+ترتیب چت فقط با قفل محلی حفظ می‌شود.
+"""
+import asyncio
+import os
+import socket
+
+from telegram.ext import Application, BaseUpdateProcessor
+
+from .base import log, CLUSTERED, LEADER_LEASE_TTL, CHAT_LOCK_TIMEOUT
+from . import adb, db, broadcast, jobs, kitchen, outbox
+
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE = "leader"
+
+_leader = False
+_tasks: list[asyncio.Task] = []
+
+def is_leader() -> bool:
+    return _leader
+
+# ---------- ترتیب و قفل چت ----------
+# سقف semaphore داخلی PTB (Application فقط «بیش از ۱» بودنش را نگاه می‌کند)؛
+# سقف واقعی در ChatLockProcessor._slots است
+_UNBOUNDED = 2 ** 31 - 1
+
+class ChatLockProcessor(BaseUpdateProcessor):
+    """update processor: آپدیت‌های یک چت به ترتیب رسیدن و یکی‌یکی پردازش می‌شوند
+    (چت‌های مختلف موازی)؛ در حالت cluster این ترتیب بین پردازه‌ها هم حفظ می‌شود."""
+
+    def __init__(self, max_concurrent_updates: int):
+        # semaphore خود PTB پیش از do_process_update گرفته می‌شود و process_update آن
+        # «final» است؛ پس آن را بی‌سقف می‌سازیم و سقف MAX_CONCURRENT_UPDATES را بعد از
+        # قفل چت با semaphore خودمان اعمال می‌کنیم. وگرنه رگبار tapهای یک چت همه‌ی جاها را
+        # با آپدیت‌هایی که فقط منتظر قفل همان چت‌اند پر می‌کند و چت‌های دیگر می‌مانند.
+        super().__init__(_UNBOUNDED)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.app: Application | None = None       # بعد از build در bot.main ست می‌شود
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiters: dict[int, int] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if CLUSTERED:
+            await adb.run(db.close_lock_connection)
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self._slots:
+                return await coroutine
+        chat_id = chat.id
+        # Application آپدیت‌ها را به ترتیب صف تحویل می‌دهد و asyncio.Lock به ترتیب
+        # درخواست (FIFO) واگذار می‌شود، پس دو tap پشت سر هم یک کاربر جابه‌جا نمی‌شوند.
+        # (قفل advisory هم در سطح session reentrant است و این قفل محلی را لازم دارد.)
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._waiters[chat_id] = self._waiters.get(chat_id, 0) + 1
+        try:
+            async with lock, self._slots:
+                await self._run_locked(update, coroutine)
+        finally:
+            self._waiters[chat_id] -= 1
+            if not self._waiters[chat_id]:
+                del self._waiters[chat_id]
+                self._locks.pop(chat_id, None)
+
+    async def _run_locked(self, update, coroutine):
+        # این‌جا قفل محلی چت و یک جای هم‌زمانی گرفته شده است
+        if not CLUSTERED:
+            return await coroutine
+        chat, user = update.effective_chat, update.effective_user
+        locked = await self._acquire(chat.id, user.id if user else None)
+        try:
+            await coroutine
+            if self.app.persistence:
+                # worker بعدی باید وضعیت همین آپدیت را ببیند؛ batching در این حالت ممکن نیست
+                await self.app.update_persistence()
+        finally:
+            if locked:
+                await adb.unlock_chat(chat.id)
+
+    async def _acquire(self, chat_id: int, user_id: int | None) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CHAT_LOCK_TIMEOUT
+        delay = 0.01
+        while True:
+            try:
+                locked, user_data, states = await adb.try_chat_lock(chat_id, user_id)
+            except Exception as e:
+                log.warning(f"chat lock {chat_id}: {e}; processing without lock")
+                return False
+            if locked:
+                if self.app.persistence:
+                    self.app.persistence.restore_chat(chat_id, user_id, user_data, states)
+                return True
+            if loop.time() >= deadline:
+                log.warning(f"chat lock {chat_id}: timed out after {CHAT_LOCK_TIMEOUT:.0f}s; processing without lock")
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+# ---------- رهبر ----------
+async def _elected(app: Application):
+    log.info(f"cluster: {HOLDER} is leader")
+    jobs.register(app)
+    outbox.start(app)
+    kitchen.start(app)
+    await broadcast.resume_all(app)
+
+async def _demoted(app: Application):
+    log.warning(f"cluster: {HOLDER} lost leadership")
+    jobs.unregister(app)
+    await outbox.stop()
+    await kitchen.stop()
+    # broadcastهای در حال اجرا بعد از دسته‌ی جاری با is_leader() متوقف می‌شوند
+
+async def _lease_loop(app: Application):
+    global _leader
+    while True:
+        try:
+            ok = await adb.acquire_lease(LEADER_LEASE, HOLDER, LEADER_LEASE_TTL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # بدون تمدید، lease منقضی و رهبر دیگری انتخاب می‌شود؛ پس این‌جا هم کنار می‌کشیم
+            log.warning(f"cluster: lease renewal failed: {e}")
+            ok = False
+        if ok and not _leader:
+            _leader = True
+            await _elected(app)
+        elif not ok and _leader:
+            _leader = False
+            await _demoted(app)
+        await asyncio.sleep(LEADER_LEASE_TTL / 3)
+
+# ---------- LISTEN/NOTIFY ----------
+def _dispatch(app: Application, payload: str):
+    kind, _, arg = payload.partition(":")
+    if kind == "catalog":
+        db.invalidate_catalog()
+    elif kind == "identities":
+        for tg_id in arg.split(","):
+            db.identities.discard(int(tg_id))
+    elif kind == "outbox":
+        outbox.wake()
+    elif kind == "kitchen":
+        kitchen.touch()
+    elif kind == "broadcast" and _leader:
+        app.create_task(broadcast.resume_all(app))
+
+async def _listen_loop(app: Application):
+    loop = asyncio.get_running_loop()
+    while True:
+        cn = None
+        try:
+            cn = await adb.run(db.listen_connection)
+            # NOTIFYهای زمان قطعی از دست رفته‌اند؛ کش را محض احتیاط باطل می‌کنیم
+            db.invalidate_catalog()
+            ready = asyncio.Event()
+            loop.add_reader(cn.fileno(), ready.set)
+            try:
+                while True:
+                    await ready.wait()
+                    ready.clear()
+                    cn.poll()
+                    while cn.notifies:
+                        _dispatch(app, cn.notifies.pop(0).payload)
+            finally:
+                loop.remove_reader(cn.fileno())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"cluster: LISTEN connection lost: {e}")
+            await asyncio.sleep(1)
+        finally:
+            if cn is not None:
+                cn.close()
+
+# ---------- چرخه‌ی عمر ----------
+async def start(app: Application):
+    global _leader
+    if not CLUSTERED:
+        _leader = True
+        await _elected(app)
+        return
+    if app.persistence:
+        # وضعیت هر چت از دیتابیس بازگردانده می‌شود؛ PTB ناسازگار همین‌جا خطا می‌دهد
+        app.persistence.bind(app)
+    _tasks.append(asyncio.create_task(_listen_loop(app), name="cluster:listen"))
+    _tasks.append(asyncio.create_task(_lease_loop(app), name="cluster:lease"))
+
+async def stop(app: Application):
+    global _leader
+    for t in _tasks:
+        t.cancel()
+    for t in _tasks:
+        try:
+            await t
+        except asyncio.CancelledError:
+            pass
+    _tasks.clear()
+    if _leader:
+        _leader = False
+        await outbox.stop()
+        await kitchen.stop()
+        if CLUSTERED:
+            try:
+                # رهبر بعدی بدون انتظار برای انقضای lease انتخاب شود
+                await adb.release_lease(LEADER_LEASE, HOLDER)
+            except Exception as e:
+                log.warning(f"cluster: lease release failed: {e}")
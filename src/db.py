@@ -1,14 +1,210 @@
 # -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 from psycopg2.extras import DictCursor
-from .base import log, DATABASE_URL
+from psycopg2.pool import ThreadedConnectionPool
+from .base import (
+    log, DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_HEALTHCHECK_IDLE,
+    CATALOG_CACHE_TTL, IDENTITY_CACHE_SIZE, DB_SLOW_QUERY_MS, CLUSTERED,
+    SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE,
+)
+from .cache import VersionedCache, IdentityMap
+from . import metrics
 import psycopg2.extras
 
-# ------------- connection helpers -------------
+# کش منو/محصولات؛ فقط با تغییر کاتالوگ (add_product / migration) باطل می‌شود
+catalog = VersionedCache("catalog", CATALOG_CACHE_TTL)
+# نتایج جستجوی محصول؛ همراه catalog باطل می‌شود
+search_cache = VersionedCache("search", SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE)
+# نگاشت telegram_id ⇄ user_id؛ write-through در upsert_user
+identities = IdentityMap(IDENTITY_CACHE_SIZE)
+
+@metrics.register_collector
+def _cache_metrics():
+    caches = [catalog.stats(), search_cache.stats(), identities.stats()]
+    for key, help_text in (("hits", "Cache hits"), ("misses", "Cache misses"), ("size", "Cached entries")):
+        name = f"crepebar_cache_{key}" + ("" if key == "size" else "_total")
+        mtype = "gauge" if key == "size" else "counter"
+        for c in caches:
+            yield name, mtype, help_text, {"cache": c["name"]}, c[key]
+
+# ------------- instrumentation -------------
+# شمارنده‌های تجمعی (برای benchmark): کانکشن فیزیکی، قرض از pool، کوئری
+counters = {"connects": 0, "borrows": 0, "queries": 0}
+_counters_lock = threading.Lock()
+
+def _count(key: str):
+    with _counters_lock:
+        counters[key] += 1
+
+def stats() -> dict:
+    with _counters_lock:
+        return dict(counters)
+
+def _sql_verb(query) -> str:
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    words = str(query).lstrip().split(None, 1)
+    return words[0].upper() if words else "?"
+
+def _on_query(query, seconds: float):
+    verb = _sql_verb(query)
+    metrics.DB_QUERY_SECONDS.observe((verb,), seconds)
+    if seconds * 1000 >= DB_SLOW_QUERY_MS:
+        metrics.DB_SLOW_QUERIES.inc((verb,))
+        text = " ".join(str(query).split())
+        log.warning(f"slow query {seconds*1000:.0f} ms: {text[:300]}")
+
+class _TimedCursorMixin:
+    def execute(self, query, vars=None):
+        _count("queries")
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _on_query(query, time.perf_counter() - t0)
+
+_cursor_classes: dict[type, type] = {}
+
+def _timed_cursor(factory: type) -> type:
+    cls = _cursor_classes.get(factory)
+    if cls is None:
+        cls = type(f"Timed{factory.__name__}", (_TimedCursorMixin, factory), {})
+        _cursor_classes[factory] = cls
+    return cls
+
+class _Connection(psycopg2.extensions.connection):
+    """هر cursor (با هر cursor_factory) کوئری‌هایش را می‌شمارد و زمان می‌گیرد."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # زمان برگشت به pool (health check کانکشن بیکار)؛ روی خود کانکشن تا با بسته شدنش برود
+        self.last_used: float | None = None
+        _count("connects")
+        metrics.DB_CONNECTIONS.inc()
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _timed_cursor(factory)
+        return super().cursor(*args, **kwargs)
+
+# ------------- connection pool -------------
+class _Pool(ThreadedConnectionPool):
+    """ThreadedConnectionPool که تا maxconn کانکشن بیکار نگه می‌دارد.
+
+    putconn در psycopg2 هر کانکشن بیش از minconn بیکار را می‌بندد؛ زیر بار هم‌زمان
+    یعنی اتصال (و TLS handshake) تازه برای بیشتر قرض‌ها. minconn فقط تعداد کانکشن‌های
+    اولیه است و بعد از ساخت، سقف نگه‌داری بیکار را maxconn می‌کنیم.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+_pool: _Pool | None = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool به‌جای صبر کردن خطا می‌دهد؛ با این سمافور منتظر می‌مانیم
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def _get_pool() -> _Pool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL env is missing.")
+                _pool = _Pool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL,
+                    connection_factory=_Connection,
+                    connect_timeout=10,
+                    # TCP keepalive تا Neon/NAT کانکشن بیکار را بی‌صدا نبندد
+                    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                )
+                log.info(f"db pool ready (min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return _pool
+
+def _discard(pool: ThreadedConnectionPool, cn):
+    try:
+        pool.putconn(cn, close=True)
+    except Exception as e:
+        log.warning(f"db pool discard failed: {e}")
+
+def _borrow():
+    """یک کانکشن سالم از pool؛ کانکشن‌های بیکارِ قدیمی قبل از تحویل چک می‌شوند."""
+    pool = _get_pool()
+    for _ in range(DB_POOL_MAX + 1):
+        cn = pool.getconn()
+        last = getattr(cn, "last_used", None)
+        if not cn.closed and (last is None or time.monotonic() - last < DB_POOL_HEALTHCHECK_IDLE):
+            return cn
+        try:
+            with cn.cursor() as cur:
+                cur.execute("SELECT 1")
+            cn.rollback()
+            return cn
+        except psycopg2.Error as e:
+            log.warning(f"db pool: dropping dead connection ({e.__class__.__name__})")
+            _discard(pool, cn)
+    # همه‌ی کانکشن‌های قبلی مرده بودند؛ یک کانکشن تازه
+    return pool.getconn()
+
+@contextmanager
 def _conn():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL env is missing.")
-    return psycopg2.connect(DATABASE_URL, connect_timeout=10)
+    """کانکشن قرضی از pool؛ در خروج commit (یا rollback در خطا) و برگرداندن به pool."""
+    with _pool_slots:
+        pool = _get_pool()
+        cn = _borrow()
+        _count("borrows")
+        broken = False
+        try:
+            yield cn
+            cn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # کانکشن خراب است: دور انداخته می‌شود و دفعه‌ی بعد کانکشن تازه ساخته می‌شود
+            broken = True
+            raise
+        except BaseException:
+            try:
+                cn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            if broken or cn.closed:
+                _discard(pool, cn)
+            else:
+                cn.last_used = time.monotonic()
+                pool.putconn(cn)
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def _dedicated_connection():
+    """کانکشن جدا از pool (autocommit) برای LISTEN و قفل‌های session-level."""
+    cn = psycopg2.connect(
+        DATABASE_URL, connection_factory=_Connection, connect_timeout=10,
+        keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+    )
+    cn.autocommit = True
+    return cn
+
+# کانال NOTIFY بین workerها؛ payload: catalog | outbox | broadcast | kitchen | identities:<tg_id,...>
+NOTIFY_CHANNEL = "crepebar"
+
+def _notify(cur, payload: str):
+    """NOTIFY در همان تراکنش (بعد از commit تحویل می‌شود)؛ تک‌پردازه‌ای لازم نیست."""
+    if CLUSTERED:
+        cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
 
 def _exec(sql_text: str, params=None):
     if not sql_text.strip():
@@ -60,6 +256,11 @@ CREATE TABLE IF NOT EXISTS products (
   is_active      BOOLEAN NOT NULL DEFAULT TRUE,
   created_at     TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
+-- صفحه‌بندی keyset محصولات هر دسته (index-only scan)
+CREATE INDEX IF NOT EXISTS ix_products_cat_page
+  ON products(category_id, product_id DESC)
+  INCLUDE (name, price, photo_file_id)
+  WHERE is_active = TRUE;
 
 -- orders / items
 CREATE TABLE IF NOT EXISTS orders (
@@ -82,6 +283,26 @@ CREATE TABLE IF NOT EXISTS order_items (
 );
 CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items(order_id);
 
+-- migration: یکتایی (order_id, product_id)؛ ردیف‌های تکراری قدیمی اول ادغام می‌شوند
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname='ux_order_items_order_product') THEN
+    DELETE FROM order_items WHERE qty <= 0;
+    UPDATE order_items oi
+       SET qty = d.qty
+      FROM (SELECT MIN(item_id) AS keep_id, SUM(qty) AS qty
+              FROM order_items
+             GROUP BY order_id, product_id
+            HAVING COUNT(*) > 1) d
+     WHERE oi.item_id = d.keep_id;
+    DELETE FROM order_items oi
+     USING order_items k
+     WHERE k.order_id = oi.order_id AND k.product_id = oi.product_id AND k.item_id < oi.item_id;
+    ALTER TABLE order_items
+      ADD CONSTRAINT ux_order_items_order_product UNIQUE (order_id, product_id);
+  END IF;
+END $$;
+
 -- total calc
 CREATE OR REPLACE FUNCTION fn_recalc_order_total(p_order_id BIGINT)
 RETURNS VOID AS $$
@@ -96,20 +317,76 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE FUNCTION trg_recalc_oi()
+-- جمع سفارش به‌صورت افزایشی: فقط qty*unit_price ردیف‌های تغییرکرده اضافه/کم می‌شود.
+-- تریگرها statement-level با transition table هستند، پس DELETE چندردیفی یک UPDATE است.
+CREATE OR REPLACE FUNCTION trg_oi_total_delta()
 RETURNS TRIGGER AS $$
-DECLARE v_order BIGINT;
 BEGIN
-  IF TG_OP='DELETE' THEN v_order:=OLD.order_id; ELSE v_order:=NEW.order_id; END IF;
-  PERFORM fn_recalc_order_total(v_order);
-  IF TG_OP='DELETE' THEN RETURN OLD; ELSE RETURN NEW; END IF;
+  IF TG_OP='INSERT' THEN
+    UPDATE orders o SET total_amount = o.total_amount + d.delta
+      FROM (SELECT order_id, SUM(qty*unit_price) AS delta FROM oi_new GROUP BY order_id) d
+     WHERE o.order_id = d.order_id;
+  ELSIF TG_OP='DELETE' THEN
+    UPDATE orders o SET total_amount = o.total_amount - d.delta
+      FROM (SELECT order_id, SUM(qty*unit_price) AS delta FROM oi_old GROUP BY order_id) d
+     WHERE o.order_id = d.order_id;
+  ELSE
+    UPDATE orders o SET total_amount = o.total_amount + d.delta
+      FROM (SELECT order_id, SUM(v) AS delta
+              FROM (SELECT order_id, qty*unit_price AS v FROM oi_new
+                    UNION ALL
+                    SELECT order_id, -(qty*unit_price) FROM oi_old) x
+             GROUP BY order_id) d
+     WHERE o.order_id = d.order_id AND d.delta <> 0;
+  END IF;
+  RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
 DROP TRIGGER IF EXISTS trg_recalc_after_change ON order_items;
-CREATE TRIGGER trg_recalc_after_change
-AFTER INSERT OR UPDATE OR DELETE ON order_items
-FOR EACH ROW EXECUTE FUNCTION trg_recalc_oi();
+DROP FUNCTION IF EXISTS trg_recalc_oi();
+
+DROP TRIGGER IF EXISTS trg_oi_total_ins ON order_items;
+CREATE TRIGGER trg_oi_total_ins
+AFTER INSERT ON order_items
+REFERENCING NEW TABLE AS oi_new
+FOR EACH STATEMENT EXECUTE FUNCTION trg_oi_total_delta();
+
+DROP TRIGGER IF EXISTS trg_oi_total_upd ON order_items;
+CREATE TRIGGER trg_oi_total_upd
+AFTER UPDATE ON order_items
+REFERENCING OLD TABLE AS oi_old NEW TABLE AS oi_new
+FOR EACH STATEMENT EXECUTE FUNCTION trg_oi_total_delta();
+
+DROP TRIGGER IF EXISTS trg_oi_total_del ON order_items;
+CREATE TRIGGER trg_oi_total_del
+AFTER DELETE ON order_items
+REFERENCING OLD TABLE AS oi_old
+FOR EACH STATEMENT EXECUTE FUNCTION trg_oi_total_delta();
+
+-- افزودن به سبد در یک رفت‌وبرگشت: باز کردن draft + upsert ردیف + جمع جدید
+-- NULL یعنی کاربر یا محصول (فعال) پیدا نشد
+CREATE OR REPLACE FUNCTION fn_cart_add(p_tg_id BIGINT, p_product_id BIGINT, p_inc INTEGER)
+RETURNS NUMERIC AS $$
+DECLARE v_user BIGINT; v_price NUMERIC; v_order BIGINT; v_total NUMERIC;
+BEGIN
+  -- قفل ردیف کاربر تا دو تپ هم‌زمان دو draft نسازند
+  SELECT user_id INTO v_user FROM users WHERE telegram_id=p_tg_id FOR NO KEY UPDATE;
+  SELECT price INTO v_price FROM products WHERE product_id=p_product_id AND is_active=TRUE;
+  IF v_user IS NULL OR v_price IS NULL THEN RETURN NULL; END IF;
+  SELECT order_id INTO v_order FROM orders
+   WHERE user_id=v_user AND status='draft' ORDER BY order_id LIMIT 1;
+  IF v_order IS NULL THEN
+    INSERT INTO orders(user_id,status) VALUES(v_user,'draft') RETURNING order_id INTO v_order;
+  END IF;
+  INSERT INTO order_items(order_id,product_id,qty,unit_price)
+  VALUES(v_order,p_product_id,p_inc,v_price)
+  ON CONFLICT (order_id,product_id)
+  DO UPDATE SET qty=order_items.qty+EXCLUDED.qty, unit_price=EXCLUDED.unit_price;
+  SELECT total_amount INTO v_total FROM orders WHERE order_id=v_order;
+  RETURN v_total;
+END;
+$$ LANGUAGE plpgsql;
 
 -- wallet
 CREATE TABLE IF NOT EXISTS wallet_transactions (
@@ -170,45 +447,438 @@ CREATE TABLE IF NOT EXISTS topup_requests (
   order_id     BIGINT, -- اگر مربوط به پرداخت سفارش باشد
   created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
+
+-- broadcasts (پیام همگانی ادمین؛ پیشرفت برای ادامه پس از ری‌استارت ذخیره می‌شود)
+CREATE TABLE IF NOT EXISTS broadcasts (
+  broadcast_id  BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  admin_tg_id   BIGINT NOT NULL,
+  from_chat_id  BIGINT,          -- copy_message از این پیام
+  message_id    BIGINT,
+  text          TEXT,            -- یا متن ساده
+  status        TEXT NOT NULL DEFAULT 'running', -- running | done | cancelled
+  last_user_id  BIGINT NOT NULL DEFAULT 0,       -- checkpoint
+  sent          INTEGER NOT NULL DEFAULT 0,
+  failed        INTEGER NOT NULL DEFAULT 0,
+  blocked       INTEGER NOT NULL DEFAULT 0,
+  created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  finished_at   TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS ix_users_active ON users(user_id) WHERE active = TRUE;
+"""
+
+# seed دسته‌ها در یک INSERT چندردیفی
+SEED_CATEGORIES_SQL = r"""
+INSERT INTO categories(slug,title,sort_order,is_active) VALUES
+  ('espresso', 'اسپرسو بار گرم و سرد', 100, TRUE),
+  ('tea',      'چای و دمنوش',          110, TRUE),
+  ('mixhot',   'ترکیبی گرم',           120, TRUE),
+  ('mocktail', 'موکتل ها',             130, TRUE),
+  ('sky',      'اسمونی ها',            140, TRUE),
+  ('cool',     'خنک',                  150, TRUE),
+  ('semi',     'دمی',                  160, TRUE),
+  ('crepe',    'کرپ',                  170, TRUE),
+  ('pancake',  'پنکیک',                180, TRUE),
+  ('diet',     'رژیمی ها',             190, TRUE),
+  ('matcha',   'ماچا بار',             200, TRUE)
+ON CONFLICT (slug) DO UPDATE
+SET title=EXCLUDED.title, sort_order=EXCLUDED.sort_order, is_active=TRUE;
+"""
+
+WALLET_CHECKOUT_SQL = r"""
+-- کش‌بک در BEFORE UPDATE تا NEW.cashback_amount واقعاً روی ردیف سفارش ذخیره شود
+DROP TRIGGER IF EXISTS trg_apply_cashback ON orders;
+CREATE TRIGGER trg_apply_cashback
+BEFORE UPDATE OF status ON orders
+FOR EACH ROW EXECUTE FUNCTION fn_apply_cashback();
+
+-- پرداخت سفارش از کیف پول در یک تراکنش: قفل کاربر، چک موجودی، کسر، paid (کش‌بک)
+-- o_status: paid | insufficient | not_payable | empty | no_user
+CREATE OR REPLACE FUNCTION fn_wallet_checkout(p_order_id BIGINT, p_tg_id BIGINT)
+RETURNS TABLE(o_status TEXT, o_total NUMERIC, o_balance NUMERIC, o_cashback NUMERIC) AS $$
+DECLARE v_user BIGINT; v_balance NUMERIC; v_status TEXT; v_total NUMERIC; v_cashback NUMERIC;
+BEGIN
+  SELECT u.user_id, u.balance INTO v_user, v_balance
+    FROM users u WHERE u.telegram_id=p_tg_id FOR NO KEY UPDATE;
+  IF v_user IS NULL THEN
+    RETURN QUERY SELECT 'no_user'::TEXT, 0::NUMERIC, 0::NUMERIC, 0::NUMERIC; RETURN;
+  END IF;
+  SELECT o.status, o.total_amount INTO v_status, v_total
+    FROM orders o WHERE o.order_id=p_order_id AND o.user_id=v_user FOR UPDATE;
+  IF v_status IS NULL OR v_status NOT IN ('draft','submitted') THEN
+    RETURN QUERY SELECT 'not_payable'::TEXT, COALESCE(v_total,0), v_balance, 0::NUMERIC; RETURN;
+  END IF;
+  IF v_total <= 0 THEN
+    RETURN QUERY SELECT 'empty'::TEXT, v_total, v_balance, 0::NUMERIC; RETURN;
+  END IF;
+  IF v_balance < v_total THEN
+    RETURN QUERY SELECT 'insufficient'::TEXT, v_total, v_balance, 0::NUMERIC; RETURN;
+  END IF;
+  INSERT INTO wallet_transactions(user_id,kind,amount,meta)
+  VALUES(v_user,'order',-v_total,jsonb_build_object('order_id',p_order_id));
+  UPDATE orders o SET status='paid' WHERE o.order_id=p_order_id
+  RETURNING o.cashback_amount INTO v_cashback;
+  SELECT u.balance INTO v_balance FROM users u WHERE u.user_id=v_user;
+  RETURN QUERY SELECT 'paid'::TEXT, v_total, v_balance, COALESCE(v_cashback,0);
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+WALLET_LEDGER_SQL = r"""
+-- صورت‌حساب keyset (جدیدترین اول) و جمع تراکنش‌های بعد از checkpoint
+CREATE INDEX IF NOT EXISTS ix_wallet_tx_user_created
+  ON wallet_transactions(user_id, created_at DESC, tx_id DESC);
+CREATE INDEX IF NOT EXISTS ix_wallet_tx_user_txid ON wallet_transactions(user_id, tx_id);
+DROP INDEX IF EXISTS ix_wallet_tx_user;
+
+-- آخرین checkpoint موجودی هر کاربر: جمع دفتر تا tx_id
+CREATE TABLE IF NOT EXISTS wallet_checkpoints (
+  user_id     BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+  tx_id       BIGINT NOT NULL,
+  balance     NUMERIC NOT NULL,
+  created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
 """
 
+OUTBOX_SQL = r"""
+-- پیام‌های تلگرامی که همراه تغییر وضعیت (در همان تراکنش) ثبت و بعداً ارسال می‌شوند
+CREATE TABLE IF NOT EXISTS outbox (
+  outbox_id       BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+  chat_id         BIGINT NOT NULL,
+  method          TEXT NOT NULL,            -- send_message | send_photo
+  payload         JSONB NOT NULL,           -- kwargs متد (بدون chat_id)
+  status          TEXT NOT NULL DEFAULT 'pending', -- pending | sent | dead
+  attempts        INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  last_error      TEXT,
+  created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  sent_at         TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox(next_attempt_at) WHERE status='pending';
+"""
+
+PERSISTENCE_SQL = r"""
+-- وضعیت ConversationHandlerها و user_data ربات (PostgresPersistence)
+CREATE TABLE IF NOT EXISTS ptb_user_data (
+  user_id    BIGINT PRIMARY KEY,            -- telegram user id
+  data       JSONB NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS ptb_conversations (
+  name       TEXT NOT NULL,                 -- ConversationHandler.name
+  key        TEXT NOT NULL,                 -- کلید مکالمه به‌صورت JSON، مثل [chat_id, user_id]
+  state      JSONB NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (name, key)
+);
+"""
+
+CLUSTER_SQL = r"""
+-- lease رهبر بین workerها؛ فقط holder فعلی یا بعد از انقضا قابل گرفتن است
+CREATE TABLE IF NOT EXISTS leases (
+  name       TEXT PRIMARY KEY,
+  holder     TEXT NOT NULL,
+  expires_at TIMESTAMPTZ NOT NULL
+);
+"""
+
+DEDUP_SQL = r"""
+-- update_idهای دریافت‌شده؛ redelivery تلگرام بین همه‌ی workerها حذف می‌شود
+CREATE TABLE IF NOT EXISTS processed_updates (
+  update_id   BIGINT PRIMARY KEY,
+  received_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS ix_processed_updates_received ON processed_updates(received_at);
+"""
+
+SEARCH_SQL = r"""
+-- جستجوی محصول روی نام + توضیحات (trigram؛ هم word_similarity و هم ILIKE از این index استفاده می‌کنند)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_products_search_trgm
+    ON products USING gin ((name || ' ' || COALESCE(description, '')) gin_trgm_ops)
+ WHERE is_active;
+"""
+
+CATALOG_IMPORT_SQL = r"""
+-- upsert دسته‌ای کاتالوگ با کلید (دسته، نام)
+CREATE INDEX IF NOT EXISTS ix_products_cat_name ON products(category_id, name);
+"""
+
+# روز گزارش‌ها به وقت ایران (همان ثابت در fn_rollup_paid_order)
+REPORT_TZ = "Asia/Tehran"
+
+ANALYTICS_SQL = r"""
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS paid_at TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS ix_orders_status_created ON orders(status, created_at);
+
+-- rollup روزانه؛ فقط هنگام رسیدن سفارش به paid افزایشی به‌روز می‌شود
+CREATE TABLE IF NOT EXISTS sales_daily (
+  day      DATE PRIMARY KEY,
+  orders   INTEGER NOT NULL DEFAULT 0,
+  revenue  NUMERIC NOT NULL DEFAULT 0,
+  cashback NUMERIC NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sales_daily_product (
+  day         DATE NOT NULL,
+  product_id  BIGINT NOT NULL,
+  category_id BIGINT NOT NULL,
+  qty         BIGINT NOT NULL DEFAULT 0,
+  revenue     NUMERIC NOT NULL DEFAULT 0,
+  cashback    NUMERIC NOT NULL DEFAULT 0,  -- سهم محصول از کش‌بک سفارش (نسبت به مبلغ)
+  PRIMARY KEY (day, product_id)
+);
+
+CREATE OR REPLACE FUNCTION fn_orders_paid_at()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.paid_at := COALESCE(NEW.paid_at, NOW());
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_orders_paid_at ON orders;
+CREATE TRIGGER trg_orders_paid_at
+BEFORE UPDATE OF status ON orders
+FOR EACH ROW WHEN (NEW.status = 'paid' AND OLD.status IS DISTINCT FROM 'paid')
+EXECUTE FUNCTION fn_orders_paid_at();
+
+CREATE OR REPLACE FUNCTION fn_rollup_paid_order()
+RETURNS TRIGGER AS $$
+DECLARE d DATE := timezone('Asia/Tehran', NEW.paid_at)::date;
+BEGIN
+  INSERT INTO sales_daily_product AS r (day, product_id, category_id, qty, revenue, cashback)
+  SELECT d, oi.product_id, p.category_id, SUM(oi.qty), SUM(oi.qty * oi.unit_price),
+         COALESCE(ROUND(SUM(oi.qty * oi.unit_price) * NEW.cashback_amount / NULLIF(NEW.total_amount, 0), 2), 0)
+    FROM order_items oi JOIN products p ON p.product_id = oi.product_id
+   WHERE oi.order_id = NEW.order_id
+   GROUP BY oi.product_id, p.category_id
+  ON CONFLICT (day, product_id) DO UPDATE
+     SET qty = r.qty + EXCLUDED.qty, revenue = r.revenue + EXCLUDED.revenue, cashback = r.cashback + EXCLUDED.cashback;
+
+  INSERT INTO sales_daily AS r (day, orders, revenue, cashback)
+  VALUES (d, 1, NEW.total_amount, NEW.cashback_amount)
+  ON CONFLICT (day) DO UPDATE
+     SET orders = r.orders + 1, revenue = r.revenue + EXCLUDED.revenue, cashback = r.cashback + EXCLUDED.cashback;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- WHEN بدون صدا زدن تابع فیلتر می‌کند؛ به‌روزرسانی‌های جمع سفارش هزینه‌ای ندارند
+DROP TRIGGER IF EXISTS trg_rollup_paid_order ON orders;
+CREATE TRIGGER trg_rollup_paid_order
+AFTER UPDATE OF status ON orders
+FOR EACH ROW WHEN (NEW.status = 'paid' AND OLD.status IS DISTINCT FROM 'paid')
+EXECUTE FUNCTION fn_rollup_paid_order();
+
+-- پر کردن rollup از سفارش‌های paid قبلی (زمان پرداخت ثبت نشده بود → created_at)
+UPDATE orders SET paid_at = created_at WHERE status = 'paid' AND paid_at IS NULL;
+-- کش‌بک قدیمی در orders.cashback_amount ذخیره نشده است (تریگر AFTER بود)؛ مبلغ واقعی در دفتر کیف پول است
+CREATE TEMP TABLE backfill_paid ON COMMIT DROP AS
+SELECT o.order_id, timezone('Asia/Tehran', o.paid_at)::date AS day, o.total_amount,
+       COALESCE(cb.amount, 0) AS cashback
+  FROM orders o
+  LEFT JOIN (SELECT (meta->>'order_id')::bigint AS order_id, SUM(amount) AS amount
+               FROM wallet_transactions
+              WHERE kind = 'cashback' AND meta ? 'order_id'
+              GROUP BY 1) cb ON cb.order_id = o.order_id
+ WHERE o.status = 'paid';
+INSERT INTO sales_daily_product (day, product_id, category_id, qty, revenue, cashback)
+SELECT b.day, oi.product_id, p.category_id,
+       SUM(oi.qty), SUM(oi.qty * oi.unit_price),
+       COALESCE(ROUND(SUM(oi.qty * oi.unit_price * b.cashback / NULLIF(b.total_amount, 0)), 2), 0)
+  FROM backfill_paid b
+  JOIN order_items oi ON oi.order_id = b.order_id
+  JOIN products p ON p.product_id = oi.product_id
+ GROUP BY b.day, oi.product_id, p.category_id
+ON CONFLICT (day, product_id) DO NOTHING;
+INSERT INTO sales_daily (day, orders, revenue, cashback)
+SELECT day, COUNT(*), SUM(total_amount), SUM(cashback)
+  FROM backfill_paid
+ GROUP BY day
+ON CONFLICT (day) DO NOTHING;
+"""
+
+JANITOR_SQL = r"""
+-- پیدا کردن سبد باز کاربر (open_draft_order، fn_cart_add) با index-only scan روی ردیف‌های draft
+CREATE INDEX IF NOT EXISTS ix_orders_user_draft ON orders(user_id, order_id) WHERE status = 'draft';
+-- آخرین فعالیت سبد؛ ایندکس نمی‌شود تا به‌روزرسانی‌های جمع سبد HOT بمانند
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+CREATE OR REPLACE FUNCTION fn_orders_touch()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.updated_at := NOW();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_orders_touch ON orders;
+CREATE TRIGGER trg_orders_touch
+BEFORE UPDATE ON orders
+FOR EACH ROW WHEN (NEW.status = 'draft')
+EXECUTE FUNCTION fn_orders_touch();
+
+CREATE INDEX IF NOT EXISTS ix_topup_requests_pending ON topup_requests(created_at) WHERE status = 'pending';
+
+-- بایگانی سفارش‌های قدیمی؛ پارتیشن ماهانه (UTC) روی created_at که هنگام انتقال ساخته می‌شود
+CREATE TABLE IF NOT EXISTS orders_history (
+  order_id        BIGINT NOT NULL,
+  user_id         BIGINT NOT NULL,
+  status          TEXT NOT NULL,
+  total_amount    NUMERIC NOT NULL,
+  cashback_amount NUMERIC NOT NULL,
+  shipping_method TEXT,
+  payment_method  TEXT,
+  created_at      TIMESTAMPTZ NOT NULL,
+  paid_at         TIMESTAMPTZ,
+  items           JSONB NOT NULL DEFAULT '[]',  -- [{product_id, qty, unit_price}]
+  archived_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (order_id, created_at)
+) PARTITION BY RANGE (created_at);
+CREATE INDEX IF NOT EXISTS ix_orders_history_user ON orders_history(user_id, created_at);
+
+CREATE OR REPLACE FUNCTION fn_orders_history_partition(p_at TIMESTAMPTZ)
+RETURNS VOID AS $$
+DECLARE m TIMESTAMP := date_trunc('month', p_at AT TIME ZONE 'UTC');
+BEGIN
+  EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF orders_history FOR VALUES FROM (%L) TO (%L)',
+                 'orders_history_' || to_char(m, 'YYYY_MM'),
+                 m AT TIME ZONE 'UTC', (m + interval '1 month') AT TIME ZONE 'UTC');
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+KITCHEN_SQL = r"""
+-- صف آشپزخانه: paid → preparing → ready → delivered
+CREATE INDEX IF NOT EXISTS ix_orders_kitchen ON orders(paid_at, order_id)
+ WHERE status IN ('paid', 'preparing', 'ready');
+-- پیام‌های پین‌شده‌ی تابلوی سفارش‌ها (هر چت ادمین/گروه یک پیام)
+CREATE TABLE IF NOT EXISTS kitchen_boards (
+  chat_id    BIGINT PRIMARY KEY,
+  message_id BIGINT NOT NULL
+);
+"""
+
+# ------------- MIGRATIONS -------------
+# (version, name, sql) به ترتیب؛ هر نسخه فقط یک بار اجرا و در schema_migrations ثبت می‌شود.
+# نسخه‌ی ۱ همان SCHEMA_SQL قدیمی است (idempotent) تا دیتابیس‌های موجود هم بی‌خطر به‌روز شوند.
+# تغییرات بعدی schema را به‌صورت نسخه‌ی جدید به انتهای این لیست اضافه کنید.
+MIGRATIONS = [
+    (1, "baseline schema", SCHEMA_SQL),
+    (2, "seed categories", SEED_CATEGORIES_SQL),
+    (3, "wallet checkout", WALLET_CHECKOUT_SQL),
+    (4, "wallet ledger checkpoints", WALLET_LEDGER_SQL),
+    (5, "outbox", OUTBOX_SQL),
+    (6, "bot persistence", PERSISTENCE_SQL),
+    (7, "cluster leases", CLUSTER_SQL),
+    (8, "processed updates", DEDUP_SQL),
+    (9, "product search", SEARCH_SQL),
+    (10, "catalog import", CATALOG_IMPORT_SQL),
+    (11, "sales rollups", ANALYTICS_SQL),
+    (12, "janitor", JANITOR_SQL),
+    (13, "kitchen queue", KITCHEN_SQL),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _schema_version() -> int:
+    with _conn() as cn, cn.cursor() as cur:
+        try:
+            cur.execute("SELECT COALESCE(MAX(version),0) FROM schema_migrations")
+            return cur.fetchone()[0]
+        except psycopg2.errors.UndefinedTable:
+            cn.rollback()
+            return 0
+
+def _migrate() -> list[int]:
+    applied = []
+    with _conn() as cn, cn.cursor() as cur:
+        # اگر چند instance هم‌زمان بالا بیایند فقط یکی migrate می‌کند؛ بقیه منتظر می‌مانند
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('crepebar:migrate'))")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+              version    INTEGER PRIMARY KEY,
+              name       TEXT NOT NULL,
+              applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("SELECT COALESCE(MAX(version),0) FROM schema_migrations")
+        current = cur.fetchone()[0]
+        for version, name, sql_text in MIGRATIONS:
+            if version <= current:
+                continue
+            t0 = time.perf_counter()
+            cur.execute(sql_text)
+            cur.execute("INSERT INTO schema_migrations(version,name) VALUES(%s,%s)", (version, name))
+            log.info(f"migration {version} ({name}) applied in {(time.perf_counter()-t0)*1000:.0f} ms")
+            applied.append(version)
+    return applied
+
 def init_db():
-    log.info("init_db() running...")
-    _exec(SCHEMA_SQL)
-    # seed categories
-    seed = [
-        ("espresso", "اسپرسو بار گرم و سرد", 100),
-        ("tea", "چای و دمنوش", 110),
-        ("mixhot", "ترکیبی گرم", 120),
-        ("mocktail", "موکتل ها", 130),
-        ("sky", "اسمونی ها", 140),
-        ("cool", "خنک", 150),
-        ("semi", "دمی", 160),
-        ("crepe", "کرپ", 170),
-        ("pancake", "پنکیک", 180),
-        ("diet", "رژیمی ها", 190),
-        ("matcha", "ماچا بار", 200),
-    ]
-    with _conn() as cn, cn.cursor() as cur:
-        for slug, title, sort in seed:
-            cur.execute("""
-                INSERT INTO categories(slug,title,sort_order,is_active)
-                VALUES(%s,%s,%s,TRUE)
-                ON CONFLICT (slug) DO UPDATE
-                SET title=EXCLUDED.title, sort_order=EXCLUDED.sort_order, is_active=TRUE
-            """, (slug, title, sort))
-    log.info("init_db() done.")
+    t0 = time.perf_counter()
+    applied = []
+    if _schema_version() < SCHEMA_VERSION:
+        applied = _migrate()
+    if applied:
+        invalidate_catalog()
+    log.info(
+        f"init_db(): schema v{SCHEMA_VERSION} "
+        f"({'applied ' + ','.join(map(str, applied)) if applied else 'up to date'}) "
+        f"in {(time.perf_counter()-t0)*1000:.0f} ms"
+    )
 
 # ------------- Domain queries -------------
 
+def _enqueue(cur, notices):
+    """ثبت پیام‌ها در outbox با همان cursor (یعنی در همان تراکنش).
+
+    notices: لیست dict با chat_id، method و payload (ساخته‌شده با outbox.message/photo).
+    """
+    if not notices:
+        return
+    psycopg2.extras.execute_values(
+        cur, "INSERT INTO outbox(chat_id,method,payload) VALUES %s",
+        [(n["chat_id"], n["method"], psycopg2.extras.Json(n["payload"])) for n in notices],
+    )
+    _notify(cur, "outbox")
+
 # Users
-def upsert_user(tg_id: int, name: str):
-    with _conn() as cn, cn.cursor() as cur:
+def upsert_user(tg_id: int, name: str) -> int:
+    cached = identities.get_by_tg(tg_id)
+    if cached is not None and cached["name"] == name:
+        return cached["id"]
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute("""
             INSERT INTO users(telegram_id, name)
             VALUES (%s,%s)
-            ON CONFLICT (telegram_id) DO UPDATE SET name=EXCLUDED.name
+            ON CONFLICT (telegram_id) DO UPDATE SET name=EXCLUDED.name, active=TRUE
+            RETURNING user_id AS id, telegram_id, name
         """, (tg_id, name))
+        user = dict(cur.fetchone())
+    identities.put(user)
+    return user["id"]
+
+def _peek_upsert_user(tg_id: int, name: str):
+    hit, u = identities.peek_tg(tg_id)
+    if hit and u["name"] == name:
+        return True, u["id"]
+    return False, None
+
+upsert_user.peek = _peek_upsert_user
+
+def resolve_user(tg_id: int):
+    """{"id", "telegram_id", "name"} کاربر تلگرام (از کش در صورت امکان) یا None."""
+    cached = identities.get_by_tg(tg_id)
+    if cached is not None:
+        return cached
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT user_id AS id, telegram_id, name FROM users WHERE telegram_id=%s", (tg_id,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    user = dict(row)
+    identities.put(user)
+    return user
+
+resolve_user.peek = identities.peek_tg
 
 def get_user_by_tg(tg_id: int):
     with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
@@ -216,11 +886,16 @@ def get_user_by_tg(tg_id: int):
         return cur.fetchone()
 
 def get_user_tg_by_id(user_id: int) -> int:
+    tg_id = identities.get_tg(user_id)
+    if tg_id is not None:
+        return tg_id
     with _conn() as cn, cn.cursor() as cur:
         cur.execute("SELECT telegram_id FROM users WHERE user_id=%s", (user_id,))
         r = cur.fetchone()
         return r[0] if r else None
 
+get_user_tg_by_id.peek = identities.peek_user
+
 def get_balance(user_id: int) -> float:
     with _conn() as cn, cn.cursor() as cur:
         cur.execute("SELECT balance FROM users WHERE user_id=%s", (user_id,))
@@ -228,24 +903,92 @@ def get_balance(user_id: int) -> float:
         return float(row[0] or 0)
 
 # Categories / Products
+@catalog.memoize
 def list_categories():
     with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute("""SELECT category_id AS id, slug, title FROM categories WHERE is_active=TRUE ORDER BY sort_order, category_id""")
         return cur.fetchall()
 
-def list_products_by_category(cat_id: int, page: int=1, page_size: int=6):
-    off = (page-1)*page_size
+@catalog.memoize
+def list_products_by_category(cat_id: int, after_id: int|None=None, before_id: int|None=None, page_size: int=6):
+    """صفحه‌بندی keyset (جدیدترین اول) بدون COUNT و OFFSET.
+
+    after_id: صفحه‌ی بعد از این product_id؛ before_id: صفحه‌ی قبل از آن.
+    خروجی (items, has_more)؛ has_more یعنی در همان جهت حرکت صفحه‌ی دیگری هست
+    (با خواندن page_size+1 ردیف تشخیص داده می‌شود).
+    """
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        if before_id is not None:
+            cur.execute("""
+                SELECT product_id AS id, name, price, photo_file_id
+                  FROM products
+                 WHERE is_active=TRUE AND category_id=%s AND product_id > %s
+                 ORDER BY product_id ASC
+                 LIMIT %s
+            """, (cat_id, before_id, page_size + 1))
+            rows = cur.fetchall()
+            return list(reversed(rows[:page_size])), len(rows) > page_size
+        if after_id is not None:
+            cur.execute("""
+                SELECT product_id AS id, name, price, photo_file_id
+                  FROM products
+                 WHERE is_active=TRUE AND category_id=%s AND product_id < %s
+                 ORDER BY product_id DESC
+                 LIMIT %s
+            """, (cat_id, after_id, page_size + 1))
+        else:
+            cur.execute("""
+                SELECT product_id AS id, name, price, photo_file_id
+                  FROM products
+                 WHERE is_active=TRUE AND category_id=%s
+                 ORDER BY product_id DESC
+                 LIMIT %s
+            """, (cat_id, page_size + 1))
+        rows = cur.fetchall()
+        return rows[:page_size], len(rows) > page_size
+
+@catalog.memoize
+def get_category_cover(cat_id: int):
+    """file_id عکس جدیدترین محصول دسته (برای صفحه‌هایی که خودشان عکس ندارند)."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""
+            SELECT photo_file_id FROM products
+             WHERE is_active=TRUE AND category_id=%s AND photo_file_id IS NOT NULL
+             ORDER BY product_id DESC
+             LIMIT 1
+        """, (cat_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+def invalidate_catalog():
+    """کش‌های وابسته به کاتالوگ (منو، صفحه‌ها، جستجو) در این پردازه."""
+    catalog.invalidate()
+    search_cache.invalidate()
+
+@search_cache.memoize
+def search_products(query: str, limit: int=20):
+    """جستجوی رتبه‌بندی‌شده در نام/توضیحات محصولات فعال.
+
+    تطابق زیررشته (ILIKE) اول، بعد شباهت کلمه‌ای trigram (غلط تایپی/ترتیب کلمات).
+    query باید از قبل نرمال شده باشد (حروف کوچک، فاصله‌ی یکتا) تا کلید کش یکسان بماند.
+    کمتر از ۳ حرف از ix_products_search_trgm استفاده نمی‌کند و نتیجه‌ای ندارد.
+    """
+    if len(query) < 3:
+        return []
+    like = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
     with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("SELECT COUNT(*) FROM products WHERE is_active=TRUE AND category_id=%s", (cat_id,))
-        total = cur.fetchone()[0]
         cur.execute("""
             SELECT product_id AS id, name, price, description, photo_file_id
               FROM products
-             WHERE is_active=TRUE AND category_id=%s
-             ORDER BY product_id DESC
-             LIMIT %s OFFSET %s
-        """, (cat_id, page_size, off))
-        return cur.fetchall(), total
+             WHERE is_active
+               AND ((name || ' ' || COALESCE(description, '')) ILIKE %(like)s
+                    OR %(q)s <%% (name || ' ' || COALESCE(description, '')))
+             ORDER BY name ILIKE %(like)s DESC,
+                      word_similarity(%(q)s, name || ' ' || COALESCE(description, '')) DESC,
+                      product_id DESC
+             LIMIT %(limit)s
+        """, {"q": query, "like": like, "limit": limit})
+        return cur.fetchall()
 
 def get_product(pid: int):
     with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
@@ -259,7 +1002,107 @@ def add_product(cat_id: int, name: str, price: float, description: str|None, pho
             VALUES(%s,%s,%s,%s,%s,TRUE)
             RETURNING product_id
         """, (cat_id, name, price, description, photo_file_id))
-        return cur.fetchone()[0]
+        pid = cur.fetchone()[0]
+        _notify(cur, "catalog")
+    invalidate_catalog()
+    return pid
+
+# Catalog import/export (COPY)
+CATALOG_COLUMNS = ("category", "name", "price", "description", "photo_file_id", "is_active")
+
+def import_catalog(csv_file, columns: list[str]):
+    """بارگذاری دسته‌ای محصولات از CSV (با سطر عنوان) در یک تراکنش.
+
+    فایل با COPY در جدول موقت ریخته می‌شود، خطای هر سطر به‌صورت set-based مشخص
+    و سطرهای سالم با کلید (slug دسته، نام) upsert می‌شوند.
+    columns: ستون‌های فایل به ترتیب (زیرمجموعه‌ی CATALOG_COLUMNS)؛ محصول موجود فقط در
+    همین ستون‌ها به‌روز می‌شود.
+    خروجی (inserted, updated, errors) با errors = [(شماره‌ی سطر فایل، خطا)].
+    """
+    with _conn() as cn, cn.cursor() as cur:
+        # دو import هم‌زمان یک محصول را دو بار درج نکنند
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('crepebar:catalog-import'))")
+        cur.execute("""
+            CREATE TEMP TABLE import_staging (
+              line_no       BIGINT GENERATED ALWAYS AS IDENTITY (START 2),  -- سطر ۱ عنوان است
+              category      TEXT, name TEXT, price TEXT, description TEXT,
+              photo_file_id TEXT, is_active TEXT,
+              cat_id BIGINT, price_num NUMERIC, active BOOLEAN, error TEXT
+            ) ON COMMIT DROP
+        """)
+        cur.copy_expert(
+            f"COPY import_staging({','.join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')",
+            csv_file,
+        )
+        # نرمال‌سازی (ارقام فارسی، جداکننده‌ی هزارگان) و اعتبارسنجی همه‌ی سطرها با یک UPDATE
+        cur.execute(r"""
+            UPDATE import_staging s
+               SET name = btrim(s.name),
+                   cat_id = (SELECT c.category_id FROM categories c WHERE c.slug = btrim(s.category)),
+                   price_num = CASE WHEN n.price ~ '^\d+(\.\d+)?$' THEN n.price::numeric END,
+                   active = CASE WHEN lower(btrim(COALESCE(s.is_active, ''))) IN ('', '1', 'true', 'yes', 't', 'y') THEN TRUE
+                                 WHEN lower(btrim(s.is_active)) IN ('0', 'false', 'no', 'f', 'n') THEN FALSE END
+              FROM (SELECT line_no,
+                           regexp_replace(translate(COALESCE(price, ''), '۰۱۲۳۴۵۶۷۸۹٬،', '0123456789,,'),
+                                          '[,\s]', '', 'g') AS price
+                      FROM import_staging) n
+             WHERE n.line_no = s.line_no
+        """)
+        cur.execute("""
+            UPDATE import_staging s
+               SET error = CASE
+                     WHEN s.cat_id IS NULL THEN 'دسته‌ی نامعتبر: ' || COALESCE(s.category, '')
+                     WHEN COALESCE(s.name, '') = '' THEN 'نام خالی'
+                     WHEN s.price_num IS NULL THEN 'قیمت نامعتبر: ' || COALESCE(s.price, '')
+                     WHEN s.active IS NULL THEN 'is_active نامعتبر: ' || s.is_active
+                     WHEN d.rn > 1 THEN 'تکراری در فایل'
+                   END
+              FROM (SELECT line_no, row_number() OVER (PARTITION BY cat_id, name ORDER BY line_no) AS rn
+                      FROM import_staging) d
+             WHERE d.line_no = s.line_no
+        """)
+        # فقط ستون‌های موجود در فایل؛ ستون غایب مقدار فعلی محصول را پاک نمی‌کند
+        sets = ["price = s.price_num"]
+        if "description" in columns:
+            sets.append("description = NULLIF(btrim(s.description), '')")
+        if "photo_file_id" in columns:
+            sets.append("photo_file_id = COALESCE(NULLIF(btrim(s.photo_file_id), ''), p.photo_file_id)")
+        if "is_active" in columns:
+            sets.append("is_active = s.active")
+        cur.execute(f"""
+            UPDATE products p
+               SET {', '.join(sets)}
+              FROM import_staging s
+             WHERE s.error IS NULL AND p.category_id = s.cat_id AND p.name = s.name
+        """)
+        updated = cur.rowcount
+        cur.execute("""
+            INSERT INTO products(category_id, name, price, description, photo_file_id, is_active)
+            SELECT s.cat_id, s.name, s.price_num, NULLIF(btrim(s.description), ''),
+                   NULLIF(btrim(s.photo_file_id), ''), s.active
+              FROM import_staging s
+             WHERE s.error IS NULL
+               AND NOT EXISTS (SELECT 1 FROM products p WHERE p.category_id = s.cat_id AND p.name = s.name)
+             ORDER BY s.line_no
+        """)
+        inserted = cur.rowcount
+        cur.execute("SELECT line_no, error FROM import_staging WHERE error IS NOT NULL ORDER BY line_no")
+        errors = cur.fetchall()
+        if inserted or updated:
+            _notify(cur, "catalog")
+    if inserted or updated:
+        invalidate_catalog()
+    return inserted, updated, errors
+
+def export_catalog(out_file):
+    """کل کاتالوگ با COPY TO STDOUT مستقیم در out_file (همان ستون‌های import)."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.copy_expert("""
+            COPY (SELECT c.slug AS category, p.name, p.price, p.description, p.photo_file_id, p.is_active
+                    FROM products p JOIN categories c USING (category_id)
+                   ORDER BY c.sort_order, c.category_id, p.product_id)
+              TO STDOUT WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')
+        """, out_file)
 
 # Orders
 def open_draft_order(user_id: int) -> int:
@@ -271,22 +1114,25 @@ def open_draft_order(user_id: int) -> int:
         return cur.fetchone()[0]
 
 def add_or_increment_item(order_id: int, product_id: int, unit_price: float, inc: int=1):
+    # جمع سفارش را تریگرهای trg_oi_total_* به‌روز می‌کنند
     with _conn() as cn, cn.cursor() as cur:
-        # اگر ردیف وجود نداشت، ایجاد کن
         cur.execute("""
             INSERT INTO order_items(order_id,product_id,qty,unit_price)
             VALUES(%s,%s,%s,%s)
-            ON CONFLICT DO NOTHING
-        """, (order_id, product_id, 0, unit_price))
-        # سپس افزایش تعداد
-        cur.execute("""UPDATE order_items SET qty=qty+%s, unit_price=%s WHERE order_id=%s AND product_id=%s""",
-                    (inc, unit_price, order_id, product_id))
-        cur.execute("SELECT fn_recalc_order_total(%s)", (order_id,))
+            ON CONFLICT (order_id,product_id)
+            DO UPDATE SET qty=order_items.qty+EXCLUDED.qty, unit_price=EXCLUDED.unit_price
+        """, (order_id, product_id, inc, unit_price))
+
+def cart_add(tg_id: int, product_id: int, inc: int=1):
+    """افزودن به سبد کاربر تلگرام در یک کوئری؛ جمع جدید سبد یا None."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("SELECT fn_cart_add(%s,%s,%s)", (tg_id, product_id, inc))
+        return cur.fetchone()[0]
 
 def empty_order(order_id: int):
     with _conn() as cn, cn.cursor() as cur:
+        # یک DELETE → یک به‌روزرسانی جمع (trg_oi_total_del)
         cur.execute("DELETE FROM order_items WHERE order_id=%s", (order_id,))
-        cur.execute("SELECT fn_recalc_order_total(%s)", (order_id,))
 
 def get_draft_with_items(user_id: int):
     with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
@@ -315,6 +1161,33 @@ def get_order_with_items_by_id(order_id: int):
         items = cur.fetchall()
         return order, items
 
+def verify_order_totals(fix: bool=False):
+    """مقایسه‌ی orders.total_amount با جمع ردیف‌ها برای کل جدول در یک پاس.
+
+    خروجی: لیست (order_id, total_amount, items_total) سفارش‌های ناسازگار؛
+    با fix=True همان‌ها اصلاح می‌شوند (total_amount مقدار قبل از اصلاح است).
+    """
+    items_sql = """
+        SELECT o.order_id, o.total_amount, COALESCE(s.items_total,0) AS items_total
+          FROM orders o
+          LEFT JOIN (SELECT order_id, SUM(qty*unit_price) AS items_total
+                       FROM order_items GROUP BY order_id) s
+            ON s.order_id = o.order_id
+         WHERE o.total_amount <> COALESCE(s.items_total,0)
+    """
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        if not fix:
+            cur.execute(items_sql + " ORDER BY o.order_id")
+            return cur.fetchall()
+        cur.execute(f"""
+            UPDATE orders o
+               SET total_amount = bad.items_total
+              FROM ({items_sql}) bad
+             WHERE o.order_id = bad.order_id
+         RETURNING o.order_id, bad.total_amount, bad.items_total
+        """)
+        return cur.fetchall()
+
 def set_order_option(order_id: int, key: str, value: str):
     with _conn() as cn, cn.cursor() as cur:
         cur.execute(f"UPDATE orders SET {key}=%s WHERE order_id=%s", (value, order_id))
@@ -326,6 +1199,60 @@ def submit_order(order_id: int):
 def mark_order_paid(order_id: int):
     with _conn() as cn, cn.cursor() as cur:
         cur.execute("UPDATE orders SET status='paid' WHERE order_id=%s", (order_id,))
+        _notify(cur, "kitchen")
+
+# Kitchen queue
+KITCHEN_FLOW = {"paid": "preparing", "preparing": "ready", "ready": "delivered"}
+
+def advance_order(order_id: int, to_status: str, notices=None):
+    """بردن سفارش به مرحله‌ی بعد آشپزخانه (compare-and-set روی مرحله‌ی قبلی).
+
+    پیام‌های notices(row) برای مشتری در همان تراکنش در outbox ثبت می‌شوند.
+    None یعنی سفارش وجود ندارد یا قبلاً جلو رفته است (دو باریستا هم‌زمان).
+    """
+    prev = next(k for k, v in KITCHEN_FLOW.items() if v == to_status)
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("""
+            UPDATE orders o SET status=%s
+              FROM users u
+             WHERE o.order_id=%s AND o.status=%s AND u.user_id=o.user_id
+         RETURNING o.order_id, o.status, o.shipping_method, u.telegram_id, u.name
+        """, (to_status, order_id, prev))
+        row = cur.fetchone()
+        if not row:
+            return None
+        if notices:
+            _enqueue(cur, notices(row))
+        _notify(cur, "kitchen")
+        return row
+
+def kitchen_queue(limit: int=30):
+    """سفارش‌های باز آشپزخانه به ترتیب پرداخت، با خلاصه‌ی اقلام؛ total = کل صف."""
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("""
+            SELECT o.order_id, o.status, o.shipping_method, o.paid_at, u.name,
+                   (SELECT string_agg(p.name || ' ×' || oi.qty, '، ' ORDER BY oi.item_id)
+                      FROM order_items oi JOIN products p ON p.product_id = oi.product_id
+                     WHERE oi.order_id = o.order_id) AS items,
+                   COUNT(*) OVER () AS total
+              FROM orders o JOIN users u ON u.user_id = o.user_id
+             WHERE o.status IN ('paid', 'preparing', 'ready')
+             ORDER BY o.paid_at, o.order_id
+             LIMIT %s
+        """, (limit,))
+        return cur.fetchall()
+
+def list_kitchen_boards() -> dict:
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("SELECT chat_id, message_id FROM kitchen_boards")
+        return dict(cur.fetchall())
+
+def set_kitchen_board(chat_id: int, message_id: int):
+    _exec("""INSERT INTO kitchen_boards(chat_id,message_id) VALUES(%s,%s)
+             ON CONFLICT (chat_id) DO UPDATE SET message_id=EXCLUDED.message_id""", (chat_id, message_id))
+
+def drop_kitchen_board(chat_id: int):
+    _exec("DELETE FROM kitchen_boards WHERE chat_id=%s", (chat_id,))
 
 # Wallet
 def add_wallet_tx(user_id: int, kind: str, amount: float, meta: dict):
@@ -333,30 +1260,487 @@ def add_wallet_tx(user_id: int, kind: str, amount: float, meta: dict):
         cur.execute("""INSERT INTO wallet_transactions(user_id,kind,amount,meta) VALUES(%s,%s,%s,%s)""",
                     (user_id, kind, amount, psycopg2.extras.Json(meta)))
 
+def wallet_checkout(order_id: int, tg_id: int, notices=None):
+    """پرداخت سفارش با کیف پول در یک رفت‌وبرگشت (fn_wallet_checkout).
+
+    خروجی dict با status (paid | insufficient | not_payable | empty | no_user)،
+    total، balance (موجودی جدید) و cashback. در صورت paid پیام‌های notices(res)
+    در همان تراکنش در outbox ثبت می‌شوند.
+    """
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("""
+            SELECT o_status AS status, o_total AS total, o_balance AS balance, o_cashback AS cashback
+              FROM fn_wallet_checkout(%s,%s)
+        """, (order_id, tg_id))
+        res = dict(cur.fetchone())
+        if res["status"] == "paid":
+            if notices:
+                _enqueue(cur, notices(res))
+            _notify(cur, "kitchen")
+        return res
+
+def wallet_statement(user_id: int, before_tx_id: int|None=None, limit: int=10):
+    """گردش حساب keyset (جدیدترین اول)؛ (rows, has_more)."""
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        if before_tx_id is None:
+            cur.execute("""
+                SELECT tx_id, kind, amount, meta, created_at FROM wallet_transactions
+                 WHERE user_id=%s
+                 ORDER BY created_at DESC, tx_id DESC
+                 LIMIT %s
+            """, (user_id, limit + 1))
+        else:
+            cur.execute("""
+                SELECT tx_id, kind, amount, meta, created_at FROM wallet_transactions
+                 WHERE user_id=%s
+                   AND (created_at, tx_id) < (SELECT created_at, tx_id FROM wallet_transactions WHERE tx_id=%s)
+                 ORDER BY created_at DESC, tx_id DESC
+                 LIMIT %s
+            """, (user_id, before_tx_id, limit + 1))
+        rows = cur.fetchall()
+        return rows[:limit], len(rows) > limit
+
+def checkpoint_wallets(settle_seconds: int=300) -> int:
+    """checkpoint جدید برای کاربرانی که از checkpoint قبلی تراکنش دارند (از روی دفتر، نه users.balance).
+
+    تراکنش‌های جوان‌تر از settle_seconds کنار گذاشته می‌شوند تا تراکنشی با tx_id
+    کوچک‌تر که دیرتر commit می‌شود از قلم نیفتد. تعداد کاربران به‌روزشده را برمی‌گرداند.
+    """
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO wallet_checkpoints(user_id, tx_id, balance)
+            SELECT t.user_id, MAX(t.tx_id), COALESCE(MAX(c.balance),0) + SUM(t.amount)
+              FROM wallet_transactions t
+              LEFT JOIN wallet_checkpoints c ON c.user_id = t.user_id
+             WHERE t.tx_id > COALESCE(c.tx_id, 0)
+               AND t.created_at < NOW() - make_interval(secs => %s)
+             GROUP BY t.user_id
+            ON CONFLICT (user_id) DO UPDATE
+               SET tx_id=EXCLUDED.tx_id, balance=EXCLUDED.balance, created_at=NOW()
+        """, (settle_seconds,))
+        return cur.rowcount
+
+def reconcile_wallets(limit: int=50):
+    """users.balance همه‌ی کاربران را با (checkpoint + تراکنش‌های بعد از آن) در یک پاس streaming مقایسه می‌کند.
+
+    خروجی: (checked, bad, mismatches) — mismatches حداکثر limit ردیف (user_id, telegram_id, balance, ledger).
+    """
+    checked, bad, mismatches = 0, 0, []
+    with _conn() as cn, cn.cursor(name="wallet_reconcile", cursor_factory=DictCursor) as cur:
+        cur.itersize = 2000
+        cur.execute("""
+            SELECT u.user_id, u.telegram_id, u.balance,
+                   COALESCE(c.balance,0) + COALESCE(d.delta,0) AS ledger
+              FROM users u
+              LEFT JOIN wallet_checkpoints c ON c.user_id = u.user_id
+              LEFT JOIN LATERAL (
+                   SELECT SUM(t.amount) AS delta FROM wallet_transactions t
+                    WHERE t.user_id = u.user_id AND t.tx_id > COALESCE(c.tx_id, 0)
+              ) d ON TRUE
+        """)
+        for row in cur:
+            checked += 1
+            if row["balance"] != row["ledger"]:
+                bad += 1
+                if len(mismatches) < limit:
+                    mismatches.append(dict(row))
+    return checked, bad, mismatches
+
+# Reports (از rollupها؛ مستقل از حجم تاریخچه)
+def sales_report(days: int=1, top: int=10) -> dict:
+    """گزارش days روز اخیر (امروز = ۱) به وقت REPORT_TZ.
+
+    totals: orders, revenue, cashback؛ products و categories: qty, revenue, cashback.
+    """
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT timezone(%s, NOW())::date - %s + 1", (REPORT_TZ, days))
+        since = cur.fetchone()[0]
+        cur.execute("""
+            SELECT COALESCE(SUM(orders), 0) AS orders, COALESCE(SUM(revenue), 0) AS revenue,
+                   COALESCE(SUM(cashback), 0) AS cashback
+              FROM sales_daily WHERE day >= %s
+        """, (since,))
+        totals = dict(cur.fetchone())
+        cur.execute("""
+            SELECT p.name, SUM(r.qty) AS qty, SUM(r.revenue) AS revenue, SUM(r.cashback) AS cashback
+              FROM sales_daily_product r JOIN products p ON p.product_id = r.product_id
+             WHERE r.day >= %s
+             GROUP BY p.product_id, p.name
+             ORDER BY revenue DESC
+             LIMIT %s
+        """, (since, top))
+        products = cur.fetchall()
+        cur.execute("""
+            SELECT c.title, SUM(r.qty) AS qty, SUM(r.revenue) AS revenue, SUM(r.cashback) AS cashback
+              FROM sales_daily_product r JOIN categories c ON c.category_id = r.category_id
+             WHERE r.day >= %s
+             GROUP BY c.category_id, c.title
+             ORDER BY revenue DESC
+        """, (since,))
+        categories = cur.fetchall()
+    return {"since": since, "totals": totals, "products": products, "categories": categories}
+
 # Topup & Order-pay requests
-def create_topup_request(user_id: int, amount: float, user_msg_id: int) -> int:
+# notices در توابع زیر: callable(نتیجه) → لیست پیام‌های outbox که در همان تراکنش ثبت می‌شوند
+def create_topup_request(user_id: int, amount: float, user_msg_id: int, notices=None) -> int:
     with _conn() as cn, cn.cursor() as cur:
         cur.execute("""INSERT INTO topup_requests(user_id,amount,status,user_msg_id)
                        VALUES(%s,%s,'pending',%s) RETURNING req_id""", (user_id, amount, user_msg_id))
-        return cur.fetchone()[0]
+        req_id = cur.fetchone()[0]
+        if notices:
+            _enqueue(cur, notices(req_id))
+        return req_id
 
-def create_order_pay_request(order_id: int, user_id: int, amount: float) -> int:
+def create_order_pay_request(order_id: int, user_id: int, amount: float, notices=None) -> int:
     with _conn() as cn, cn.cursor() as cur:
         cur.execute("""INSERT INTO topup_requests(user_id,amount,status,order_id)
                        VALUES(%s,%s,'pending',%s) RETURNING req_id""", (user_id, amount, order_id))
-        return cur.fetchone()[0]
+        req_id = cur.fetchone()[0]
+        if notices:
+            _enqueue(cur, notices(req_id))
+        return req_id
 
 def set_topup_admin_msg(req_id: int, admin_msg_id: int):
     _exec("UPDATE topup_requests SET admin_msg_id=%s WHERE req_id=%s", (admin_msg_id, req_id))
 
-def decide_payment(req_id: int, approve: bool):
+def decide_payment(req_id: int, approve: bool, notices=None):
+    """تصمیم ادمین روی درخواست شارژ/پرداخت سفارش، همه در یک تراکنش.
+
+    فقط درخواست pending تغییر می‌کند (compare-and-set)، پس دو ادمین هم‌زمان یا
+    callback تکراری دو بار شارژ/پرداخت نمی‌کنند. در تایید، کیف پول شارژ یا سفارش
+    paid می‌شود و پیام‌های notices(row) در outbox ثبت می‌شوند. None یعنی درخواست
+    وجود ندارد یا قبلاً بررسی شده است. اگر سفارش در این فاصله از راه دیگری پرداخت شده
+    باشد، درخواست rejected و row["already_paid"] برابر True است.
+    """
     newst = 'approved' if approve else 'rejected'
     with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute("""
-            UPDATE topup_requests
+            UPDATE topup_requests t
                SET status=%s
-             WHERE req_id=%s
-         RETURNING user_id, amount, order_id
+              FROM users u
+             WHERE t.req_id=%s AND t.status='pending' AND u.user_id=t.user_id
+         RETURNING t.user_id, u.telegram_id, u.name, t.amount, t.order_id
         """, (newst, req_id))
         row = cur.fetchone()
+        if not row:
+            return None
+        row = dict(row, already_paid=False)
+        if approve and row["order_id"]:
+            # فقط سفارش هنوز پرداخت‌نشده؛ سفارشی که در این فاصله با کیف پول پرداخت شده و شاید در
+            # آشپزخانه جلو رفته، نباید به paid برگردد (کش‌بک و rollup دوباره اجرا می‌شدند)
+            cur.execute("UPDATE orders SET status='paid' WHERE order_id=%s AND status IN ('draft','submitted')",
+                        (row["order_id"],))
+            if cur.rowcount:
+                _notify(cur, "kitchen")
+            else:
+                cur.execute("UPDATE topup_requests SET status='rejected' WHERE req_id=%s", (req_id,))
+                row["already_paid"] = True
+        elif approve:
+            cur.execute("""INSERT INTO wallet_transactions(user_id,kind,amount,meta) VALUES(%s,'topup',%s,%s)""",
+                        (row["user_id"], row["amount"], psycopg2.extras.Json({"req_id": req_id})))
+        if notices:
+            _enqueue(cur, notices(row))
         return row
+
+# Broadcasts
+def create_broadcast(admin_tg_id: int, from_chat_id: int|None, message_id: int|None, text: str|None) -> int:
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""INSERT INTO broadcasts(admin_tg_id,from_chat_id,message_id,text)
+                       VALUES(%s,%s,%s,%s) RETURNING broadcast_id""",
+                    (admin_tg_id, from_chat_id, message_id, text))
+        bid = cur.fetchone()[0]
+        _notify(cur, "broadcast")
+        return bid
+
+def get_broadcast(broadcast_id: int):
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT * FROM broadcasts WHERE broadcast_id=%s", (broadcast_id,))
+        return cur.fetchone()
+
+def list_running_broadcasts() -> list[int]:
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("SELECT broadcast_id FROM broadcasts WHERE status='running' ORDER BY broadcast_id")
+        return [r[0] for r in cur.fetchall()]
+
+def fetch_broadcast_recipients(after_user_id: int, limit: int=500):
+    """دسته‌ی بعدی گیرندگان فعال (keyset روی user_id)."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""
+            SELECT user_id, telegram_id FROM users
+             WHERE active=TRUE AND user_id > %s
+             ORDER BY user_id
+             LIMIT %s
+        """, (after_user_id, limit))
+        return cur.fetchall()
+
+def checkpoint_broadcast(broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                         blocked_tg_ids: list[int]) -> str:
+    """ثبت پیشرفت یک دسته + غیرفعال کردن کاربرانی که ربات را بلاک کرده‌اند؛ وضعیت فعلی را برمی‌گرداند."""
+    with _conn() as cn, cn.cursor() as cur:
+        if blocked_tg_ids:
+            cur.execute("UPDATE users SET active=FALSE WHERE telegram_id = ANY(%s)", (blocked_tg_ids,))
+            # payload NOTIFY حداکثر ~8000 بایت است
+            for i in range(0, len(blocked_tg_ids), 400):
+                _notify(cur, "identities:" + ",".join(map(str, blocked_tg_ids[i:i+400])))
+        cur.execute("""
+            UPDATE broadcasts
+               SET last_user_id=%s, sent=sent+%s, failed=failed+%s, blocked=blocked+%s
+             WHERE broadcast_id=%s
+         RETURNING status
+        """, (last_user_id, sent, failed, len(blocked_tg_ids), broadcast_id))
+        row = cur.fetchone()
+    for tg_id in blocked_tg_ids:
+        # تا /start بعدی دوباره active=TRUE کند
+        identities.discard(tg_id)
+    return row[0] if row else "cancelled"
+
+def finish_broadcast(broadcast_id: int, status: str='done'):
+    _exec("""UPDATE broadcasts SET status=%s, finished_at=NOW()
+              WHERE broadcast_id=%s AND status='running'""", (status, broadcast_id))
+
+# Outbox
+def enqueue_notices(notices):
+    with _conn() as cn, cn.cursor() as cur:
+        _enqueue(cur, notices)
+
+def claim_outbox(limit: int, lease_seconds: float):
+    """برداشتن دسته‌ی پیام‌های سررسیده (SKIP LOCKED)؛ تا پایان lease دوباره برداشته نمی‌شوند."""
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("""
+            UPDATE outbox o
+               SET attempts=o.attempts+1, next_attempt_at=NOW()+make_interval(secs => %s)
+             WHERE o.outbox_id IN (
+                   SELECT outbox_id FROM outbox
+                    WHERE status='pending' AND next_attempt_at<=NOW()
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                      FOR UPDATE SKIP LOCKED)
+         RETURNING o.outbox_id, o.chat_id, o.method, o.payload, o.attempts
+        """, (lease_seconds, limit))
+        return cur.fetchall()
+
+def finish_outbox(sent_ids: list[int], failures: list[tuple]):
+    """sent_ids → sent؛ failures: (outbox_id, error, retry_seconds یا None برای dead)."""
+    with _conn() as cn, cn.cursor() as cur:
+        if sent_ids:
+            cur.execute("UPDATE outbox SET status='sent', sent_at=NOW(), last_error=NULL WHERE outbox_id = ANY(%s)",
+                        (sent_ids,))
+        if failures:
+            cur.execute("""
+                UPDATE outbox o
+                   SET status = CASE WHEN f.delay IS NULL THEN 'dead' ELSE 'pending' END,
+                       next_attempt_at = NOW() + make_interval(secs => COALESCE(f.delay, 0)),
+                       last_error = f.err
+                  FROM unnest(%s::bigint[], %s::text[], %s::float8[]) AS f(id, err, delay)
+                 WHERE o.outbox_id = f.id
+            """, ([f[0] for f in failures], [f[1] for f in failures], [f[2] for f in failures]))
+
+# Bot persistence (PostgresPersistence)
+def load_user_data() -> dict:
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("SELECT user_id, data FROM ptb_user_data")
+        return {uid: data for uid, data in cur.fetchall()}
+
+def load_conversations(name: str) -> dict:
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("SELECT key, state FROM ptb_conversations WHERE name=%s", (name,))
+        return {tuple(json.loads(key)): state for key, state in cur.fetchall()}
+
+def save_persistence(user_data: dict, conversations: dict):
+    """نوشتن دسته‌ای همه‌ی تغییرات در یک تراکنش.
+
+    user_data: {user_id: dict یا None برای حذف}
+    conversations: {(name, key): state یا None برای پایان مکالمه}
+    """
+    Json = psycopg2.extras.Json
+    upsert_users = [(uid, Json(d)) for uid, d in user_data.items() if d]
+    drop_users = [uid for uid, d in user_data.items() if not d]
+    conv_rows = [(name, json.dumps(list(key)), state) for (name, key), state in conversations.items()]
+    upsert_convs = [(name, key, Json(state)) for name, key, state in conv_rows if state is not None]
+    drop_convs = [(name, key) for name, key, state in conv_rows if state is None]
+    with _conn() as cn, cn.cursor() as cur:
+        if upsert_users:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO ptb_user_data(user_id, data) VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET data=EXCLUDED.data, updated_at=NOW()
+            """, upsert_users)
+        if drop_users:
+            cur.execute("DELETE FROM ptb_user_data WHERE user_id = ANY(%s)", (drop_users,))
+        if upsert_convs:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO ptb_conversations(name, key, state) VALUES %s
+                ON CONFLICT (name, key) DO UPDATE SET state=EXCLUDED.state, updated_at=NOW()
+            """, upsert_convs)
+        if drop_convs:
+            psycopg2.extras.execute_values(cur, """
+                DELETE FROM ptb_conversations c USING (VALUES %s) AS d(name, key)
+                 WHERE c.name=d.name AND c.key=d.key
+            """, drop_convs)
+
+# Cluster: lease رهبر و قفل چت بین workerها
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """گرفتن یا تمدید lease؛ True اگر holder حالا صاحب آن است."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO leases(name, holder, expires_at) VALUES(%s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (name) DO UPDATE SET holder=EXCLUDED.holder, expires_at=EXCLUDED.expires_at
+             WHERE leases.holder=EXCLUDED.holder OR leases.expires_at < NOW()
+         RETURNING holder
+        """, (name, holder, ttl))
+        return cur.fetchone() is not None
+
+def release_lease(name: str, holder: str):
+    _exec("DELETE FROM leases WHERE name=%s AND holder=%s", (name, holder))
+
+# قفل‌های advisory در سطح session هستند، پس روی یک کانکشن اختصاصی گرفته و آزاد می‌شوند؛
+# اگر کانکشن قطع شود Postgres همه‌ی قفل‌هایش را خودش آزاد می‌کند.
+_lock_cn = None
+_lock_mu = threading.Lock()
+_CHAT_LOCK_SQL = "hashtext('crepebar:chat'), hashtext(%s::text)"
+
+def _with_lock_connection(fn):
+    global _lock_cn
+    with _lock_mu:
+        if _lock_cn is None or _lock_cn.closed:
+            _lock_cn = _dedicated_connection()
+        try:
+            with _lock_cn.cursor() as cur:
+                return fn(cur)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            try:
+                _lock_cn.close()
+            finally:
+                _lock_cn = None
+            raise
+
+def try_chat_lock(chat_id: int, user_id: int|None):
+    """(locked, user_data, states): بعد از گرفتن قفل، وضعیت تازه‌ی مکالمه‌ها و user_data
+    همین چت هم خوانده می‌شود (در statement جدا تا snapshot بعد از قفل باشد)."""
+    def run(cur):
+        cur.execute(f"SELECT pg_try_advisory_lock({_CHAT_LOCK_SQL})", (chat_id,))
+        if not cur.fetchone()[0]:
+            return False, None, {}
+        cur.execute("""
+            SELECT (SELECT data FROM ptb_user_data WHERE user_id=%s),
+                   (SELECT jsonb_object_agg(name, state) FROM ptb_conversations WHERE key=%s)
+        """, (user_id, json.dumps([chat_id, user_id])))
+        user_data, states = cur.fetchone()
+        return True, user_data, states or {}
+    return _with_lock_connection(run)
+
+def unlock_chat(chat_id: int):
+    def run(cur):
+        cur.execute(f"SELECT pg_advisory_unlock({_CHAT_LOCK_SQL})", (chat_id,))
+    _with_lock_connection(run)
+
+def close_lock_connection():
+    global _lock_cn
+    with _lock_mu:
+        if _lock_cn is not None:
+            _lock_cn.close()
+            _lock_cn = None
+
+def listen_connection():
+    """کانکشن اختصاصی LISTEN روی NOTIFY_CHANNEL (برای add_reader در event loop)."""
+    cn = _dedicated_connection()
+    with cn.cursor() as cur:
+        cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+    return cn
+
+# Janitor (هر تابع یک دسته‌ی محدود در یک تراکنش؛ ردیف‌های قفل‌شده رد می‌شوند)
+# سفارش‌های پرداخت‌شده (در هر مرحله‌ی آشپزخانه) بعد از ORDER_ARCHIVE_DAYS به orders_history می‌روند
+ARCHIVED_STATUSES = ["paid", "preparing", "ready", "delivered"]
+
+def expire_payment_requests(older_than_hours: float, limit: int, notices=None) -> int:
+    """درخواست‌های شارژ/پرداخت pending قدیمی → expired (تایید بعدی ادمین دیگر اثری ندارد).
+
+    پیام‌های notices(rows) (مشتری و ادمین‌ها) در همان تراکنش در outbox ثبت می‌شوند؛
+    rows: req_id، telegram_id، amount و order_id درخواست‌های منقضی‌شده.
+    """
+    with _conn() as cn, cn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("""
+            UPDATE topup_requests t SET status='expired'
+              FROM users u
+             WHERE u.user_id = t.user_id AND t.req_id IN (
+                SELECT req_id FROM topup_requests
+                 WHERE status='pending' AND created_at < NOW() - make_interval(hours => %s)
+                 ORDER BY created_at LIMIT %s
+                   FOR UPDATE SKIP LOCKED)
+         RETURNING t.req_id, u.telegram_id, t.amount, t.order_id
+        """, (older_than_hours, limit))
+        rows = cur.fetchall()
+        if rows and notices:
+            _enqueue(cur, notices(rows))
+        return len(rows)
+
+def expire_drafts(older_than_hours: float, limit: int) -> int:
+    """حذف سبدهای draft بدون فعالیت (ردیف‌ها با cascade)؛ سبدی که درخواست پرداخت باز دارد می‌ماند."""
+    with _conn() as cn, cn.cursor() as cur:
+        # created_at از ix_orders_status_created؛ سبد قدیمی ولی فعال را updated_at نگه می‌دارد
+        cur.execute("""
+            DELETE FROM orders WHERE order_id IN (
+                SELECT o.order_id FROM orders o
+                 WHERE o.status='draft'
+                   AND o.created_at < NOW() - make_interval(hours => %s)
+                   AND o.updated_at < NOW() - make_interval(hours => %s)
+                   AND NOT EXISTS (SELECT 1 FROM topup_requests t
+                                    WHERE t.order_id = o.order_id AND t.status='pending')
+                 ORDER BY o.created_at LIMIT %s
+                   FOR UPDATE SKIP LOCKED)
+        """, (older_than_hours, older_than_hours, limit))
+        return cur.rowcount
+
+def archive_orders(older_than_days: float, limit: int) -> int:
+    """انتقال سفارش‌های تمام‌شده‌ی قدیمی (با اقلامشان به شکل JSON) به orders_history."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""
+            SELECT order_id FROM orders
+             WHERE status = ANY(%s) AND created_at < NOW() - make_interval(days => %s)
+             ORDER BY created_at LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, (ARCHIVED_STATUSES, older_than_days, limit))
+        ids = [r[0] for r in cur.fetchall()]
+        if not ids:
+            return 0
+        cur.execute("""
+            SELECT fn_orders_history_partition(m AT TIME ZONE 'UTC')
+              FROM (SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') AS m
+                      FROM orders WHERE order_id = ANY(%s)) x
+        """, (ids,))
+        # هر دو CTE یک snapshot را می‌بینند، پس اقلام پیش از حذف cascade خوانده می‌شوند
+        cur.execute("""
+            WITH items AS (
+                SELECT order_id,
+                       jsonb_agg(jsonb_build_object('product_id', product_id, 'qty', qty, 'unit_price', unit_price)
+                                 ORDER BY item_id) AS items
+                  FROM order_items WHERE order_id = ANY(%s)
+                 GROUP BY order_id
+            ), moved AS (
+                DELETE FROM orders WHERE order_id = ANY(%s) RETURNING *
+            )
+            INSERT INTO orders_history(order_id, user_id, status, total_amount, cashback_amount,
+                                       shipping_method, payment_method, created_at, paid_at, items)
+            SELECT m.order_id, m.user_id, m.status, m.total_amount, m.cashback_amount,
+                   m.shipping_method, m.payment_method, m.created_at, m.paid_at, COALESCE(i.items, '[]')
+              FROM moved m LEFT JOIN items i USING (order_id)
+        """, (ids, ids))
+        return cur.rowcount
+
+# Update de-duplication
+def claim_update(update_id: int) -> bool:
+    """True اگر این update_id اولین بار است که دیده می‌شود."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("INSERT INTO processed_updates(update_id) VALUES(%s) ON CONFLICT DO NOTHING RETURNING 1",
+                    (update_id,))
+        return cur.fetchone() is not None
+
+def prune_processed_updates(keep_hours: float=24, limit: int=5000) -> int:
+    """حذف دسته‌ای update_idهای قدیمی (تلگرام بیش از ۲۴ ساعت آپدیت نگه نمی‌دارد)."""
+    with _conn() as cn, cn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM processed_updates WHERE update_id IN (
+                SELECT update_id FROM processed_updates
+                 WHERE received_at < NOW() - make_interval(hours => %s)
+                 LIMIT %s)
+        """, (keep_hours, limit))
+        return cur.rowcount
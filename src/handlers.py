@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
+import asyncio
+
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup,
+    Update, InlineKeyboardButton, InputFile, InlineKeyboardMarkup, InputMediaPhoto,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent,
 )
 from telegram.ext import (
     ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters
+    ConversationHandler, InlineQueryHandler, filters
 )
 from .base import (
-    log, fmt_money, is_admin, ADMIN_IDS,
-    CARD_PAN, CARD_NAME, CARD_NOTE, CURRENCY
+    log, fmt_money, is_admin,
+    CARD_PAN, CARD_NAME, CARD_NOTE, CURRENCY, ADMIN_IDS, SEARCH_CACHE_TTL
 )
-from . import db
+from . import adb, outbox, broadcast, catalog_io, kitchen
+from .cache import RecentSet
+from .db import catalog as db_catalog
 
 # ===================== Keyboards =====================
 def main_keyboard():
@@ -21,18 +26,21 @@ def main_keyboard():
     ]
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
-def categories_keyboard():
-    cats = db.list_categories()
+async def categories_keyboard():
+    cats = await adb.list_categories()
     buttons = [[InlineKeyboardButton(c["title"], callback_data=f"cat:{c['id']}")] for c in cats]
+    # جستجو با inline mode در همین چت: @bot <عبارت>
+    buttons.append([InlineKeyboardButton("🔎 جستجو", switch_inline_query_current_chat="")])
     return InlineKeyboardMarkup(buttons)
 
-def products_keyboard(cat_id: int, page: int, total: int, page_size: int = 6):
-    # ناوبری
+def products_keyboard(cat_id: int, page: int, first_id: int | None, last_id: int | None,
+                      has_prev: bool, has_next: bool):
+    # ناوبری (keyset): قبلی = قبل از اولین محصول صفحه، بعدی = بعد از آخرین محصول صفحه
     nav = []
-    if page > 1:
-        nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"catp:{cat_id}:{page-1}"))
-    if page * page_size < total:
-        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"catp:{cat_id}:{page+1}"))
+    if has_prev and first_id is not None:
+        nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"catp:{cat_id}:{page-1}:b{first_id}"))
+    if has_next and last_id is not None:
+        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"catp:{cat_id}:{page+1}:a{last_id}"))
 
     rows = []
     if nav: rows.append(nav)
@@ -64,7 +72,7 @@ def pay_keyboard(order_id: int):
 # ---------- /start ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db.upsert_user(u.id, u.full_name or u.username or "")
+    await adb.upsert_user(u.id, u.full_name or u.username or "")
     await update.effective_chat.send_message(
         "سلام 😊\nبه ربات فروشگاهی بیو کِرِپ‌بار خوش آمدید!",
         reply_markup=main_keyboard()
@@ -72,65 +80,144 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------- Menu ----------
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.effective_chat.send_message("دستهٔ محصول را انتخاب کنید:", reply_markup=categories_keyboard())
+    await update.effective_chat.send_message("دستهٔ محصول را انتخاب کنید:", reply_markup=await categories_keyboard())
 
 # ---------- Category & Paging ----------
+# هر صفحه‌ی دسته یک کارت است: عکس (file_id ذخیره‌شده، بدون آپلود دوباره) + فهرست در caption
+# + دکمه‌ها. ورق زدن همان پیام را با یک edit_message_media عوض می‌کند و کارت ساخته‌شده
+# در کش catalog می‌ماند، پس ورق زدن دوباره به دیتابیس نمی‌رود. دسته‌ی بی‌عکس متنی می‌ماند.
+PAGE_SIZE = 6
+
 async def cb_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    _, cat_id = q.data.split(":")
+    _, cat_id = update.callback_query.data.split(":")
     await show_category(update, context, int(cat_id), 1)
 
 async def cb_category_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    _, cat_id, page = q.data.split(":")
-    await show_category(update, context, int(cat_id), int(page))
+    _, cat_id, page, cursor = update.callback_query.data.split(":")
+    await show_category(update, context, int(cat_id), int(page), cursor=cursor)
+
+# دیدن عکس یک محصول از همان صفحه: pv:{cat}:{page}:{cursor}:{pid}
+async def cb_product_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _, cat_id, page, cursor, pid = update.callback_query.data.split(":")
+    await show_category(update, context, int(cat_id), int(page), cursor=cursor, cover_id=int(pid))
+
+async def render_category_page(cat_id: int, page: int, cursor: str = "-", cover_id: int | None = None) -> dict:
+    """کارت صفحه: {"photo": file_id یا None، "text"، "markup"}؛ کش‌شده تا تغییر بعدی کاتالوگ.
+
+    cursor: "-" صفحه‌ی اول، a{id} بعد از id، b{id} قبل از id (keyset).
+    """
+    key = ("page", cat_id, page, cursor, cover_id)
+    hit, card = db_catalog.get(key)
+    if hit:
+        return card
+    version = db_catalog.version
+    after_id = int(cursor[1:]) if cursor[0] == "a" else None
+    before_id = int(cursor[1:]) if cursor[0] == "b" else None
+    items, has_more = await adb.list_products_by_category(cat_id, after_id, before_id, PAGE_SIZE)
+    if before_id is not None:
+        # برگشت به عقب: صفحه‌ی بعد حتماً هست؛ قبلی فقط اگر جدیدترها تمام نشده باشند
+        has_prev, has_next = has_more, bool(items)
+        page = max(page, 2) if has_more else 1
+    else:
+        has_prev, has_next = page > 1, has_more
 
-async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int, page: int):
-    page_size = 6
-    items, total = db.list_products_by_category(cat_id, page, page_size)
+    # عکس کارت: محصول انتخاب‌شده، وگرنه اولین محصول عکس‌دار صفحه، وگرنه عکس دسته
+    cover = next((p for p in items if p["id"] == cover_id and p["photo_file_id"]), None) \
+        or next((p for p in items if p["photo_file_id"]), None)
+    photo = cover["photo_file_id"] if cover else await adb.get_category_cover(cat_id)
 
     if not items:
         txt = "در این دسته هنوز محصولی ثبت نشده است."
     else:
         lines = [f"🧺 محصولات (صفحه {page})\n\nبرای افزودن، روی دکمه‌ی هر محصول بزنید:"]
         for p in items:
-            price = fmt_money(p["price"])
-            # یک ردیف دکمه برای افزودن هر محصول
-            lines.append(f"• {p['name']} — {price}")
+            mark = "📷 " if cover and p["id"] == cover["id"] else "• "
+            lines.append(f"{mark}{p['name']} — {fmt_money(p['price'])}")
         txt = "\n".join(lines)
 
-    # زیر متن، دکمه‌های «افزودن» را هم می‌گذاریم
-    # هر دکمه‌ی افزودن به سبد، در یک ردیف جدا
+    # هر محصول یک ردیف: افزودن به سبد + (اگر عکس دارد) نمایش عکسش روی همین کارت
     kb_rows = []
     for p in items:
-        kb_rows.append([InlineKeyboardButton(f"➕ {p['name']}", callback_data=f"add:{p['id']}")])
+        row = [InlineKeyboardButton(f"➕ {p['name']}", callback_data=f"add:{p['id']}")]
+        if photo and p["photo_file_id"] and not (cover and p["id"] == cover["id"]):
+            row.append(InlineKeyboardButton("🖼", callback_data=f"pv:{cat_id}:{page}:{cursor}:{p['id']}"))
+        kb_rows.append(row)
     # ناوبری + سایر
-    nav_keyboard = products_keyboard(cat_id, page, total, page_size)
-    kb_rows.extend(nav_keyboard.inline_keyboard)
-    kb = InlineKeyboardMarkup(kb_rows)
-
-    if update.callback_query:
-        await update.effective_message.edit_text(txt, reply_markup=kb)
+    first_id = items[0]["id"] if items else None
+    last_id = items[-1]["id"] if items else None
+    kb_rows.extend(products_keyboard(cat_id, page, first_id, last_id, has_prev, has_next).inline_keyboard)
+
+    card = {"photo": photo, "text": txt, "markup": InlineKeyboardMarkup(kb_rows)}
+    db_catalog.put(key, card, version)
+    return card
+
+async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int, page: int,
+                        cursor: str = "-", cover_id: int | None = None):
+    card = await render_category_page(cat_id, page, cursor, cover_id)
+    q = update.callback_query
+    msg = update.effective_message
+    if q and card["photo"] and msg.photo:
+        # ورق زدن کارت عکس‌دار: فقط یک edit؛ answer هم‌زمان فرستاده می‌شود
+        await asyncio.gather(q.answer(), msg.edit_media(
+            InputMediaPhoto(card["photo"], caption=card["text"]), reply_markup=card["markup"]))
+    elif q and not card["photo"] and msg.text:
+        await asyncio.gather(q.answer(), msg.edit_text(card["text"], reply_markup=card["markup"]))
     else:
-        await update.effective_chat.send_message(txt, reply_markup=kb)
+        # اولین کارت (از پیام منو یا بعد از ثبت محصول): پیام تازه، منو سر جایش می‌ماند
+        if q:
+            await q.answer()
+        if card["photo"]:
+            await update.effective_chat.send_photo(card["photo"], caption=card["text"], reply_markup=card["markup"])
+        else:
+            await update.effective_chat.send_message(card["text"], reply_markup=card["markup"])
+
+# ---------- Inline search (@bot crepe nutella) ----------
+SEARCH_LIMIT = 20
+# ILIKE/trigram روی GIN فقط با حداقل یک trigram کامل (۳ حرف) از index استفاده می‌کند؛
+# عبارت کوتاه‌تر کل جدول را می‌خواند
+SEARCH_MIN_QUERY = 3
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    # نرمال‌سازی تا «Nutella» و «nutella  » یک کلید کش باشند
+    query = " ".join(iq.query.lower().split())[:64]
+    if len(query) < SEARCH_MIN_QUERY:
+        return await iq.answer([], cache_time=300)
+    results = []
+    for p in await adb.search_products(query, SEARCH_LIMIT):
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("➕ افزودن به سبد", callback_data=f"add:{p['id']}")]])
+        text = f"{p['name']} — {fmt_money(p['price'])}"
+        if p["description"]:
+            text += f"\n{p['description']}"
+        if p["photo_file_id"]:
+            results.append(InlineQueryResultCachedPhoto(
+                id=str(p["id"]), photo_file_id=p["photo_file_id"], title=p["name"],
+                description=fmt_money(p["price"]), caption=text, reply_markup=kb,
+            ))
+        else:
+            results.append(InlineQueryResultArticle(
+                id=str(p["id"]), title=p["name"], description=fmt_money(p["price"]),
+                input_message_content=InputTextMessageContent(text), reply_markup=kb,
+            ))
+    # نتایج شخصی نیستند؛ تلگرام هم همین مدت برای همه کش می‌کند
+    await iq.answer(results, cache_time=int(SEARCH_CACHE_TTL), is_personal=False)
 
 # ---------- Add to cart ----------
 async def cb_add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
+    q = update.callback_query
     _, pid = q.data.split(":")
-    pid = int(pid)
-    prod = db.get_product(pid)
-    if not prod:
+    # دکمه‌ی نتیجه‌ی inline یا پیام فورواردشده ممکن است از کسی باشد که هنوز /start نزده
+    u = update.effective_user
+    await adb.upsert_user(u.id, u.full_name or u.username or "")
+    total = await adb.cart_add(u.id, int(pid), 1)
+    if total is None:
         return await q.answer("محصول یافت نشد.", show_alert=True)
-    u = db.get_user_by_tg(update.effective_user.id)
-    oid = db.open_draft_order(u["id"])
-    db.add_or_increment_item(oid, pid, float(prod["price"]), 1)
-    await q.answer("به سبد افزوده شد ✅", show_alert=False)
+    await q.answer(f"به سبد افزوده شد ✅ (جمع: {fmt_money(total)})", show_alert=False)
 
 # ---------- Cart (Order tab) ----------
 async def order_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = db.get_user_by_tg(update.effective_user.id)
-    order, items = db.get_draft_with_items(u["id"])
+    u = await adb.resolve_user(update.effective_user.id)
+    order, items = await adb.get_draft_with_items(u["id"])
     if not order or not items:
         return await update.effective_chat.send_message("سبد شما خالی است.", reply_markup=main_keyboard())
 
@@ -152,24 +239,24 @@ async def order_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # تغییر روش ارسال (حضوری/پیک)
 async def cb_toggle_shipping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    u = db.get_user_by_tg(update.effective_user.id)
-    order, items = db.get_draft_with_items(u["id"])
+    u = await adb.resolve_user(update.effective_user.id)
+    order, items = await adb.get_draft_with_items(u["id"])
     if not order: return await q.answer("سبد خالی است.", show_alert=True)
     shipping = order.get("shipping_method") or ""
     new_v = "پیک" if shipping != "پیک" else "حضوری"
-    db.set_order_option(order["order_id"], "shipping_method", new_v)
+    await adb.set_order_option(order["order_id"], "shipping_method", new_v)
     # بازنمایش
     await order_entry(update, context)
 
 # تغییر روش پرداخت (کیف/کارت)
 async def cb_toggle_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    u = db.get_user_by_tg(update.effective_user.id)
-    order, items = db.get_draft_with_items(u["id"])
+    u = await adb.resolve_user(update.effective_user.id)
+    order, items = await adb.get_draft_with_items(u["id"])
     if not order: return await q.answer("سبد خالی است.", show_alert=True)
     pay = order.get("payment_method") or ""
     new_v = "wallet" if pay != "wallet" else "card"
-    db.set_order_option(order["order_id"], "payment_method", new_v)
+    await adb.set_order_option(order["order_id"], "payment_method", new_v)
     await order_entry(update, context)
 
 # ثبت نهایی: بر اساس روش پرداخت
@@ -178,7 +265,7 @@ async def cb_submit_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, oid = q.data.split(":")
     oid = int(oid)
 
-    order, items = db.get_order_with_items_by_id(oid)
+    order, items = await adb.get_order_with_items_by_id(oid)
     if not order or not items:
         return await q.edit_message_text("سبد خالی است.")
     pay = order.get("payment_method")
@@ -186,20 +273,23 @@ async def cb_submit_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not (pay and shipping):
         return await q.answer("روش ارسال/پرداخت را انتخاب کنید.", show_alert=True)
 
-    u = db.get_user_by_tg(update.effective_user.id)
+    u = await adb.resolve_user(update.effective_user.id)
 
     if pay == "wallet":
-        bal = db.get_balance(u["id"])
-        if bal < float(order["total_amount"]):
+        # قفل، چک موجودی، کسر و paid در یک تراکنش سمت سرور؛
+        # ادمین‌ها سفارش را روی تابلوی آشپزخانه می‌بینند (نه پیام جدا برای هر سفارش)
+        res = await adb.wallet_checkout(oid, update.effective_user.id)
+        if res["status"] == "insufficient":
             return await q.edit_message_text(
-                f"❗️ موجودی کیف پول کافی نیست.\nموجودی: {fmt_money(bal)}\nجمع کل: {fmt_money(order['total_amount'])}\nاز «👛 کیف پول» شارژ کنید."
+                f"❗️ موجودی کیف پول کافی نیست.\nموجودی: {fmt_money(res['balance'])}\nجمع کل: {fmt_money(res['total'])}\nاز «👛 کیف پول» شارژ کنید."
             )
-        # کسر و پرداخت
-        db.add_wallet_tx(u["id"], "order", -float(order["total_amount"]), {"order_id": oid})
-        db.mark_order_paid(oid)
-        await q.edit_message_text("✅ سفارش با کیف پول پرداخت شد. ممنونیم!")
-        # اطلاع به ادمین
-        await _notify_admins(context, f"🛒 سفارش جدید پرداخت شد (کیف پول)\nOrder #{oid}\nکاربر: {u['name']} ({u['telegram_id']})\nمبلغ: {fmt_money(order['total_amount'])}\nروش ارسال: {shipping}")
+        if res["status"] != "paid":
+            return await q.edit_message_text("این سفارش قابل پرداخت نیست (قبلاً پرداخت شده یا خالی است).")
+        txt = f"✅ سفارش با کیف پول پرداخت شد. ممنونیم!\nموجودی جدید: {fmt_money(res['balance'])}"
+        if res["cashback"]:
+            txt += f"\nکش‌بک: {fmt_money(res['cashback'])}"
+        kitchen.touch()
+        await q.edit_message_text(txt)
         return
 
     # pay == "card" → کارت‌به‌کارت
@@ -209,23 +299,23 @@ async def cb_submit_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• کارت: {CARD_PAN}\n• به نام: {CARD_NAME}\n{CARD_NOTE}\n\n"
         "پس از ارسال رسید، ادمین تایید می‌کند و وضعیت سفارش «پرداخت‌شده» می‌شود."
     )
+    # برای ادمین هم یک درخواست تایید می‌سازیم؛ پیام ادمین‌ها با همان تراکنش در outbox
+    def notices(req_id):
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("تایید پرداخت سفارش ✅", callback_data=f"opa:{req_id}")],
+            [InlineKeyboardButton("رد ❌", callback_data=f"opr:{req_id}")],
+        ])
+        admin_txt = f"🔔 سفارش منتظر تایید پرداخت (کارت‌به‌کارت)\nOrder #{oid}\nکاربر: {u['name']} ({u['telegram_id']})\nمبلغ: {fmt_money(order['total_amount'])}\nروش ارسال: {shipping}"
+        return [outbox.message(a, admin_txt, kb) for a in ADMIN_IDS]
+    await adb.create_order_pay_request(oid, u["id"], float(order["total_amount"]), notices)
+    outbox.wake()
     await q.edit_message_text(txt)
-    # برای ادمین هم یک درخواست تایید می‌سازیم
-    req_id = db.create_order_pay_request(oid, u["id"], float(order["total_amount"]))
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("تایید پرداخت سفارش ✅", callback_data=f"opa:{req_id}")],
-        [InlineKeyboardButton("رد ❌", callback_data=f"opr:{req_id}")],
-    ])
-    await _notify_admins(context,
-        f"🔔 سفارش منتظر تایید پرداخت (کارت‌به‌کارت)\nOrder #{oid}\nکاربر: {u['name']} ({u['telegram_id']})\nمبلغ: {fmt_money(order['total_amount'])}\nروش ارسال: {shipping}",
-        reply_markup=kb
-    )
 
 # خالی کردن سبد
 async def cb_empty(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     _, oid = q.data.split(":")
-    db.empty_order(int(oid))
+    await adb.empty_order(int(oid))
     await q.edit_message_text("سبد خالی شد.")
 
 # ---------- Add product (admin only) ----------
@@ -265,7 +355,7 @@ async def ap_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.photo:
         file_id = update.message.photo[-1].file_id
     ap["photo"] = file_id
-    pid = db.add_product(
+    pid = await adb.add_product(
         ap["cat_id"], ap["name"], ap["price"], ap["desc"], ap["photo"]
     )
     await update.message.reply_text(f"✅ محصول «{ap['name']}» ثبت شد.")
@@ -274,12 +364,32 @@ async def ap_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------- Wallet ----------
 async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = db.get_user_by_tg(update.effective_user.id)
-    bal = fmt_money(db.get_balance(u["id"]))
+    u = await adb.resolve_user(update.effective_user.id)
+    bal = fmt_money(await adb.get_balance(u["id"]))
     txt = f"موجودی شما: {bal}\n\nکارت‌به‌کارت:\n• کارت: {CARD_PAN}\n• صاحب حساب: {CARD_NAME}\n{CARD_NOTE}\n\nبرای شارژ، مبلغ را بفرستید."
-    await update.effective_chat.send_message(txt)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("📜 گردش حساب", callback_data="wst:0")]])
+    await update.effective_chat.send_message(txt, reply_markup=kb)
     return TOPUP_AMOUNT
 
+TX_KINDS = {"topup": "شارژ", "order": "خرید", "cashback": "کش‌بک"}
+
+# گردش حساب (صفحه‌بندی keyset روی tx_id)
+async def cb_wallet_statement(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    before = int(q.data.split(":")[1]) or None
+    u = await adb.resolve_user(update.effective_user.id)
+    rows, has_more = await adb.wallet_statement(u["id"], before, 10)
+    if not rows:
+        return await q.edit_message_text("تراکنشی ثبت نشده است.")
+    lines = ["📜 گردش حساب:\n"]
+    for r in rows:
+        sign = "➕" if r["amount"] >= 0 else "➖"
+        lines.append(f"{sign} {TX_KINDS.get(r['kind'], r['kind'])} {fmt_money(abs(r['amount']))} — {r['created_at']:%Y-%m-%d %H:%M}")
+    kb = None
+    if has_more:
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("قدیمی‌تر ▶️", callback_data=f"wst:{rows[-1]['tx_id']}")]])
+    await q.edit_message_text("\n".join(lines), reply_markup=kb)
+
 async def topup_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         amount = int(update.message.text.replace(",", "").replace("،", "").strip())
@@ -292,70 +402,231 @@ async def topup_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def topup_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
         return await update.message.reply_text("لطفاً عکس رسید را بفرستید.")
-    u = db.get_user_by_tg(update.effective_user.id)
+    u = await adb.resolve_user(update.effective_user.id)
     amount = context.user_data.get("topup_amount", 0)
-    req_id = db.create_topup_request(u["id"], amount, update.message.message_id)
-
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("تایید شارژ ✅", callback_data=f"tpa:{req_id}")],
-        [InlineKeyboardButton("رد ❌",   callback_data=f"tpr:{req_id}")],
-    ])
-
-    # ارسال به همه ادمین‌ها (با try/except)
-    sent_any = False
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_photo(
-                chat_id=admin_id,
-                photo=update.message.photo[-1].file_id,
-                caption=f"🔔 درخواست شارژ کیف پول\nکاربر: {u['name']} ({u['telegram_id']})\nمبلغ: {fmt_money(amount)}\nreq_id={req_id}",
-                reply_markup=kb
-            )
-            sent_any = True
-        except Exception as e:
-            log.warning(f"send to admin failed: {e}")
-    if not sent_any:
-        log.warning("No admin notified: ADMIN_IDS empty?")
+    file_id = update.message.photo[-1].file_id
+
+    # پیام همه ادمین‌ها با همان تراکنش درخواست در outbox ثبت می‌شود
+    def notices(req_id):
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("تایید شارژ ✅", callback_data=f"tpa:{req_id}")],
+            [InlineKeyboardButton("رد ❌",   callback_data=f"tpr:{req_id}")],
+        ])
+        caption = f"🔔 درخواست شارژ کیف پول\nکاربر: {u['name']} ({u['telegram_id']})\nمبلغ: {fmt_money(amount)}\nreq_id={req_id}"
+        return [outbox.photo(a, file_id, caption, kb) for a in ADMIN_IDS]
+    await adb.create_topup_request(u["id"], amount, update.message.message_id, notices)
+    outbox.wake()
 
     await update.message.reply_text("✅ درخواست شارژ ارسال شد. پس از تایید ادمین، کیف پول شما شارژ می‌شود.")
     return ConversationHandler.END
 
 # تایید/رد شارژ یا پرداخت سفارش توسط ادمین
+# درخواست‌هایی که این پردازه رویشان تصمیم گرفته؛ ادمین دوم یا callback تکراری بدون DB جواب می‌گیرد
+_decided_requests = RecentSet(4096)
+
+async def _edit_admin_msg(q, text: str):
+    # پیام شارژ عکس (caption) است و پیام پرداخت سفارش متن
+    if q.message and q.message.photo:
+        await q.edit_message_caption(caption=text)
+    else:
+        await q.edit_message_text(text)
+
+def _decision_texts(row, approve: bool):
+    """(متن ادمین، متن کاربر) برای نتیجه‌ی decide_payment."""
+    amount, order_id = float(row["amount"]), row["order_id"]
+    if order_id and row["already_paid"]:
+        admin_txt = f"⚠️ سفارش #{order_id} قبلاً پرداخت شده است؛ این درخواست رد شد. وجه کارت‌به‌کارت {fmt_money(amount)} را برگردانید."
+        user_txt = f"ℹ️ سفارش #{order_id} قبلاً پرداخت شده بود؛ وجه کارت‌به‌کارت شما بازگردانده می‌شود."
+    elif order_id:
+        admin_txt = f"{'✅' if approve else '❌'} پرداخت سفارش #{order_id} {'تایید' if approve else 'رد'} شد."
+        user_txt = f"✅ پرداخت سفارش #{order_id} تایید شد. سپاس!" if approve else f"❌ پرداخت سفارش #{order_id} رد شد."
+    elif approve:
+        admin_txt = f"✅ شارژ تایید شد و {fmt_money(amount)} اضافه گردید."
+        user_txt = f"✅ شارژ {fmt_money(amount)} تایید شد و به کیف پول اضافه گردید."
+    else:
+        admin_txt = "❌ شارژ رد شد."
+        user_txt = "❌ درخواست شارژ شما رد شد."
+    return admin_txt, user_txt
+
 async def cb_topup_or_order_decide(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
+    q = update.callback_query
     data = q.data
     approve = data.startswith("tpa:") or data.startswith("opa:")
     req_id = int(data.split(":")[1])
-    row = db.decide_payment(req_id, approve)
+    if not _decided_requests.add(req_id):
+        return await q.answer("این درخواست قبلاً بررسی شده است.", show_alert=True)
+    me = update.effective_user
+
+    # پیام کاربر و بقیه‌ی ادمین‌ها همراه همان تراکنش تصمیم در outbox ثبت می‌شوند
+    def notices(row):
+        admin_txt, user_txt = _decision_texts(row, approve)
+        info = f"ℹ️ درخواست #{req_id} ({row['name']}) توسط {me.full_name}: {admin_txt}"
+        return [outbox.message(row["telegram_id"], user_txt)] + \
+               [outbox.message(a, info) for a in ADMIN_IDS if a != me.id]
+    try:
+        row = await adb.decide_payment(req_id, approve, notices)
+    except Exception:
+        _decided_requests.discard(req_id)
+        raise
+    await q.answer()
     if not row:
-        return await q.edit_message_caption(caption="درخواست یافت نشد یا قبلاً بررسی شده.")
-    user_id, amount, order_id = int(row["user_id"]), float(row["amount"]), row.get("order_id")
-    # اگر مربوط به سفارش بود:
-    if order_id and approve:
-        db.mark_order_paid(order_id)
-        await q.edit_message_caption(caption=f"✅ پرداخت سفارش #{order_id} تایید شد.")
-    elif order_id and not approve:
-        await q.edit_message_caption(caption=f"❌ پرداخت سفارش #{order_id} رد شد.")
-    else:
-        # شارژ کیف پول
-        if approve:
-            db.add_wallet_tx(user_id, "topup", amount, {"req_id": req_id})
-            await q.edit_message_caption(caption=f"✅ شارژ تایید شد و {fmt_money(amount)} اضافه گردید.")
-        else:
-            await q.edit_message_caption(caption=f"❌ شارژ رد شد.")
+        return await _edit_admin_msg(q, "درخواست یافت نشد، منقضی شده یا قبلاً بررسی شده.")
+    outbox.wake()
+    if approve and row["order_id"] and not row["already_paid"]:
+        kitchen.touch()
+    await _edit_admin_msg(q, _decision_texts(row, approve)[0])
+
+# ---------- Admin: consistency check ----------
+async def cmd_check_totals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    fix = bool(context.args) and context.args[0] == "fix"
+    rows = await adb.verify_order_totals(fix)
+    if not rows:
+        return await update.effective_chat.send_message("✅ جمع همه‌ی سفارش‌ها با ردیف‌هایشان یکی است.")
+    lines = [f"{'🛠 اصلاح شد' if fix else '⚠️ ناسازگار'}: {len(rows)} سفارش"]
+    for r in rows[:20]:
+        lines.append(f"• #{r['order_id']}: {fmt_money(r['total_amount'])} ≠ {fmt_money(r['items_total'])}")
+    if not fix:
+        lines.append("\nبرای اصلاح: /checktotals fix")
+    await update.effective_chat.send_message("\n".join(lines))
+
+# ---------- Admin: wallet reconciliation ----------
+async def cmd_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    checked, bad, rows = await adb.reconcile_wallets()
+    if not bad:
+        return await update.effective_chat.send_message(f"✅ موجودی {checked} کاربر با دفتر کیف پول یکی است.")
+    lines = [f"⚠️ {bad} از {checked} کاربر ناسازگار:"]
+    for r in rows[:20]:
+        lines.append(f"• {r['telegram_id']}: موجودی {fmt_money(r['balance'])} ≠ دفتر {fmt_money(r['ledger'])}")
+    await update.effective_chat.send_message("\n".join(lines))
+
+# ---------- Admin: kitchen queue ----------
+async def cmd_kitchen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/kitchen: تابلوی سفارش‌ها را در همین چت (خصوصی یا گروه باریستاها) بفرست و پین کن."""
+    if not is_admin(update.effective_user.id):
+        return
+    await kitchen.post_board(context.bot, update.effective_chat.id)
 
-    # اطلاع به کاربر
-    tg_id = db.get_user_tg_by_id(user_id)
-    if order_id:
-        if approve:
-            await context.bot.send_message(tg_id, f"✅ پرداخت سفارش #{order_id} تایید شد. سپاس!")
-        else:
-            await context.bot.send_message(tg_id, f"❌ پرداخت سفارش #{order_id} رد شد.")
-    else:
-        if approve:
-            await context.bot.send_message(tg_id, f"✅ شارژ {fmt_money(amount)} تایید شد و به کیف پول اضافه گردید.")
-        else:
-            await context.bot.send_message(tg_id, f"❌ درخواست شارژ شما رد شد.")
+async def cb_kitchen_advance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(update.effective_user.id):
+        return await q.answer("فقط ادمین.", show_alert=True)
+    _, oid, to_status = q.data.split(":")
+
+    # پیام مشتری همراه همان تراکنش تغییر وضعیت در outbox ثبت می‌شود
+    def notices(row):
+        return [outbox.message(row["telegram_id"], kitchen.customer_notice(row))]
+    row = await adb.advance_order(int(oid), to_status, notices)
+    if not row:
+        # باریستای دیگری زودتر زده؛ تابلو در ویرایش بعدی درست می‌شود
+        kitchen.touch()
+        return await q.answer("وضعیت این سفارش قبلاً تغییر کرده است.")
+    outbox.wake()
+    kitchen.touch()
+    await q.answer(f"سفارش #{oid}: {kitchen.ACTION_LABELS[to_status]} ✅")
+
+# ---------- Admin: sales report ----------
+async def cmd_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/report [روز]: فروش و کش‌بک امروز یا N روز اخیر از rollupهای روزانه."""
+    if not is_admin(update.effective_user.id):
+        return
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    days = min(max(days, 1), 366)
+    rep = await adb.sales_report(days)
+    t = rep["totals"]
+    title = "امروز" if days == 1 else f"{days} روز اخیر (از {rep['since']:%Y-%m-%d})"
+    lines = [
+        f"📊 گزارش فروش {title}",
+        f"سفارش پرداخت‌شده: {t['orders']} | فروش: {fmt_money(t['revenue'])} | کش‌بک: {fmt_money(t['cashback'])}",
+    ]
+    if rep["categories"]:
+        lines.append("\nدسته‌ها:")
+        for c in rep["categories"]:
+            lines.append(f"• {c['title']}: {c['qty']} عدد — {fmt_money(c['revenue'])} (کش‌بک {fmt_money(c['cashback'])})")
+    if rep["products"]:
+        lines.append("\nپرفروش‌ترین‌ها:")
+        for i, p in enumerate(rep["products"], 1):
+            lines.append(f"{i}. {p['name']}: {p['qty']} عدد — {fmt_money(p['revenue'])}")
+    await update.effective_chat.send_message("\n".join(lines))
+
+# ---------- Admin: catalog import/export ----------
+IMPORT_MAX_BYTES = 10 * 1024 * 1024
+
+async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """فایل CSV/XLSX با کپشن /import یا ریپلای /import روی فایل."""
+    if not is_admin(update.effective_user.id):
+        return
+    msg = update.message
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if not doc:
+        return await msg.reply_text(
+            "بارگذاری دسته‌ای محصولات:\n• فایل CSV یا XLSX را با کپشن /import بفرستید (یا روی فایل ریپلای کنید)\n"
+            f"• ستون‌ها: {', '.join(catalog_io.CATALOG_COLUMNS)} (اولی‌ها الزامی؛ category = slug دسته)\n"
+            "• محصول با همان دسته و نام به‌روز می‌شود، بقیه اضافه می‌شوند.\n"
+            "خروجی فعلی با /export"
+        )
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        return await msg.reply_text("❗️ فایل بزرگ‌تر از ۱۰ مگابایت است.")
+    data = bytes(await (await doc.get_file()).download_as_bytearray())
+    try:
+        csv_file, columns = catalog_io.prepare_import(doc.file_name or "", data)
+        inserted, updated, errors = await adb.import_catalog(csv_file, columns)
+    except ValueError as e:
+        return await msg.reply_text(f"❗️ {e}")
+    except Exception as e:
+        # خطای COPY (مثلاً تعداد ستون نادرست) شماره‌ی سطر را در پیامش دارد؛ چیزی ثبت نشده
+        log.warning(f"catalog import failed: {e}")
+        return await msg.reply_text(f"❗️ فایل خوانده نشد و هیچ تغییری ثبت نشد:\n{str(e)[:500]}")
+    lines = [f"📥 بارگذاری کاتالوگ: {inserted} جدید، {updated} به‌روزرسانی، {len(errors)} خطا"]
+    for line_no, err in errors[:20]:
+        lines.append(f"• سطر {line_no}: {err}")
+    if len(errors) > 20:
+        lines.append(f"… و {len(errors) - 20} خطای دیگر")
+    await msg.reply_text("\n".join(lines))
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    f = catalog_io.export_file()
+    try:
+        await adb.export_catalog(f)
+        f.seek(0)
+        await update.effective_chat.send_document(InputFile(f, filename="catalog.csv"),
+                                                  caption="📤 کاتالوگ (قابل ویرایش و بارگذاری با /import)")
+    finally:
+        f.close()
+
+# ---------- Admin: broadcast ----------
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    msg = update.message
+    src = msg.reply_to_message
+    text = msg.text.partition(" ")[2].strip()
+    if not src and not text:
+        return await msg.reply_text(
+            "ارسال پیام همگانی:\n• روی یک پیام ریپلای کنید و /broadcast بفرستید (عکس/متن کپی می‌شود)\n"
+            "• یا: /broadcast متن پیام"
+        )
+    bid = await adb.create_broadcast(
+        update.effective_user.id,
+        src.chat_id if src else None,
+        src.message_id if src else None,
+        None if src else text,
+    )
+    broadcast.schedule(context.application, bid)
+    await msg.reply_text(f"📣 پیام همگانی #{bid} در صف ارسال قرار گرفت. لغو: /bcancel {bid}")
+
+async def cmd_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    if not context.args or not context.args[0].isdigit():
+        return await update.message.reply_text("استفاده: /bcancel <شماره>")
+    await adb.finish_broadcast(int(context.args[0]), "cancelled")
+    await update.message.reply_text("⏹ درخواست لغو ثبت شد (بعد از دسته‌ی جاری متوقف می‌شود).")
 
 # ---------- Help ----------
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -368,20 +639,9 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=main_keyboard()
     )
 
-# ---------- Internal ----------
-async def _notify_admins(context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup=None):
-    ok = False
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=text, reply_markup=reply_markup)
-            ok = True
-        except Exception as e:
-            log.warning(f"notify admin failed: {e}")
-    if not ok:
-        log.warning("no admin notified")
-
 # ---------- Builder ----------
-def build_handlers():
+def build_handlers(persistent: bool = True):
+    # persistent=False فقط برای اجرای بدون persistence (مثلاً bench)
     conv_add_product = ConversationHandler(
         entry_points=[CallbackQueryHandler(cb_add_product_entry, pattern=r"^addp:\d+$")],
         states={
@@ -392,9 +652,10 @@ def build_handlers():
         },
         fallbacks=[],
         name="add_product",
-        persistent=False,
+        persistent=persistent,
     )
 
+    # «👛 کیف پول» فقط ورودی همین مکالمه است؛ هندلر جدا جلوتر از آن، مکالمه را هرگز شروع نمی‌کرد
     conv_topup = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^👛 کیف پول$"), wallet)],
         states={
@@ -403,27 +664,41 @@ def build_handlers():
         },
         fallbacks=[],
         name="topup",
-        persistent=False,
+        persistent=persistent,
+        allow_reentry=True,
     )
 
     return [
         CommandHandler("start", start),
         MessageHandler(filters.Regex("^🍭 منو$"), menu),
         MessageHandler(filters.Regex("^🧾 سفارش$"), order_entry),
-        MessageHandler(filters.Regex("^👛 کیف پول$"), wallet),
         MessageHandler(filters.Regex("^ℹ️ راهنما$"), help_cmd),
+        CommandHandler("checktotals", cmd_check_totals),
+        CommandHandler("reconcile", cmd_reconcile),
+        CommandHandler("broadcast", cmd_broadcast),
+        CommandHandler("report", cmd_report),
+        CommandHandler("kitchen", cmd_kitchen),
+        CommandHandler("import", cmd_import),
+        MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), cmd_import),
+        CommandHandler("export", cmd_export),
+        CommandHandler("bcancel", cmd_broadcast_cancel),
 
         CallbackQueryHandler(cb_category,      pattern=r"^cat:\d+$"),
-        CallbackQueryHandler(cb_category_page, pattern=r"^catp:\d+:\d+$"),
+        CallbackQueryHandler(cb_category_page, pattern=r"^catp:\d+:\d+:[ab]\d+$"),
+        CallbackQueryHandler(cb_product_photo, pattern=r"^pv:\d+:\d+:(-|[ab]\d+):\d+$"),
         CallbackQueryHandler(cb_add_to_cart,   pattern=r"^add:\d+$"),
+        CallbackQueryHandler(cb_wallet_statement, pattern=r"^wst:\d+$"),
 
         CallbackQueryHandler(cb_toggle_shipping, pattern=r"^ship:toggle$"),
         CallbackQueryHandler(cb_toggle_pay,      pattern=r"^pay:toggle$"),
         CallbackQueryHandler(cb_submit_order,    pattern=r"^submit:\d+$"),
         CallbackQueryHandler(cb_empty,           pattern=r"^empty:\d+$"),
 
+        InlineQueryHandler(inline_search),
+
         # تایید/رد: tpa|tpr برای شارژ، opa|opr برای سفارش
         CallbackQueryHandler(cb_topup_or_order_decide, pattern=r"^(tpa|tpr|opa|opr):\d+$"),
+        CallbackQueryHandler(cb_kitchen_advance, pattern=r"^kq:\d+:(preparing|ready|delivered)$"),
 
         conv_add_product,
         conv_topup,
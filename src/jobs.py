@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""کارهای دوره‌ای نگه‌داری (JobQueue)؛ فقط روی رهبر cluster ثبت می‌شوند."""
+import time
+
+from telegram.ext import Application, ContextTypes
+
+from .base import (
+    log, fmt_money, ADMIN_IDS, WALLET_CHECKPOINT_INTERVAL, UPDATE_DEDUP_DB, JANITOR_INTERVAL, JANITOR_BATCH,
+    DRAFT_TTL_HOURS, PAYMENT_REQUEST_TTL_HOURS, ORDER_ARCHIVE_DAYS,
+)
+from . import adb, outbox
+
+JOB_NAMES = ("wallet_checkpoint", "prune_updates", "janitor")
+# سقف دسته‌ها در هر اجرا؛ عقب‌ماندگی بیشتر در اجراهای بعدی جمع می‌شود
+JANITOR_MAX_BATCHES = 20
+
+async def wallet_checkpoint(context: ContextTypes.DEFAULT_TYPE):
+    t0 = time.perf_counter()
+    n = await adb.checkpoint_wallets()
+    log.info(f"wallet checkpoint: {n} user(s) in {(time.perf_counter()-t0)*1000:.0f} ms")
+
+async def prune_updates(context: ContextTypes.DEFAULT_TYPE):
+    n = await adb.prune_processed_updates()
+    if n:
+        log.info(f"processed_updates: pruned {n} row(s)")
+
+async def _drain(fn, age: float) -> int:
+    total = 0
+    for _ in range(JANITOR_MAX_BATCHES):
+        n = await fn(age, JANITOR_BATCH)
+        total += n
+        if n < JANITOR_BATCH:
+            break
+    return total
+
+def _expiry_notices(rows):
+    """مشتری (که شاید رسید یا وجه را فرستاده) و ادمین‌ها از منقضی شدن درخواست باخبر شوند."""
+    out = []
+    for r in rows:
+        if r["order_id"]:
+            what = f"درخواست پرداخت سفارش #{r['order_id']}"
+        else:
+            what = f"درخواست شارژ {fmt_money(r['amount'])}"
+        out.append(outbox.message(r["telegram_id"], (
+            f"⌛️ {what} در {PAYMENT_REQUEST_TTL_HOURS:.0f} ساعت بررسی نشد و منقضی شد.\n"
+            "اگر مبلغ را واریز کرده‌اید، رسید را دوباره بفرستید تا ادمین بررسی کند."
+        )))
+    ids = ", ".join(f"#{r['req_id']}" for r in rows[:50])
+    more = f" و {len(rows) - 50} مورد دیگر" if len(rows) > 50 else ""
+    admin_txt = (f"⌛️ {len(rows)} درخواست شارژ/پرداخت بی‌پاسخ منقضی شد: {ids}{more}\n"
+                 "دکمه‌های تایید این درخواست‌ها دیگر اثری ندارند؛ به مشتری‌ها اطلاع داده شد.")
+    return out + [outbox.message(a, admin_txt) for a in ADMIN_IDS]
+
+async def _expire_requests(age: float, limit: int) -> int:
+    return await adb.expire_payment_requests(age, limit, _expiry_notices)
+
+async def janitor(context: ContextTypes.DEFAULT_TYPE):
+    t0 = time.perf_counter()
+    # اول درخواست‌ها: سبدی که درخواست پرداخت pending دارد حذف نمی‌شود
+    expired = await _drain(_expire_requests, PAYMENT_REQUEST_TTL_HOURS)
+    if expired:
+        outbox.wake()
+    drafts = await _drain(adb.expire_drafts, DRAFT_TTL_HOURS)
+    archived = await _drain(adb.archive_orders, ORDER_ARCHIVE_DAYS) if ORDER_ARCHIVE_DAYS > 0 else 0
+    if expired or drafts or archived:
+        log.info(f"janitor: {expired} request(s) expired, {drafts} draft(s) removed, "
+                 f"{archived} order(s) archived in {(time.perf_counter()-t0)*1000:.0f} ms")
+
+def register(app: Application):
+    app.job_queue.run_repeating(wallet_checkpoint, interval=WALLET_CHECKPOINT_INTERVAL, first=60,
+                                name="wallet_checkpoint")
+    if UPDATE_DEDUP_DB:
+        app.job_queue.run_repeating(prune_updates, interval=3600, first=120, name="prune_updates")
+    app.job_queue.run_repeating(janitor, interval=JANITOR_INTERVAL, first=180, name="janitor")
+
+def unregister(app: Application):
+    for name in JOB_NAMES:
+        for job in app.job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""صف آشپزخانه: سفارش‌های پرداخت‌شده paid → preparing → ready → delivered جلو می‌روند.
+
+باریستاها یک تابلوی پین‌شده (یک پیام در هر چت ادمین/گروه) دارند که در جا ویرایش
+می‌شود. هر تغییر فقط touch() می‌کند؛ حلقه‌ی تابلو (فقط روی رهبر cluster) تغییرات هر
+KITCHEN_BOARD_INTERVAL ثانیه را در یک ویرایش به ازای هر تابلو جمع می‌کند، پس شلوغی
+ساعت اوج حداکثر «تعداد تابلو ÷ بازه» درخواست Bot API در ثانیه هزینه دارد.
+"""
+import asyncio
+from zoneinfo import ZoneInfo
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application
+
+from .base import log, ADMIN_IDS, KITCHEN_BOARD_INTERVAL, KITCHEN_BOARD_SIZE
+from .db import KITCHEN_FLOW, REPORT_TZ
+from . import adb
+
+TZ = ZoneInfo(REPORT_TZ)
+STATUS_ICONS = {"paid": "🆕", "preparing": "👩‍🍳", "ready": "✅"}
+# برچسب دکمه‌ی رفتن به هر مرحله
+ACTION_LABELS = {"preparing": "شروع آماده‌سازی", "ready": "آماده شد", "delivered": "تحویل شد"}
+# سقف‌های Bot API: متن پیام ۴۰۹۶ واحد UTF-16 (ایموجی‌ها بیش از یک واحد)، ۱۰۰ دکمه در کیبورد
+MAX_TEXT = 4096
+MAX_BUTTONS = 100
+
+_dirty: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+# آخرین (message_id، متن) هر تابلو تا ویرایش بی‌تغییر ارسال نشود
+_shown: dict[int, tuple[int, str]] = {}
+
+def touch():
+    """بعد از هر تغییر صف صدا بزنید؛ ویرایش تابلو با تاخیر و دسته‌ای انجام می‌شود."""
+    if _dirty is not None:
+        _dirty.set()
+
+# ---------- متن‌ها ----------
+def customer_notice(row) -> str:
+    oid, status = row["order_id"], row["status"]
+    if status == "preparing":
+        return f"👩‍🍳 سفارش #{oid} در حال آماده‌سازی است."
+    if status == "ready":
+        if row["shipping_method"] == "پیک":
+            return f"✅ سفارش #{oid} آماده است و به‌زودی با پیک ارسال می‌شود."
+        return f"✅ سفارش #{oid} آماده است؛ می‌توانید تحویل بگیرید."
+    return f"📦 سفارش #{oid} تحویل شد. نوش جان!"
+
+def _tg_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def _clip(text: str, n: int) -> str:
+    return text if len(text) <= n else text[:n - 1] + "…"
+
+def render(rows):
+    """(متن، کیبورد) تابلو از خروجی kitchen_queue؛ سفارش‌هایی که در سقف پیام جا نشوند
+    فقط در شمارش «… و N سفارش دیگر» می‌آیند."""
+    if not rows:
+        return "🧑‍🍳 صف سفارش‌ها خالی است.", None
+    total = rows[0]["total"]
+    lines = [f"🧑‍🍳 صف سفارش‌ها ({total})\n"]
+    # جا برای سطر آخر «… و N سفارش دیگر»
+    budget = MAX_TEXT - _tg_len(lines[0]) - 40
+    buttons = []
+    for r in rows[:MAX_BUTTONS]:
+        at = f"{r['paid_at'].astimezone(TZ):%H:%M}" if r["paid_at"] else "--:--"
+        line = (f"{STATUS_ICONS[r['status']]} #{r['order_id']} | {at} | {_clip(r['name'] or '-', 32)} | "
+                f"{r['shipping_method'] or '-'}\n    {_clip(r['items'] or '-', 80)}")
+        size = _tg_len(line) + 1
+        if size > budget:
+            break
+        budget -= size
+        lines.append(line)
+        nxt = KITCHEN_FLOW[r["status"]]
+        buttons.append([InlineKeyboardButton(f"#{r['order_id']} ▶️ {ACTION_LABELS[nxt]}",
+                                             callback_data=f"kq:{r['order_id']}:{nxt}")])
+    if total > len(buttons):
+        lines.append(f"\n… و {total - len(buttons)} سفارش دیگر")
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+# ---------- تابلو ----------
+async def post_board(bot, chat_id: int, board=None) -> int:
+    """ارسال تابلوی تازه در این چت، پین و ثبت آن به‌عنوان تابلوی چت.
+
+    board: (متن، کیبورد) از قبل ساخته‌شده؛ None یعنی از صف فعلی ساخته شود.
+    """
+    text, kb = board or render(await adb.kitchen_queue(KITCHEN_BOARD_SIZE))
+    msg = await bot.send_message(chat_id, text, reply_markup=kb)
+    try:
+        await bot.pin_chat_message(chat_id, msg.message_id, disable_notification=True)
+    except TelegramError as e:
+        # در گروه، ربات بدون دسترسی پین فقط پیام را می‌فرستد
+        log.warning(f"kitchen: cannot pin board in {chat_id}: {e}")
+    await adb.set_kitchen_board(chat_id, msg.message_id)
+    _shown[chat_id] = (msg.message_id, text)
+    return msg.message_id
+
+async def _show(bot, chat_id: int, message_id: int, board):
+    text, kb = board
+    try:
+        await bot.edit_message_text(text, chat_id, message_id, reply_markup=kb)
+    except BadRequest as e:
+        err = str(e).lower()
+        if "not found" in err:
+            # تابلو پاک شده؛ تابلوی جدید (post_board خودش _shown را ثبت می‌کند)
+            await post_board(bot, chat_id, board)
+            return
+        if "not modified" not in err:
+            raise
+    _shown[chat_id] = (message_id, text)
+
+async def refresh(bot):
+    board = render(await adb.kitchen_queue(KITCHEN_BOARD_SIZE))
+    boards = await adb.list_kitchen_boards()
+    if not boards:
+        # پیش‌فرض: یک تابلو در چت هر ادمین (جای پیام جدا برای هر سفارش)
+        boards = {admin_id: None for admin_id in ADMIN_IDS}
+    # خطای هر تابلو همان تابلو را رد می‌کند؛ بقیه و حلقه‌ی تابلو ادامه می‌دهند
+    for chat_id, message_id in boards.items():
+        if message_id is not None and _shown.get(chat_id) == (message_id, board[0]):
+            continue
+        try:
+            if message_id is None:
+                await post_board(bot, chat_id, board)
+            else:
+                await _show(bot, chat_id, message_id, board)
+        except RetryAfter as e:
+            # بقیه‌ی تابلوها در دور بعد، بعد از مهلت تلگرام
+            log.warning(f"kitchen: flood control, retry in {e.retry_after}s")
+            touch()
+            await asyncio.sleep(float(e.retry_after))
+            return
+        except Forbidden as e:
+            log.warning(f"kitchen: board chat {chat_id} unreachable, dropped: {e}")
+            if message_id is not None:
+                await adb.drop_kitchen_board(chat_id)
+            _shown.pop(chat_id, None)
+        except BadRequest as e:
+            log.warning(f"kitchen: board {chat_id}/{message_id}: {e}")
+        except NetworkError as e:
+            # گذرا؛ دور بعد دوباره
+            log.warning(f"kitchen: board {chat_id}/{message_id}: {e}")
+            touch()
+        except TelegramError as e:
+            log.warning(f"kitchen: board {chat_id}/{message_id}: {e}")
+
+async def _run(app: Application):
+    while True:
+        await _dirty.wait()
+        # تغییرات این بازه (مثلاً چند پرداخت پشت سر هم) در یک ویرایش جمع می‌شوند
+        await asyncio.sleep(KITCHEN_BOARD_INTERVAL)
+        _dirty.clear()
+        try:
+            await refresh(app.bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"kitchen board refresh failed: {e}")
+
+def start(app: Application):
+    global _dirty, _task
+    _dirty = asyncio.Event()
+    _dirty.set()  # تابلو بعد از شروع (یا رهبر شدن) یک بار هماهنگ شود
+    _task = asyncio.create_task(_run(app), name="kitchen")
+
+async def stop():
+    global _dirty, _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    _dirty = None
+    _shown.clear()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""متریک‌های درون‌پردازه‌ای با خروجی متنی Prometheus (بدون وابستگی خارجی)."""
+import bisect
+import functools
+import threading
+import time
+
+# ثانیه
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: list = []
+_collectors: list = []
+
+def _fmt_labels(names, values, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace('"', "'")) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, labels: tuple = (), n: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for labels, v in items:
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {v}"
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels → [counts per bucket..., +Inf count, sum]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, labels: tuple, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def time(self, labels: tuple = ()):
+        return _Timer(self, labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        for labels, s in items:
+            acc = 0
+            for b, c in zip(self.buckets + ("+Inf",), s):
+                acc += c
+                le = 'le="%s"' % b
+                yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {acc}"
+            yield f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {s[-1]}"
+            yield f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {acc}"
+
+class _Timer:
+    def __init__(self, hist: Histogram, labels: tuple):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(self.labels, time.perf_counter() - self.t0)
+
+def register_collector(fn):
+    """fn() → iterable از (name, type, help, {labels_tuple_as_dict...}, value)؛ برای gaugeهای لحظه‌ای."""
+    _collectors.append(fn)
+    return fn
+
+def render() -> str:
+    lines = []
+    for m in _registry:
+        lines.extend(m.render())
+    for fn in _collectors:
+        seen = set()
+        for name, mtype, help_text, labels, value in fn():
+            if name not in seen:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {mtype}")
+                seen.add(name)
+            lines.append(f"{name}{_fmt_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
+
+# ---------- متریک‌های مشترک ----------
+HANDLER_SECONDS = Histogram("crepebar_handler_seconds", "Handler callback latency", ("handler",))
+HANDLER_ERRORS = Counter("crepebar_handler_errors_total", "Handler callbacks that raised", ("handler",))
+CALLBACK_SECONDS = Histogram("crepebar_callback_seconds", "Callback-query latency by data prefix", ("prefix",))
+DB_QUERY_SECONDS = Histogram("crepebar_db_query_seconds", "SQL statement latency by verb", ("verb",))
+DB_SLOW_QUERIES = Counter("crepebar_db_slow_queries_total", "Statements slower than DB_SLOW_QUERY_MS", ("verb",))
+DUPLICATE_UPDATES = Counter("crepebar_duplicate_updates_total", "Redelivered updates dropped before dispatch", ("source",))
+DB_CONNECTIONS = Counter("crepebar_db_connections_opened_total", "Physical Postgres connections opened")
+
+# ---------- هندلرهای تلگرام ----------
+def _timed(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc((name,))
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            HANDLER_SECONDS.observe((name,), dt)
+            cq = getattr(update, "callback_query", None)
+            if cq is not None and cq.data:
+                CALLBACK_SECONDS.observe((cq.data.split(":", 1)[0],), dt)
+    return wrapper
+
+def instrument(handler):
+    """callback هندلر (و هندلرهای داخل ConversationHandler) را با زمان‌سنج می‌پوشاند."""
+    from telegram.ext import ConversationHandler
+    if isinstance(handler, ConversationHandler):
+        for h in handler.entry_points:
+            instrument(h)
+        for hs in handler.states.values():
+            for h in hs:
+                instrument(h)
+        for h in handler.fallbacks:
+            instrument(h)
+        return handler
+    cb = handler.callback
+    handler.callback = _timed(cb, getattr(cb, "__name__", type(handler).__name__))
+    return handler
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Outbox: پیام‌های تلگرامی در همان تراکنشِ تغییر وضعیت در جدول outbox ثبت می‌شوند
+و این dispatcher در پس‌زمینه آن‌ها را دسته‌ای، با سقف هم‌زمانی، تلاش مجدد و
+dead-letter ارسال می‌کند. هندلرها منتظر Bot API نمی‌مانند و قطعی شبکه پیام را گم نمی‌کند.
+"""
+import asyncio
+import time
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application
+
+from .base import (
+    log, OUTBOX_BATCH, OUTBOX_CONCURRENCY, OUTBOX_MAX_ATTEMPTS, OUTBOX_POLL_INTERVAL,
+)
+from . import adb
+
+# اگر ارسال یک دسته بیش از این طول بکشد، پیام‌ها دوباره قابل برداشت می‌شوند
+LEASE_SECONDS = 120
+
+_wakeup: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+
+# ---------- ساخت پیام ----------
+def message(chat_id: int, text: str, reply_markup: InlineKeyboardMarkup | None = None) -> dict:
+    payload = {"text": text}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_dict()
+    return {"chat_id": chat_id, "method": "send_message", "payload": payload}
+
+def photo(chat_id: int, file_id: str, caption: str, reply_markup: InlineKeyboardMarkup | None = None) -> dict:
+    payload = {"photo": file_id, "caption": caption}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_dict()
+    return {"chat_id": chat_id, "method": "send_photo", "payload": payload}
+
+def wake():
+    """بعد از commit پیام‌های جدید صدا بزنید تا بدون انتظار poll ارسال شوند."""
+    if _wakeup is not None:
+        _wakeup.set()
+
+# ---------- dispatcher ----------
+async def _send(bot, row):
+    """(outbox_id, ok, latency, error, retry_seconds|None)"""
+    payload = dict(row["payload"])
+    if "reply_markup" in payload:
+        payload["reply_markup"] = InlineKeyboardMarkup.de_json(payload["reply_markup"], bot)
+    t0 = time.perf_counter()
+    try:
+        await getattr(bot, row["method"])(chat_id=row["chat_id"], **payload)
+        return row["outbox_id"], True, time.perf_counter() - t0, None, None
+    except RetryAfter as e:
+        err, delay = e, float(e.retry_after)
+    except (BadRequest, Forbidden) as e:
+        # تکرار فایده ندارد → dead
+        return row["outbox_id"], False, time.perf_counter() - t0, e, None
+    except NetworkError as e:
+        err, delay = e, min(300.0, 2.0 ** row["attempts"])
+    except Exception as e:
+        return row["outbox_id"], False, time.perf_counter() - t0, e, None
+    if row["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        delay = None
+    return row["outbox_id"], False, time.perf_counter() - t0, err, delay
+
+async def drain_once(bot) -> int:
+    rows = await adb.claim_outbox(OUTBOX_BATCH, LEASE_SECONDS)
+    if not rows:
+        return 0
+    sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+
+    async def limited(row):
+        async with sem:
+            return await _send(bot, row)
+
+    results = await asyncio.gather(*(limited(r) for r in rows))
+    sent = [oid for oid, ok, *_ in results if ok]
+    failures = [(oid, str(err)[:500], delay) for oid, ok, _, err, delay in results if not ok]
+    await adb.finish_outbox(sent, failures)
+
+    chats = {r["outbox_id"]: r["chat_id"] for r in rows}
+    log.info(
+        f"outbox: {len(sent)}/{len(rows)} sent; "
+        + ", ".join(f"{chats[oid]}={lat*1000:.0f}ms" for oid, _, lat, _, _ in results)
+    )
+    for oid, ok, _, err, delay in results:
+        if not ok:
+            what = "dead-lettered" if delay is None else f"retry in {delay:.0f}s"
+            log.warning(f"outbox #{oid} -> {chats[oid]} {what}: {err}")
+    return len(rows)
+
+async def _run(app: Application):
+    while True:
+        # پیش از برداشت پاک می‌شود تا wake() در حین ارسال گم نشود
+        _wakeup.clear()
+        try:
+            n = await drain_once(app.bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"outbox dispatcher error: {e}")
+            n = 0
+        if n >= OUTBOX_BATCH:
+            continue  # صف هنوز پر است
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start(app: Application):
+    global _wakeup, _task
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run(app), name="outbox")
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
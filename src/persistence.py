@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""PostgresPersistence: وضعیت ConversationHandlerها و user_data در Postgres.
+
+Application هر update_interval ثانیه تغییرات کثیف را با update_* می‌فرستد؛ این‌جا
+فقط در حافظه جمع می‌شوند و همه‌ی فراخوانی‌های یک دور با یک تراکنش
+(db.save_persistence) نوشته می‌شوند. هزینه‌ی هر update فقط علامت‌گذاری است.
+chat_data، bot_data و callback_data استفاده نمی‌شوند و ذخیره نمی‌شوند.
+"""
+import asyncio
+import time
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+from .base import log, PERSISTENCE_INTERVAL
+from . import adb
+
+class PostgresPersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._users: dict = {}          # user_id → dict یا None (حذف)
+        self._convs: dict = {}          # (name, key) → state یا None (پایان)
+        self._write: asyncio.Task | None = None
+        # حالت cluster: user_data تازه از try_chat_lock تا refresh_user_data آن را جایگزین کند
+        self._fresh: dict = {}
+        self._conv_maps: dict | None = None     # name → وضعیت‌های هر ConversationHandler؛ bind()
+        self.counters = {"flushes": 0, "rows": 0, "seconds": 0.0}
+
+    # ---------- بارگذاری هنگام initialize ----------
+    async def get_user_data(self):
+        return await adb.load_user_data()
+
+    async def get_conversations(self, name: str):
+        return await adb.load_conversations(name)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ---------- تغییرات: جمع در حافظه، نوشتن دسته‌ای ----------
+    async def update_user_data(self, user_id: int, data: dict):
+        self._users[user_id] = data      # Application خودش deepcopy می‌دهد
+        await self._write_soon()
+
+    async def drop_user_data(self, user_id: int):
+        self._users[user_id] = None
+        await self._write_soon()
+
+    async def update_conversation(self, name: str, key, new_state):
+        self._convs[(name, key)] = new_state
+        await self._write_soon()
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data):
+        # Application پیش از هر callback صدا می‌زند؛ فقط در حالت cluster چیزی آماده است
+        if user_id in self._fresh:
+            fresh = self._fresh.pop(user_id)
+            user_data.clear()
+            user_data.update(fresh or {})
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await self._save()
+
+    # update_*های یک دور با gather هم‌زمان صدا زده می‌شوند؛ اولی task نوشتن را می‌سازد
+    # و چون task بعد از بقیه اجرا می‌شود، همه در یک تراکنش نوشته می‌شوند
+    async def _write_soon(self):
+        if self._write is None or self._write.done():
+            self._write = asyncio.create_task(self._save())
+        await asyncio.shield(self._write)
+
+    async def _save(self):
+        if not (self._users or self._convs):
+            return
+        users, convs = self._users, self._convs
+        self._users, self._convs = {}, {}
+        t0 = time.perf_counter()
+        try:
+            await adb.save_persistence(users, convs)
+        except Exception:
+            # تغییرات جدیدتر (اگر آمده) مقدم‌اند؛ بقیه در دور بعد دوباره نوشته می‌شوند
+            self._users = {**users, **self._users}
+            self._convs = {**convs, **self._convs}
+            raise
+        dt = time.perf_counter() - t0
+        self.counters["flushes"] += 1
+        self.counters["rows"] += len(users) + len(convs)
+        self.counters["seconds"] += dt
+        log.debug(f"persistence: {len(users)} user_data + {len(convs)} conversations in {dt*1000:.1f}ms")
+
+    # ---------- حالت cluster ----------
+    def bind(self, app):
+        """بعد از app.initialize: وضعیت مکالمه‌های ماندگار را برای restore_chat پیدا می‌کند.
+
+        PTB (۲۱.x) برای عوض کردن وضعیت یک مکالمه در حین اجرا API عمومی ندارد؛ وضعیت‌ها را
+        فقط هنگام initialize از get_conversations می‌خواند و با update_conversation
+        برمی‌گرداند. پس این‌جا همان dictهایی که از get_conversations پر شده‌اند یک بار
+        پیدا و بررسی می‌شوند؛ اگر ساختار PTB عوض شده باشد ربات بالا نمی‌آید (RuntimeError)
+        به‌جای این‌که وضعیت‌های بازگردانده بی‌صدا دور ریخته شوند.
+        """
+        names = {h.name for group in app.handlers.values() for h in group
+                 if isinstance(h, ConversationHandler) and h.persistent}
+        maps = getattr(app, "_conversation_handler_conversations", None)
+        if (not isinstance(maps, dict) or set(maps) != names
+                or not all(hasattr(m, "update_no_track") and hasattr(m, "data") for m in maps.values())):
+            raise RuntimeError("persistence: unsupported python-telegram-bot version; "
+                               "conversation states cannot be restored per chat")
+        self._conv_maps = maps
+
+    def restore_chat(self, chat_id: int, user_id: int | None, user_data, states: dict):
+        """وضعیت تازه‌ی یک چت (از db.try_chat_lock) را جایگزین نسخه‌ی حافظه‌ی این پردازه می‌کند.
+
+        در حالت چند worker، پردازه‌ی دیگری ممکن است آپدیت قبلی همین چت را پردازش کرده
+        باشد؛ مکالمه‌های پیش‌فرض (per_chat و per_user) کلید (chat_id, user_id) دارند.
+        user_data از مسیر عمومی refresh_user_data جایگزین می‌شود.
+        """
+        if self._conv_maps is None:
+            raise RuntimeError("persistence: bind(app) was not called")
+        key = (chat_id, user_id)
+        for name, convs in self._conv_maps.items():
+            # update_no_track: همین حالا از دیتابیس آمده و نباید دوباره نوشته شود
+            if name in states:
+                convs.update_no_track({key: states[name]})
+            else:
+                convs.data.pop(key, None)
+        if user_id is not None:
+            self._fresh[user_id] = user_data
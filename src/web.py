@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""سرور HTTP (tornado): وبهوک تلگرام + متریک‌ها + health روی همان پورت."""
+import hmac
+import json
+import re
+from urllib.parse import urlparse
+
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+from .base import (
+    log, PUBLIC_URL, WEBHOOK_SECRET, METRICS_PATH, METRICS_TOKEN, UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_DB,
+)
+from .cache import RecentSet
+from . import adb, metrics
+
+# update_idهای اخیر این پردازه؛ redelivery تلگرام (مثلاً بعد از پاسخ کند) قبل از صف حذف می‌شود
+_recent_updates = RecentSet(UPDATE_DEDUP_WINDOW)
+
+async def is_duplicate(update_id: int) -> bool:
+    if not _recent_updates.add(update_id):
+        metrics.DUPLICATE_UPDATES.inc(("memory",))
+        return True
+    if UPDATE_DEDUP_DB:
+        try:
+            if not await adb.claim_update(update_id):
+                metrics.DUPLICATE_UPDATES.inc(("db",))
+                return True
+        except Exception as e:
+            # بهتر است احتمالاً تکراری پردازش شود تا این‌که گم شود
+            log.warning(f"update {update_id}: dedupe check failed: {e}")
+    return False
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, app: Application):
+        self.app = app
+
+    async def post(self):
+        if WEBHOOK_SECRET:
+            got = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(got, WEBHOOK_SECRET):
+                raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except Exception as e:
+            log.warning(f"bad webhook payload: {e}")
+            raise tornado.web.HTTPError(400)
+        if await is_duplicate(update.update_id):
+            log.info(f"update {update.update_id}: duplicate dropped")
+        else:
+            await self.app.update_queue.put(update)
+        self.set_status(200)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        if METRICS_TOKEN and not hmac.compare_digest(self.get_query_argument("token", ""), METRICS_TOKEN):
+            raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+def webhook_path() -> str:
+    return urlparse(PUBLIC_URL).path.rstrip("/") or "/"
+
+def make_app(app: Application) -> tornado.web.Application:
+    return tornado.web.Application([
+        (re.escape(METRICS_PATH), MetricsHandler),
+        (r"/healthz", HealthHandler),
+        (re.escape(webhook_path()), WebhookHandler, {"app": app}),
+    ])
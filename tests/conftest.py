@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""fixtureهای مشترک تست‌ها؛ Postgres موقت همان bench/local_pg است."""
+import os
+import subprocess
+
+import pytest
+
+# src.base تنظیمات را هنگام import از env می‌خواند و ماژول‌های تست src را در سطح
+# ماژول import می‌کنند؛ پس env باید پیش از جمع‌آوری تست‌ها (همین‌جا) ست شود
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ADMIN_IDS", "900000")
+if os.getenv("BENCH_DATABASE_URL"):
+    os.environ.setdefault("DATABASE_URL", os.environ["BENCH_DATABASE_URL"])
+
+@pytest.fixture(scope="session")
+def db():
+    """ماژول src.db روی یک دیتابیس خالی با همه‌ی migrationها.
+
+    BENCH_DATABASE_URL اگر ست شده باشد استفاده می‌شود؛ وگرنه initdb/pg_ctl لازم است.
+    """
+    pytest.importorskip("psycopg2")
+    from bench.local_pg import local_postgres
+    ctx = local_postgres()
+    try:
+        url = ctx.__enter__()
+    except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+        pytest.skip(f"no local Postgres: {e}")
+    from src import db as _db
+    # آدرس Postgres موقت بعد از import شدن src.base معلوم می‌شود
+    os.environ["DATABASE_URL"] = url
+    _db.DATABASE_URL = url
+    _db.close_pool()
+    _db.init_db()
+    try:
+        yield _db
+    finally:
+        _db.close_pool()
+        ctx.__exit__(None, None, None)
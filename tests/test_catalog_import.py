@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""import_catalog با فایلی که فقط بخشی از ستون‌ها را دارد."""
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from src.catalog_io import prepare_import
+
+def _import(db, text: str):
+    csv_file, columns = prepare_import("catalog.csv", text.encode("utf-8"))
+    return db.import_catalog(csv_file, columns)
+
+def _product(db, cat_id: int, name: str):
+    with db._conn() as cn, cn.cursor() as cur:
+        cur.execute("""SELECT name, price, description, photo_file_id, is_active FROM products
+                        WHERE category_id=%s AND name=%s""", (cat_id, name))
+        return cur.fetchone()
+
+def test_partial_columns_keep_other_fields(db):
+    cat = db.list_categories()[0]
+    db.add_product(cat["id"], "Nutella crepe", 85000, "yum", "photo-n")
+    hidden = db.add_product(cat["id"], "Hidden crepe", 70000, "secret", None)
+    db._exec("UPDATE products SET is_active=FALSE WHERE product_id=%s", (hidden,))
+
+    inserted, updated, errors = _import(db, (
+        "category,name,price\n"
+        f"{cat['slug']},Nutella crepe,90000\n"
+        f"{cat['slug']},Hidden crepe,75000\n"
+        f"{cat['slug']},New crepe,60000\n"
+    ))
+
+    assert (inserted, updated, errors) == (1, 2, [])
+    n = _product(db, cat["id"], "Nutella crepe")
+    assert (float(n[1]), n[2], n[3], n[4]) == (90000, "yum", "photo-n", True)
+    h = _product(db, cat["id"], "Hidden crepe")
+    assert (float(h[1]), h[2], h[4]) == (75000, "secret", False)
+    new = _product(db, cat["id"], "New crepe")
+    assert (new[2], new[4]) == (None, True)
+
+def test_columns_in_file_are_updated(db):
+    cat = db.list_categories()[0]
+    db.add_product(cat["id"], "Lotus crepe", 80000, "old", None)
+
+    _, updated, errors = _import(db, (
+        "category,name,price,description,is_active\n"
+        f"{cat['slug']},Lotus crepe,81000,,0\n"
+    ))
+
+    assert (updated, errors) == (1, [])
+    row = _product(db, cat["id"], "Lotus crepe")
+    assert (float(row[1]), row[2], row[4]) == (81000, None, False)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""ترتیب و هم‌زمانی ChatLockProcessor (تک‌پردازه، بدون دیتابیس)."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("psycopg2")
+
+from src.cluster import ChatLockProcessor
+
+def _update(chat_id: int):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id),
+                           effective_user=SimpleNamespace(id=chat_id))
+
+def test_flooding_chat_does_not_block_other_chats():
+    async def scenario():
+        proc = ChatLockProcessor(2)
+        release = asyncio.Event()
+        done = []
+
+        async def handler(chat_id: int, n: int):
+            if chat_id == 1:
+                await release.wait()
+            done.append((chat_id, n))
+
+        # چت ۱ ده tap پشت سر هم می‌فرستد و اولی گیر کرده است
+        flood = [asyncio.create_task(proc.process_update(_update(1), handler(1, n))) for n in range(10)]
+        other = asyncio.create_task(proc.process_update(_update(2), handler(2, 0)))
+        await asyncio.wait_for(other, timeout=1)
+        assert done == [(2, 0)]
+
+        release.set()
+        await asyncio.gather(*flood)
+        # آپدیت‌های چت ۱ به ترتیب رسیدن پردازش شده‌اند
+        assert [n for c, n in done if c == 1] == list(range(10))
+        assert not proc._locks and not proc._waiters
+
+    asyncio.run(scenario())
+
+def test_updates_without_chat_bypass_chat_lock():
+    async def scenario():
+        proc = ChatLockProcessor(1)
+        done = []
+
+        async def handler():
+            done.append(True)
+
+        await proc.process_update(SimpleNamespace(), handler())
+        assert done == [True]
+
+    asyncio.run(scenario())
+
+def test_concurrency_cap_applies_across_chats():
+    async def scenario():
+        proc = ChatLockProcessor(2)
+        # process_update در PTB «final» است؛ سقف باید در do_process_update اعمال شود
+        assert "process_update" not in ChatLockProcessor.__dict__
+        release = asyncio.Event()
+        running = []
+
+        async def handler(chat_id: int):
+            running.append(chat_id)
+            await release.wait()
+
+        tasks = [asyncio.create_task(proc.process_update(_update(c), handler(c))) for c in (1, 2, 3)]
+        await asyncio.sleep(0.05)
+        assert running == [1, 2]
+
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+        assert running == [1, 2, 3]
+
+    asyncio.run(scenario())
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""pool کانکشن‌های بیکار را تا DB_POOL_MAX نگه می‌دارد و دوباره اتصال نمی‌سازد."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+def test_concurrent_borrows_reuse_connections(db):
+    n = db.DB_POOL_MAX
+    barrier = threading.Barrier(n)
+
+    def borrow(_):
+        with db._conn() as cn, cn.cursor() as cur:
+            cur.execute("SELECT 1")
+            # همه‌ی n کانکشن هم‌زمان قرض گرفته شوند
+            barrier.wait(timeout=10)
+
+    before = db.stats()["connects"]
+    for _ in range(3):
+        with ThreadPoolExecutor(n) as ex:
+            list(ex.map(borrow, range(n)))
+
+    assert db.stats()["connects"] - before <= n
+    assert len(db._get_pool()._pool) == n
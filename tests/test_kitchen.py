@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""تابلوی آشپزخانه در سقف پیام تلگرام می‌ماند."""
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("psycopg2")
+
+from src import kitchen
+
+def _rows(n: int):
+    paid_at = datetime(2026, 1, 1, 9, 30, tzinfo=timezone.utc)
+    return [{
+        "order_id": 1000 + i, "status": ("paid", "preparing", "ready")[i % 3],
+        "shipping_method": "پیک", "paid_at": paid_at, "name": "مشتری " * 20,
+        "items": "کرپ نوتلا ×2، " * 20, "total": n + 50,
+    } for i in range(n)]
+
+def test_busy_board_fits_telegram_limits():
+    text, kb = kitchen.render(_rows(120))
+    shown = len(kb.inline_keyboard)
+    assert kitchen._tg_len(text) <= kitchen.MAX_TEXT
+    assert 0 < shown <= kitchen.MAX_BUTTONS
+    assert f"… و {170 - shown} سفارش دیگر" in text
+
+def test_empty_board():
+    text, kb = kitchen.render([])
+    assert kb is None and "خالی" in text
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""تایید دیرهنگام پرداخت کارت‌به‌کارت سفارشی که قبلاً پرداخت شده است."""
+import pytest
+
+pytest.importorskip("psycopg2")
+
+def _scalar(db, sql_text: str, params=()):
+    with db._conn() as cn, cn.cursor() as cur:
+        cur.execute(sql_text, params)
+        return cur.fetchone()[0]
+
+def test_late_card_approval_does_not_repay_order(db):
+    tg_id = 5001
+    uid = db.upsert_user(tg_id, "late approval")
+    db.add_wallet_tx(uid, "topup", 1_000_000, {"test": True})
+    cat = db.list_categories()[0]
+    pid = db.add_product(cat["id"], "Payment crepe", 100000, None, None)
+    db.cart_add(tg_id, pid, 1)
+    order, _ = db.get_draft_with_items(uid)
+    oid = order["order_id"]
+
+    req_id = db.create_order_pay_request(oid, uid, 100000)
+    assert db.wallet_checkout(oid, tg_id)["status"] == "paid"
+    assert db.advance_order(oid, "preparing") is not None
+    orders_before = _scalar(db, "SELECT COALESCE(SUM(orders),0) FROM sales_daily")
+
+    row = db.decide_payment(req_id, True)
+
+    assert row["already_paid"] is True
+    assert _scalar(db, "SELECT status FROM orders WHERE order_id=%s", (oid,)) == "preparing"
+    assert _scalar(db, "SELECT status FROM topup_requests WHERE req_id=%s", (req_id,)) == "rejected"
+    assert _scalar(db, """SELECT COUNT(*) FROM wallet_transactions
+                           WHERE kind='cashback' AND meta->>'order_id' = %s""", (str(oid),)) == 1
+    assert _scalar(db, "SELECT COALESCE(SUM(orders),0) FROM sales_daily") == orders_before
+
+def test_expired_requests_notify_customer_and_admins(db):
+    tg_id = 5002
+    uid = db.upsert_user(tg_id, "expired topup")
+    req_id = db.create_topup_request(uid, 50000, 1)
+    db._exec("UPDATE topup_requests SET created_at = NOW() - interval '3 days' WHERE req_id=%s", (req_id,))
+    outbox_before = _scalar(db, "SELECT COUNT(*) FROM outbox")
+
+    def notices(rows):
+        assert [(r["req_id"], r["telegram_id"]) for r in rows] == [(req_id, tg_id)]
+        return [{"chat_id": tg_id, "method": "send_message", "payload": {"text": "expired"}},
+                {"chat_id": 900000, "method": "send_message", "payload": {"text": "expired"}}]
+
+    assert db.expire_payment_requests(48, 100, notices) == 1
+    assert _scalar(db, "SELECT status FROM topup_requests WHERE req_id=%s", (req_id,)) == "expired"
+    assert _scalar(db, "SELECT COUNT(*) FROM outbox") == outbox_before + 2
+    # تایید دیرهنگام ادمین اثری ندارد
+    assert db.decide_payment(req_id, True) is None
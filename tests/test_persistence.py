@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""بازگرداندن وضعیت یک چت در حالت cluster روی Application واقعی PTB (بدون دیتابیس)."""
+import asyncio
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("psycopg2")
+
+from telegram.ext import Application, ConversationHandler, ExtBot, MessageHandler, filters
+
+from src.persistence import PostgresPersistence
+
+class _Bot(ExtBot):
+    async def initialize(self):       # بدون getMe
+        pass
+
+class _Persistence(PostgresPersistence):
+    async def get_user_data(self):
+        return {}
+
+    async def get_conversations(self, name):
+        return {(1, 1): "old"}
+
+async def _noop(update, context):
+    pass
+
+def _app():
+    app = Application.builder().bot(_Bot("1:x")).persistence(_Persistence()).build()
+    conv = ConversationHandler(entry_points=[MessageHandler(filters.ALL, _noop)],
+                               states={"old": [], "new": []}, fallbacks=[],
+                               name="c", persistent=True)
+    app.add_handler(conv)
+    return app, conv
+
+def test_restore_chat_replaces_conversation_and_user_data():
+    async def scenario():
+        app, conv = _app()
+        await app.initialize()
+        p = app.persistence
+        # ارتقای PTB که این مسیر را بشکند باید همین‌جا خطا بدهد، نه بی‌صدا
+        p.bind(app)
+        maps = p._conv_maps["c"]
+
+        p.restore_chat(1, 1, {"cart": 3}, {"c": "new"})
+        assert maps[(1, 1)] == "new"
+        # از دیتابیس آمده؛ دوباره نوشته نمی‌شود
+        assert not maps.pop_accessed_write_items()
+
+        p.restore_chat(1, 1, None, {})
+        assert (1, 1) not in maps
+
+        app.user_data[1]["cart"] = 1
+        await p.refresh_user_data(1, app.user_data[1])
+        assert app.user_data[1] == {}
+        p.restore_chat(1, 1, {"cart": 3}, {})
+        await p.refresh_user_data(1, app.user_data[1])
+        assert app.user_data[1] == {"cart": 3}
+        await app.shutdown()
+
+    asyncio.run(scenario())
+
+def test_restore_chat_requires_bind():
+    with pytest.raises(RuntimeError):
+        PostgresPersistence().restore_chat(1, 1, None, {})